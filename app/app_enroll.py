@@ -0,0 +1,47 @@
+"""
+Enroll recipients and schedule their iterations from a CSV file (with a
+header) or a JSONL file, with one scheduled iteration per row and columns
+phone_number, full_name, instrument_id, opens_datetime (ISO 8601, local
+time unless it has a UTC offset) and message_body. From /app:
+
+    python app_enroll.py /persistent_storage/cohort.csv
+"""
+
+import argparse
+import json
+import os
+
+from utils.db import make_engine
+from utils.enrollment import (
+    ENROLLMENT_FORMATS,
+    enroll,
+)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("file")
+    parser.add_argument(
+        "--format",
+        choices=ENROLLMENT_FORMATS,
+        help="Defaults to the file's extension",
+    )
+    parser.add_argument("--json", help="Also write the report to this file")
+    args = parser.parse_args()
+
+    format = args.format or os.path.splitext(args.file)[1].lstrip(".")
+    with open(args.file, "rb") as f:
+        report = enroll(make_engine(), f, format)
+
+    for error in report.errors:
+        print(f"Row {error.row_number}: {error.message}")
+    print(
+        f"{report.n_rows} rows: {report.n_recipients_created} recipients and "
+        + f"{report.n_iterations_created} iterations created, "
+        + f"{len(report.already_scheduled)} already scheduled, "
+        + f"{len(report.errors)} failed"
+    )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report.to_json(), f, indent=2)
@@ -0,0 +1,68 @@
+"""
+Export the answers to an instrument in wide format, one row per iteration and
+one column per item, as CSV or Parquet (which needs pyarrow). For nightly
+jobs, --watermark-file makes each export only contain the iterations that
+changed since the previous one. From /app:
+
+    python app_export.py --instrument-id 1 --format parquet \\
+        --output /persistent_storage/eq5d_$(date +%F).parquet \\
+        --watermark-file /persistent_storage/eq5d.watermark
+"""
+
+import argparse
+import os
+from datetime import datetime
+
+from utils.db import make_engine
+from utils.export import (
+    EXPORT_FORMATS,
+    ResponseExport,
+)
+from utils.logging import LOGGER
+
+
+def read_watermark(path: str) -> datetime:
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return datetime.fromisoformat(f.readline().strip())
+
+
+def write_watermark(path: str, watermark: datetime) -> None:
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as f:
+        f.write(watermark.isoformat() + "\n")
+    os.replace(temporary_path, path)  # never leave a half-written watermark
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--instrument-id", type=int, required=True)
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="csv")
+    parser.add_argument("--output", required=True)
+    parser.add_argument(
+        "--since",
+        type=datetime.fromisoformat,
+        help="Only iterations changed since then (ISO 8601)",
+    )
+    parser.add_argument(
+        "--watermark-file",
+        help="Read --since from this file and store the new watermark in it",
+    )
+    args = parser.parse_args()
+
+    since = args.since or read_watermark(args.watermark_file)
+    export = ResponseExport(
+        make_engine(), args.instrument_id, format=args.format, since=since
+    )
+    with open(args.output, "wb") as f:
+        export.write(f)
+
+    if args.watermark_file:
+        write_watermark(args.watermark_file, export.watermark)
+    LOGGER.info(
+        f"Exported {export.n_iterations} iterations of instrument "
+        + f"{args.instrument_id} to {args.output} (since {since})"
+    )
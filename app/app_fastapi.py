@@ -1,56 +1,192 @@
-import hashlib
-import inspect
+import asyncio
 import json
 import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from functools import partial
+from itertools import chain
 
 import uvicorn
 from fastapi import (
     Depends,
     FastAPI,
     Request,
+    UploadFile,
 )
-from fastapi.responses import JSONResponse
-from sqlalchemy import (
-    and_,
-    func,
-    select,
-    update,
+from fastapi.responses import (
+    JSONResponse,
+    Response,
+    StreamingResponse,
 )
 from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine
 from utils.api import (
     XmlResponse,
     dump_request,
     fetch_awaiting_responses,
-    fetch_next_item,
+    idempotency_key,
+    is_admin,
     parse_response,
     to_xml_response,
 )
-from utils.db import (
-    make_engine,
-    make_session,
+from utils.archive import REQUEST_ARCHIVE
+from utils.catalog import (
+    CatalogListener,
+    InstrumentCatalog,
+)
+from utils.config import read_secret
+from utils.conversation import (
+    INVALID_ANSWER_TEXT,
+    conversation_step,
+    reject_answer,
+    restart_conversation,
+)
+from utils.db import make_engine
+from utils.db_async import (
+    dispose_async_engines,
+    make_async_engine,
 )
+from utils.enrollment import enroll
+from utils.export import (
+    EXPORT_MEDIA_TYPES,
+    ResponseExport,
+)
+from utils.journal import MESSAGE_JOURNAL
 from utils.logging import LOGGER
-from utils.orm import (
-    Iteration,
-    Message,
-    Response,
+from utils.metrics import (
+    AWAITING_STORE_SIZE,
+    DUPLICATE_REPLIES,
+    INVALID_ANSWERS,
+    JOURNAL_DROPPED_MESSAGES,
+    REPLIES,
+    RESTARTS,
+    STARTUP_SECONDS,
+    render_metrics,
+    time_stage,
+)
+from utils.profiling import (
+    PROFILE_ENABLED,
+    should_profile,
+    start_profile,
+    stop_profile,
+)
+from utils.state import (
+    LRUAwaitingStore,
+    NotifyListener,
+    PhoneNumberLocks,
+    PostgresNotifyListener,
+)
+from utils.stats import (
+    fetch_instrument_stats,
+    fetch_iteration_stats,
 )
 
-with open("/run/secrets/cpsms_webhook_token", "r") as f:
-    CPSMS_WEBHOOK_TOKEN: str = f.readline()
+# Paths that don't need the webhook token
+OPEN_PATHS: tuple = ("/health", "/ready", "/metrics")
+# Paths that need the admin token instead, in an Authorization header: the
+# webhook token is shared with the gateway, travels in query strings and is
+# archived with the requests
+ADMIN_PATHS: tuple = ("/export", "/enrollments")
+
+# Which response each phone number is awaiting, kept coherent across workers
+# through notifications from the database (once the app has started)
+awaiting_responses = LRUAwaitingStore()
+AWAITING_STORE_SIZE.set_function(lambda: len(awaiting_responses))
+JOURNAL_DROPPED_MESSAGES.set_function(lambda: MESSAGE_JOURNAL.writer.n_dropped)
+
+# Item texts, by item_id, kept current the same way
+catalog = InstrumentCatalog()
+
+# Each respondent's replies are handled one at a time in this process, without
+# holding a database connection while waiting. Across processes, the steps
+# take the phone number's advisory lock
+phone_number_locks = PhoneNumberLocks()
+
+
+async def record_startup(listeners: list[NotifyListener], started: float):
+    for listener in listeners:
+        await listener.warmed.wait()
+    seconds = time.perf_counter() - started
+    STARTUP_SECONDS.set(seconds)
+    LOGGER.info(f"Ready after {seconds:.2f} seconds")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Connect and warm caches in the background, so the app serves requests
+    (through the database) right away, and reports ready once warmed up
+    """
+
+    started = time.perf_counter()
+    engine = make_async_engine()
+    listeners = [
+        PostgresNotifyListener(
+            awaiting_responses,
+            warm=partial(fetch_awaiting_responses, engine),
+        ),
+        CatalogListener(catalog, engine),
+    ]
+    app.state.listeners = listeners
+    for listener in listeners:
+        listener.start()
+    startup = asyncio.create_task(record_startup(listeners, started))
+
+    yield
+
+    startup.cancel()
+    for listener in listeners:
+        await listener.stop()
+    await dispose_async_engines()
+    REQUEST_ARCHIVE.stop()
+    MESSAGE_JOURNAL.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+async def profile_middleware(request: Request, call_next):
+    """
+    Profile requests asking for it, or a sample of them; only registered with
+    PROFILE_ENABLED, and inside the token check
+    """
+
+    is_open = request.url.path in OPEN_PATHS
+    if is_open or not should_profile(request.query_params):
+        return await call_next(request)
+
+    profile, token = start_profile(request.url.path)
+    try:
+        response = await call_next(request)
+    finally:
+        stop_profile(token)
+
+    try:
+        await asyncio.to_thread(profile.write)
+        response.headers["X-Profile-Id"] = profile.profile_id
+    except OSError as e:
+        LOGGER.error(f"Could not write profile {profile.profile_id}: {e!r}")
+    return response
 
-# TODO: should probably use environment variable,
-# perhaps even defining once without Depends()
-awaiting_responses = fetch_awaiting_responses(make_engine())
 
-app = FastAPI()
+# Added first, so it runs after (i.e. within) the token check
+if PROFILE_ENABLED:
+    app.middleware("http")(profile_middleware)
 
 
 @app.middleware("http")
 async def validate_token_middleware(request: Request, call_next):
-    token = request.query_params.get("token")
-
-    if token != CPSMS_WEBHOOK_TOKEN and request.url.path != "/health":
+    with time_stage("validate_token"):
+        path = request.url.path
+        if path in OPEN_PATHS:
+            is_valid = True
+        elif path in ADMIN_PATHS:
+            is_valid = is_admin(request.headers.get("Authorization"))
+        else:
+            token = request.query_params.get("token")
+            is_valid = token == read_secret("cpsms_webhook_token")
+
+    if not is_valid:
         return JSONResponse(
             status_code=403, content={"details": "Invalid token"}
         )
@@ -64,16 +200,113 @@ def health() -> JSONResponse:
     return {"status": "Service is healthy"}
 
 
+@app.get("/ready", response_class=JSONResponse)
+def ready(request: Request) -> JSONResponse:
+    listeners = getattr(request.app.state, "listeners", [])
+    if not listeners or not all(lst.warmed.is_set() for lst in listeners):
+        return JSONResponse(
+            status_code=503, content={"status": "Service is warming up"}
+        )
+    return {"status": "Service is ready"}
+
+
+@app.get("/metrics")
+def metrics() -> Response:
+    content, media_type = render_metrics()
+    return Response(content=content, media_type=media_type)
+
+
+@app.get("/export")
+def export_responses(
+    instrument_id: int,
+    format: str = "csv",
+    since: datetime = None,
+    engine: Engine = Depends(make_engine),
+) -> Response:
+    """
+    Stream the answers to an instrument in wide format. X-Export-Watermark is
+    what to pass as since next time, to only get what changed in between.
+    """
+
+    try:
+        export = ResponseExport(engine, instrument_id, format, since)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"details": str(e)})
+    except RuntimeError as e:
+        return JSONResponse(status_code=501, content={"details": str(e)})
+
+    # The first chunk is written here, so that a failing export fails with an
+    # error response, and the watermark (taken first) can go in a header
+    chunks = export.stream()
+    first_chunk = next(chunks)
+    headers = {
+        "X-Export-Watermark": export.watermark.isoformat(),
+        "Content-Disposition": (
+            f'attachment; filename="instrument_{instrument_id}.{format}"'
+        ),
+    }
+    return StreamingResponse(
+        chain([first_chunk], chunks),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers=headers,
+    )
+
+
+@app.post("/enrollments", response_class=JSONResponse)
+def enroll_recipients(
+    file: UploadFile,
+    format: str = "csv",
+    engine: Engine = Depends(make_engine),
+) -> JSONResponse:
+    """
+    Enroll recipients and schedule their iterations from a CSV or JSONL file.
+    Rows that can't be enrolled are listed in the report.
+    """
+
+    try:
+        report = enroll(engine, file.file, format)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"details": str(e)})
+
+    return report.to_json()
+
+
+@app.get("/stats/instruments/{instrument_id}", response_class=JSONResponse)
+async def instrument_stats(
+    instrument_id: int, engine: AsyncEngine = Depends(make_async_engine)
+) -> JSONResponse:
+    """
+    Opened iterations of an instrument by state, and their median time to
+    finish. Read from aggregates kept up to date as responses change, so this
+    costs the same however large the study.
+    """
+
+    return await fetch_instrument_stats(engine, instrument_id)
+
+
+@app.get("/stats/iterations/{iteration_id}", response_class=JSONResponse)
+async def iteration_stats(
+    iteration_id: int, engine: AsyncEngine = Depends(make_async_engine)
+) -> JSONResponse:
+    stats = await fetch_iteration_stats(engine, iteration_id)
+    if stats is None:
+        return JSONResponse(
+            status_code=404, content={"details": "Iteration not opened"}
+        )
+    return stats
+
+
 @app.get("/aquaicu", response_class=XmlResponse)
 async def sms_response(
-    request: Request, engine: Engine = Depends(make_engine)
+    request: Request, engine: AsyncEngine = Depends(make_async_engine)
 ) -> XmlResponse:
 
     data = request.query_params
     phone_number = data.get("from", None)
     inbound_body = data.get("message", None)
 
-    await dump_request(request, "request")
+    with time_stage("dump_request"):
+        await dump_request(request)
 
     if not phone_number:
         LOGGER.critical(
@@ -82,140 +315,59 @@ async def sms_response(
         )
         return to_xml_response("Houston, we have a problem")
 
-    # TODO: make sessions async
-
-    with make_session(engine) as session:
-        new_message = Message(
-            phone_number=phone_number,
-            message_body=inbound_body,
-            direction="inbound",
+    # Retries by the gateway get the reply sent before, from prod.sent_replies
+    reply_key = idempotency_key(data)
+    async with phone_number_locks.hold(phone_number):
+        reply = await handle_reply(
+            engine, phone_number, inbound_body, reply_key
         )
-        session.add(new_message)
+    return reply
 
-    # TODO: remove later, this is to allow to start over interactively
-    if inbound_body == "Restart":
-        awaiting_responses.pop(phone_number, None)
-
-        # TODO: remove later, this is to allow to start over interactively
-        if inbound_body == "Restart":
-            awaiting_responses.pop(phone_number, None)
-
-            with make_session(engine) as session:
-                stmt = (
-                    update(Iteration)
-                    .where(Iteration.phone_number == phone_number)
-                    .values(is_open=False, updated_by="fastapi")
-                )
-                session.execute(stmt)
-
-                stmt = (
-                    update(Response)
-                    .where(
-                        Response.phone_number == phone_number,
-                    )
-                    .values(status="open", response=None, updated_by="fastapi")
-                )
-                session.execute(stmt)
-
-        with make_session(engine) as session:
-            stmt = (
-                select(Iteration)
-                .where(
-                    and_(
-                        Iteration.phone_number == phone_number,
-                        Iteration.is_open,
-                    )
-                )
-                .order_by(Iteration.iteration_id.desc())
-            )
-            outbound_body = session.scalars(stmt).first()
 
-            new_message = Message(
-                phone_number=phone_number,
-                message_body=outbound_body,
-                direction="outbound",
-            )
-            session.add(new_message)
+async def handle_reply(
+    engine: AsyncEngine,
+    phone_number: str,
+    inbound_body: str,
+    reply_key: str = None,
+) -> str:
+    """Move the conversation forward and render the reply to send back"""
 
-        return to_xml_response(outbound_body)
-
-    with make_session(engine) as session:
-        stmt = select(func.count(Response.response_id)).where(
-            and_(
-                Response.phone_number == phone_number,
-                Response.status == "awaiting",
-            )
-        )
-        n_responses_waiting_for_user = session.scalar(stmt)
-
-    parsed_response = parse_response(inbound_body)
-
-    if n_responses_waiting_for_user == 0:
-        awaiting_responses.pop(phone_number, None)
-    elif parsed_response:
-        stmt = (
-            update(Response)
-            .where(
-                and_(
-                    Response.response_id == awaiting_responses[phone_number],
-                    Response.phone_number == phone_number,
-                    Response.status == "awaiting",
-                )
-            )
-            .values(
-                response=parsed_response, status="closed", updated_by="fastapi"
-            )
-        )
-        with make_session(engine) as session:
-            session.execute(stmt)
+    REPLIES.inc()
+    with time_stage("parse_response"):
+        parsed_response = parse_response(inbound_body)
+    awaiting_response_id = awaiting_responses.get(phone_number)
 
+    # TODO: remove later, this is to allow to start over interactively
+    if inbound_body == "Restart":
+        RESTARTS.inc()
+        with time_stage("restart_conversation"):
+            step = await restart_conversation(engine, phone_number, reply_key)
+    elif parsed_response is None and awaiting_response_id:
+        step = await reject_answer(engine, awaiting_response_id, reply_key)
     else:
-        outbound_body = "Husk svare med blot èt heltal fra listen ovenfor."
-
-        with make_session(engine) as session:
-            new_message = Message(
-                phone_number=phone_number,
-                message_body=outbound_body,
-                direction="outbound",
+        with time_stage("conversation_step"):
+            step = await conversation_step(
+                engine, phone_number, parsed_response, catalog, reply_key
             )
-            session.add(new_message)
-
-        return to_xml_response(outbound_body)
 
-    item = fetch_next_item(engine, phone_number)
+    if step.is_duplicate:
+        DUPLICATE_REPLIES.inc()
+        with time_stage("to_xml_response"):
+            return to_xml_response(step.outbound_body)
 
-    if item:
-        awaiting_responses[phone_number] = item.response_id
-        outbound_body = item.item_text
+    MESSAGE_JOURNAL.record(phone_number, inbound_body, "inbound")
+    MESSAGE_JOURNAL.record(phone_number, step.outbound_body, "outbound")
 
-        stmt = (
-            update(Response)
-            .where(Response.response_id == item.response_id)
-            .values(status="awaiting", updated_by="fastapi")
-        )
-        with make_session(engine) as session:
-            session.execute(stmt)
+    if step.outbound_body == INVALID_ANSWER_TEXT:
+        INVALID_ANSWERS.inc()
 
+    if step.awaiting_response_id:
+        awaiting_responses.set(phone_number, step.awaiting_response_id)
     else:
-        # TODO: consider to mention we'll be in touch again
-        error_code = hashlib.sha256(f"{time.time()}".encode("utf-8"))
-        error_code = error_code.hexdigest()[:7]
-        outbound_body = inspect.cleandoc(
-            """\
-            Der ser ikke ud til at være nogle åbne spørgsmål til dig.
-            Svar 'Restart' for at starte forfra.\
-            """
-        )
-
-    with make_session(engine) as session:
-        new_message = Message(
-            phone_number=phone_number,
-            message_body=outbound_body,
-            direction="outbound",
-        )
-        session.add(new_message)
+        awaiting_responses.invalidate(phone_number)
 
-    return to_xml_response(outbound_body)
+    with time_stage("to_xml_response"):
+        return to_xml_response(step.outbound_body)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,28 @@
+import time
+
+from sqlalchemy.engine import Engine
+from utils.db import make_engine
+from utils.logging import LOGGER
+from utils.partitions import (
+    PARTITION_MAINTENANCE_SECONDS,
+    maintain_partitions,
+)
+from utils.replies import purge_sent_replies
+
+if __name__ == "__main__":
+    LOGGER.info("Starting the maintenance app")
+    engine: Engine = make_engine()
+
+    while True:
+        try:
+            maintain_partitions(engine)
+        except Exception as e:
+            error_msg: str = getattr(e, "message", repr(e))
+            LOGGER.error(f"Partition maintenance fails: {error_msg}")
+
+        try:
+            purge_sent_replies(engine)
+        except Exception as e:
+            LOGGER.error(f"Purging sent replies fails: {e!r}")
+
+        time.sleep(PARTITION_MAINTENANCE_SECONDS)
@@ -1,95 +1,87 @@
-import logging
 import time
+from functools import partial
 
-import requests
+from prometheus_client import start_http_server
 from sqlalchemy import update
 from sqlalchemy.engine import Engine
+from sqlalchemy.orm.session import Session as SQLAlchemySession
+from utils.catalog import InstrumentCatalog
+from utils.config import read_secret
 from utils.db import (
     make_engine,
-    make_session,
+    pool_stats,
 )
 from utils.logging import LOGGER
-from utils.orm import Iteration
-from utils.sms import (
-    document_sms,
-    send_sms,
+from utils.metrics import (
+    STARTER_METRICS_PORT,
+    time_stage,
 )
-from utils.starter import (
-    add_item_to_responses,
-    fetch_items,
-    fetch_iterations_to_open,
+from utils.orm import Iteration
+from utils.outbox import (
+    OutboxSender,
+    enqueue,
 )
-
-with open("/run/secrets/cpsms_api_token", "r") as f:
-    CPSMS_API_TOKEN: str = f.readline()
+from utils.reminders import ReminderEngine
+from utils.scheduler import IterationScheduler
+from utils.sms import SmsDispatcher
+from utils.starter import prefill_responses
 
 
-def main(engine: Engine):
-    LOGGER.info("Connected to db and ready to process user request")
-    iterations = fetch_iterations_to_open(engine)
+def open_iterations(
+    session: SQLAlchemySession,
+    iterations: list[Iteration],
+    catalog: InstrumentCatalog,
+) -> None:
+    """
+    Mark the (claimed) iterations as open and queue their invitations, in the
+    claiming transaction, so recipients are invited if and only if it commits.
+    Sending is left to the OutboxSender, so no iteration fails here.
+    """
 
-    for iter in iterations:
-        items = fetch_items(engine=engine, instrument_id=iter.instrument_id)
+    with time_stage("prefill_responses"):
+        prefill_responses(session, iterations, catalog)
 
-        for item in items:
-            add_item_to_responses(
-                engine=engine,
-                phone_number=iter.phone_number,
-                item_text=item.item_text,
-                item_id=item.item_id,
-            )
-
-        add_item_to_responses(
-            engine=engine,
-            phone_number=iter.phone_number,
-            item_text="Tak for din hjælp!",
-            item_id=None,
-        )
+    # One statement each for the whole batch
+    iteration_ids = [iter.iteration_id for iter in iterations]
+    stmt = (
+        update(Iteration)
+        .where(Iteration.iteration_id.in_(iteration_ids))
+        .values(is_open=True, updated_by="starter")
+    )
+    session.execute(stmt)
 
-        message = send_sms(
-            to=iter.phone_number,
-            message=iter.message_body,
-            token=CPSMS_API_TOKEN,
-            logger=LOGGER,
+    with time_stage("queue_invitations"):
+        enqueue(
+            session,
+            ((iter.phone_number, iter.message_body) for iter in iterations),
         )
-
-        if message.status_code == requests.codes.ok:
-            stmt = (
-                update(Iteration)
-                .where(Iteration.iteration_id == iter.iteration_id)
-                .values(is_open=True, updated_by="starter")
-            )
-            with make_session(engine) as session:
-                session.execute(stmt)
-        else:
-            logging.error(
-                f"Could not invite {iter.phone_number} to new around. "
-                + "Iteration_id: {iter.iteration_id}"
-            )
-
-        document_sms(
-            engine=engine,
-            phone_number=iter.phone_number,
-            message_body=iter.message_body,
-            direction="outbound",
-        )
-
-        LOGGER.info(f"{iter.phone_number} invited to new round.)")
-    else:
-        LOGGER.info("No pending iterations")
+    LOGGER.info(f"{len(iterations)} recipients invited to a new round.")
 
 
 if __name__ == "__main__":
     LOGGER.info("Starting the starter app")
+    start_http_server(STARTER_METRICS_PORT)
+    engine: Engine = make_engine()
+    dispatcher = SmsDispatcher(
+        token=read_secret("cpsms_api_token"), logger=LOGGER
+    )
+    catalog = InstrumentCatalog(engine)
+    OutboxSender(engine, dispatcher).start()
+    ReminderEngine(engine, catalog).start()
+    scheduler = IterationScheduler(
+        engine,
+        partial(open_iterations, catalog=catalog),
+        catalog=catalog,
+    )
 
     while True:
         try:
-            engine: Engine = make_engine()
-            main(engine)
+            LOGGER.info("Connected to db and ready to process user request")
+            scheduler.run_forever()
         except Exception as e:
             error_msg: str = getattr(e, "message", repr(e))
-            LOGGER.fatal(f"main() fails. Error message: {error_msg}")
+            LOGGER.fatal(f"Scheduler fails. Error message: {error_msg}")
+            LOGGER.info(f"Connection pool: {pool_stats(engine)}")
             # TODO: send to pushover or similar
 
-        SECONDS_PER_HOUR = 60 * 60
-        time.sleep(SECONDS_PER_HOUR / 2)
+        time.sleep(scheduler.reconnect_seconds)
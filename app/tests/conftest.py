@@ -0,0 +1,152 @@
+"""
+Fixtures shared by the tests. Tests needing the database get one of their own
+per pytest-xdist worker (or one for the whole run without xdist), cloned from
+TEST_DB_TEMPLATE on the test server, i.e. an initialised database that
+nothing else is connected to. Run from /app, in parallel, with
+
+    pytest -n auto
+
+The test server is configured with TEST_DB_HOST, TEST_DB_PORT, TEST_DB_USER
+and TEST_DB_PASSWORD (see utils/db.py). Tests using the database are skipped
+if it can't be reached.
+"""
+
+import os
+import tempfile
+
+# Set before the app's modules read them on import; no secrets needed
+os.environ.setdefault("CPSMS_WEBHOOK_TOKEN", "test-webhook-token")
+os.environ.setdefault("CPSMS_API_TOKEN", "test-api-token")
+os.environ.setdefault("PROCUS_ADMIN_TOKEN", "test-admin-token")
+os.environ.setdefault("POSTGRES_PASSWORD", "postgres")  # as test-db's
+os.environ.setdefault("MESSAGE_JOURNAL_SPILL_PATH", "")
+os.environ.setdefault("MESSAGE_JOURNAL_QUARANTINE_PATH", "")
+os.environ.setdefault("REQUEST_ARCHIVE_DIR", tempfile.mkdtemp())
+# Waiting for a lock held by another connection of the same test fails the
+# test rather than hanging it (for libpq-based drivers)
+os.environ.setdefault("PGOPTIONS", "-c lock_timeout=10s")
+
+import pytest  # noqa: E402
+from app_fastapi import app  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlalchemy import (  # noqa: E402
+    create_engine,
+    text,
+)
+from sqlalchemy.engine import URL  # noqa: E402
+from sqlalchemy.exc import OperationalError  # noqa: E402
+from sqlalchemy.pool import NullPool  # noqa: E402
+from tests.fake_cpsms import FakeCpsms  # noqa: E402
+from utils.db import (  # noqa: E402
+    DB_CONN_PARAMS,
+    DB_CONN_PARAMS_TEST,
+    connection_details,
+    dispose_engines,
+    make_engine,
+)
+from utils.sms import SmsDispatcher  # noqa: E402
+
+TEST_DB_TEMPLATE: str = os.getenv(
+    "TEST_DB_TEMPLATE", DB_CONN_PARAMS_TEST["dbname"]
+)
+# Where CREATE/DROP DATABASE are run from; not the template
+TEST_DB_ADMIN_NAME: str = os.getenv("TEST_DB_ADMIN_NAME", "template1")
+
+
+def make_admin_engine():
+    cnxn = connection_details(
+        dict(DB_CONN_PARAMS_TEST, dbname=TEST_DB_ADMIN_NAME)
+    )
+    url = URL.create(
+        f"{cnxn.dbms}+psycopg2",
+        username=cnxn.user,
+        password=cnxn.password,
+        host=cnxn.host,
+        port=cnxn.port,
+        database=cnxn.dbname,
+    )
+    return create_engine(
+        url, isolation_level="AUTOCOMMIT", poolclass=NullPool
+    )
+
+
+@pytest.fixture(scope="session")
+def database():
+    """
+    The name of this worker's database, which make_engine(),
+    make_engine_test() and their async siblings connect to from now on
+    """
+
+    name = f"procus_test_{os.getenv('PYTEST_XDIST_WORKER', 'main')}"
+    try:
+        admin = make_admin_engine()
+        with admin.connect() as connection:
+            # One copy at a time: CREATE DATABASE fails while the template is
+            # in use
+            connection.execute(text("SELECT pg_advisory_lock(20250101)"))
+            connection.execute(
+                text(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)')
+            )
+            connection.execute(
+                text(f'CREATE DATABASE "{name}" TEMPLATE "{TEST_DB_TEMPLATE}"')
+            )
+            connection.execute(text("SELECT pg_advisory_unlock(20250101)"))
+    except (OperationalError, OSError) as e:
+        pytest.skip(f"Test database not available: {e!r}")
+
+    original = dict(DB_CONN_PARAMS), dict(DB_CONN_PARAMS_TEST)
+    DB_CONN_PARAMS.clear()
+    DB_CONN_PARAMS.update(DB_CONN_PARAMS_TEST, dbname=name)
+    DB_CONN_PARAMS_TEST.update(dbname=name)
+
+    yield name
+
+    dispose_engines()
+    DB_CONN_PARAMS.clear()
+    DB_CONN_PARAMS.update(original[0])
+    DB_CONN_PARAMS_TEST.clear()
+    DB_CONN_PARAMS_TEST.update(original[1])
+    with admin.connect() as connection:
+        connection.execute(
+            text(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)')
+        )
+
+
+@pytest.fixture(scope="session")
+def engine(database):
+    return make_engine()
+
+
+@pytest.fixture
+def connection(engine):
+    """
+    A connection in a transaction that is rolled back after the test. Pass it
+    to make_session() instead of an engine; sessions join its transaction
+    rather than committing.
+    """
+
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        yield connection
+        transaction.rollback()
+
+
+@pytest.fixture
+def fake_cpsms():
+    with FakeCpsms() as fake:
+        yield fake
+
+
+@pytest.fixture
+def dispatcher(fake_cpsms):
+    dispatcher = SmsDispatcher(token="test", url=fake_cpsms.url)
+    yield dispatcher
+    dispatcher.close()
+
+
+@pytest.fixture(scope="session")
+def client(database):
+    """The webhook in-process, started up against this worker's database"""
+
+    with TestClient(app) as client:
+        yield client
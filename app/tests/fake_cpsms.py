@@ -0,0 +1,158 @@
+"""
+A local stand-in for the CPSMS send API (https://api.cpsms.dk/v2/send), for
+testing throughput and failure handling offline. Run it on its own with
+
+    python tests/fake_cpsms.py --port 8025 --failure-rate 0.05
+
+and point the starter at it with CPSMS_API_URL=http://localhost:8025/v2/send
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer,
+)
+
+
+class FakeCpsms:
+    """
+    Accepts POSTs to /v2/send and records their payloads in sent. A share
+    of requests (failure_rate) gets failure_status instead, and every
+    request takes latency_seconds to answer. Recipients in rejected_numbers
+    get an error entry in an otherwise successful reply. With
+    drop_connections, requests are handled but the connection is closed
+    instead of replying, as when a reply is lost on the way.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency_seconds: float = 0.0,
+        failure_rate: float = 0.0,
+        failure_status: int = 503,
+        seed: int = None,
+        rejected_numbers: tuple = (),
+        drop_connections: bool = False,
+    ):
+        self.latency_seconds = latency_seconds
+        self.rejected_numbers = set(rejected_numbers)
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.drop_connections = drop_connections
+        self.sent: list = []
+        self.n_requests = 0
+        self.n_failed = 0
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v2/send"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like the real thing
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                time.sleep(fake.latency_seconds)
+
+                with fake._lock:
+                    fake.n_requests += 1
+                    failed = fake._random.random() < fake.failure_rate
+                    if failed:
+                        fake.n_failed += 1
+                    elif self.path == "/v2/send":
+                        fake.sent.append(json.loads(body))
+
+                if fake.drop_connections:
+                    self.close_connection = True
+                    return
+
+                if self.path != "/v2/send":
+                    status, reply = 404, {"error": {"code": 404}}
+                elif failed:
+                    status = fake.failure_status
+                    reply = {"error": {"code": status, "message": "Fake"}}
+                else:
+                    status, reply = 200, fake._reply(json.loads(body))
+
+                data = json.dumps(reply).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def _reply(self, payload: dict) -> dict:
+        """One entry per recipient, as "to" may be a list of them"""
+
+        recipients = payload["to"]
+        if not isinstance(recipients, list):
+            recipients = [recipients]
+        reply = {"success": [], "error": []}
+        for to in recipients:
+            if to in self.rejected_numbers:
+                error = {"to": to, "code": 400, "message": "Invalid number"}
+                reply["error"].append(error)
+            else:
+                reply["success"].append({"to": to, "cost": 1})
+        if not reply["error"]:
+            del reply["error"]
+        return reply
+
+    def start(self) -> "FakeCpsms":
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeCpsms":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8025)
+    parser.add_argument("--latency-seconds", type=float, default=0.05)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--failure-status", type=int, default=503)
+    args = parser.parse_args()
+
+    fake = FakeCpsms(
+        host=args.host,
+        port=args.port,
+        latency_seconds=args.latency_seconds,
+        failure_rate=args.failure_rate,
+        failure_status=args.failure_status,
+    )
+    print(f"Fake CPSMS listening on {fake.url}")
+    try:
+        fake._server.serve_forever()
+    except KeyboardInterrupt:
+        fake._server.server_close()
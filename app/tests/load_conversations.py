@@ -0,0 +1,300 @@
+"""
+Load test for the webhook: creates synthetic recipients, invites them through
+the starter (against a fake CPSMS) and drives each of them through a whole
+EQ-5D-5L conversation against /aquaicu, many respondents at once. Reports
+throughput, latency percentiles per conversation step and database round
+trips per request. Run it from /app, against the test database, with
+
+    python -m tests.load_conversations --respondents 1000 --concurrency 100
+
+The webhook runs in-process (through httpx' ASGI transport), so round trips
+can be counted on the engine. Its startup isn't run, i.e. the awaiting-state
+store is only filled by the requests themselves.
+"""
+
+import argparse
+import asyncio
+import contextvars
+import json
+import math
+import time
+from collections import defaultdict
+from datetime import (
+    datetime,
+    timezone,
+)
+
+import httpx
+from app_fastapi import app
+from app_starter import open_iterations
+from sqlalchemy import (
+    delete,
+    event,
+    func,
+    insert,
+    select,
+)
+from sqlalchemy.engine import Engine
+from tests.fake_cpsms import FakeCpsms
+from utils.archive import REQUEST_ARCHIVE
+from utils.catalog import InstrumentCatalog
+from utils.config import read_secret
+from utils.db import (
+    make_engine,
+    make_engine_test,
+    make_session,
+    pool_stats,
+)
+from utils.db_async import (
+    dispose_async_engines,
+    make_async_engine,
+    make_async_engine_test,
+)
+from utils.orm import (
+    Instrument,
+    Iteration,
+    Message,
+    Outbox,
+    Recipient,
+    Response,
+)
+from utils.outbox import OutboxSender
+from utils.sms import SmsDispatcher
+from utils.starter import claim_iterations_to_open
+
+PHONE_PREFIX: str = "97"
+INSTRUMENT_NAME: str = "EQ-5D-5L"
+N_ITEMS: int = 5
+
+# (step, inbound message), in the order a respondent sends them
+CONVERSATION: list = (
+    [("start", "Ja"), ("invalid", "syv")]
+    + [("answer", str(1 + i % 5)) for i in range(N_ITEMS)]
+    + [("restart", "Restart"), ("start", "Ja")]
+    + [("answer", str(5 - i % 5)) for i in range(N_ITEMS)]
+    + [("close", "1"), ("empty", "Hej")]
+)
+
+# Round trips of the request being handled; a mutable holder, because the
+# context is copied into the tasks and greenlets serving the request
+_round_trips = contextvars.ContextVar("round_trips", default=None)
+
+
+def count_round_trips(engine: Engine) -> None:
+    """Count statements and transaction control sent through engine"""
+
+    def count(*args, **kwargs):
+        counter = _round_trips.get()
+        if counter is not None:
+            counter[0] += 1
+
+    event.listen(engine, "before_cursor_execute", count)
+    for name in ("begin", "commit", "rollback"):
+        event.listen(engine, name, count)
+
+
+def percentile(values: list, p: float) -> float:
+    """Nearest-rank percentile"""
+
+    ordered = sorted(values)
+    rank = max(math.ceil(p / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def phone_numbers(n: int) -> list[str]:
+    return [f"{PHONE_PREFIX}{i:08}" for i in range(n)]
+
+
+def remove_respondents(engine: Engine) -> None:
+    phone_number_like = f"{PHONE_PREFIX}%"
+    with make_session(engine) as session:
+        for table in (Message, Outbox, Response, Iteration, Recipient):
+            session.execute(
+                delete(table).where(table.phone_number.like(phone_number_like))
+            )
+
+
+def create_respondents(engine: Engine, n: int) -> None:
+    """Recipients with one iteration each, due now but not yet open"""
+
+    with make_session(engine) as session:
+        instrument_id = session.scalar(
+            select(Instrument.instrument_id).where(
+                Instrument.instrument_name == INSTRUMENT_NAME
+            )
+        )
+        recipients = [
+            dict(phone_number=phone_number, full_name="Load Test")
+            for phone_number in phone_numbers(n)
+        ]
+        session.execute(insert(Recipient), recipients)
+
+        now = datetime.now(timezone.utc)
+        iterations = [
+            dict(
+                instrument_id=instrument_id,
+                phone_number=recipient["phone_number"],
+                message_body="Er du klar til en ny runde? Svar Ja.",
+                is_open=False,
+                opens_datetime=now,
+            )
+            for recipient in recipients
+        ]
+        session.execute(insert(Iteration), iterations)
+
+
+def invite_respondents(engine: Engine, url: str, batch_size: int) -> int:
+    """
+    Open the iterations and send the invitations like the starter does;
+    returns the number of invitations not sent
+    """
+
+    dispatcher = SmsDispatcher(token="load-test", url=url)
+    catalog = InstrumentCatalog(engine)
+    stmt = select(Iteration.iteration_id).where(
+        Iteration.phone_number.like(f"{PHONE_PREFIX}%")
+    )
+    with make_session(engine) as session:
+        iteration_ids = list(session.scalars(stmt))
+
+    for start in range(0, len(iteration_ids), batch_size):
+        batch = iteration_ids[start:][:batch_size]
+        with make_session(engine) as session:
+            claimed = claim_iterations_to_open(session, batch)
+            open_iterations(session, claimed, catalog)
+
+    OutboxSender(engine, dispatcher, batch_size=batch_size).drain()
+    dispatcher.close()
+    with make_session(engine) as session:
+        return session.scalar(
+            select(func.count()).where(
+                Outbox.phone_number.like(f"{PHONE_PREFIX}%")
+            )
+        )
+
+
+async def converse(
+    client: httpx.AsyncClient, phone_number: str, timings: dict
+) -> None:
+    for step, message in CONVERSATION:
+        counter = [0]
+        token = _round_trips.set(counter)
+        start = time.perf_counter()
+        response = await client.get(
+            "/aquaicu",
+            params={
+                "token": read_secret("cpsms_webhook_token"),
+                "from": phone_number,
+                "message": message,
+            },
+        )
+        elapsed = time.perf_counter() - start
+        _round_trips.reset(token)
+
+        response.raise_for_status()
+        timings[step].append((elapsed, counter[0]))
+
+
+async def drive_conversations(n: int, concurrency: int) -> dict:
+    timings: dict = defaultdict(list)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def respondent(client, phone_number):
+        async with semaphore:
+            await converse(client, phone_number, timings)
+
+    async with httpx.AsyncClient(
+        app=app, base_url="http://procus", timeout=None
+    ) as client:
+        respondents = [respondent(client, p) for p in phone_numbers(n)]
+        await asyncio.gather(*respondents)
+    return timings
+
+
+def summarise(timings: dict, seconds: float) -> dict:
+    steps = {}
+    for step, samples in timings.items():
+        latencies = [elapsed * 1000 for elapsed, _ in samples]
+        steps[step] = {
+            "n": len(samples),
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "round_trips": sum(n for _, n in samples) / len(samples),
+        }
+
+    n_requests = sum(step["n"] for step in steps.values())
+    return {
+        "seconds": seconds,
+        "requests_per_second": n_requests / seconds,
+        "steps": steps,
+    }
+
+
+def print_summary(summary: dict) -> None:
+    print(f"{'step':<10}{'n':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'trips':>8}")
+    for step, s in summary["steps"].items():
+        print(
+            f"{step:<10}{s['n']:>8}{s['p50_ms']:>10.1f}{s['p95_ms']:>10.1f}"
+            + f"{s['p99_ms']:>10.1f}{s['round_trips']:>8.1f}"
+        )
+    print(
+        f"{summary['requests_per_second']:.0f} requests/s "
+        + f"({summary['conversations_per_second']:.1f} conversations/s), "
+        + f"{summary['invitations_per_second']:.0f} invitations/s"
+    )
+
+
+async def main(args) -> dict:
+    engine = make_engine_test()
+    app.dependency_overrides[make_engine] = make_engine_test
+    app.dependency_overrides[make_async_engine] = make_async_engine_test
+    count_round_trips(make_async_engine_test().sync_engine)
+
+    remove_respondents(engine)
+    create_respondents(engine, args.respondents)
+
+    with FakeCpsms(latency_seconds=args.sms_latency_seconds) as fake:
+        start = time.perf_counter()
+        n_failed = invite_respondents(engine, fake.url, args.batch_size)
+        invite_seconds = time.perf_counter() - start
+    if n_failed:
+        print(f"{n_failed} invitations failed")
+
+    start = time.perf_counter()
+    timings = await drive_conversations(args.respondents, args.concurrency)
+    summary = summarise(timings, time.perf_counter() - start)
+    summary.update(
+        respondents=args.respondents,
+        concurrency=args.concurrency,
+        conversations_per_second=args.respondents / summary["seconds"],
+        invitations_per_second=args.respondents / invite_seconds,
+        pool=pool_stats(make_async_engine_test().sync_engine),
+    )
+
+    await dispose_async_engines()
+    REQUEST_ARCHIVE.stop()
+    if not args.keep:
+        remove_respondents(engine)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--respondents", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--sms-latency-seconds", type=float, default=0.0)
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument(
+        "--keep", action="store_true", help="Keep the synthetic respondents"
+    )
+    args = parser.parse_args()
+
+    summary = asyncio.run(main(args))
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
@@ -0,0 +1,33 @@
+from utils.archive import RequestArchive
+
+
+def make_snapshot(phone_number: str, message: str) -> dict:
+    return {
+        "method": "GET",
+        "url_path": "/aquaicu",
+        "query_params": {"from": phone_number, "message": message},
+    }
+
+
+def test_requests_can_be_found_again(tmp_path):
+    archive = RequestArchive(directory=str(tmp_path), max_segment_bytes=200)
+    for i in range(10):
+        archive.submit(make_snapshot(f"450000000{i % 2}", str(i)))
+    archive.stop()
+
+    segments = [p for p in tmp_path.iterdir() if p.suffix == ".gz"]
+    assert len(segments) > 1
+
+    found = archive.find(phone_number="4500000001")
+    messages = [r["query_params"]["message"] for r in found]
+    assert messages == ["1", "3", "5", "7", "9"]
+
+
+def test_uncompressed_segments(tmp_path):
+    archive = RequestArchive(directory=str(tmp_path), compress=False)
+    archive.submit(make_snapshot("4500000000", "Restart"))
+    archive.stop()
+
+    (record,) = archive.find()
+    assert record["query_params"]["message"] == "Restart"
+    assert "received_at" in record
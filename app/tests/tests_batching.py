@@ -0,0 +1,67 @@
+import logging
+import threading
+from datetime import (
+    datetime,
+    timezone,
+)
+
+from utils.batching import BatchWriter
+from utils.logging import DatabaseLogHandler
+
+
+def test_flushes_in_batches_and_on_stop():
+    batches = []
+    writer = BatchWriter(batches.append, batch_size=3, flush_seconds=60)
+    for i in range(7):
+        writer.put(i)
+    writer.stop()
+
+    assert [item for batch in batches for item in batch] == list(range(7))
+    assert max(len(batch) for batch in batches) <= 3
+
+
+def test_drop_oldest_when_buffer_is_full():
+    started = threading.Event()
+    release = threading.Event()
+    flushed = []
+
+    def slow_flush(batch):
+        started.set()
+        release.wait()
+        flushed.extend(batch)
+
+    writer = BatchWriter(
+        slow_flush, batch_size=1, max_buffer_size=2, overflow="drop_oldest"
+    )
+    writer.put("first")  # picked up by the flush thread, which then waits
+    assert started.wait(10)
+    for item in ("a", "b", "c"):
+        writer.put(item)
+    release.set()
+    writer.stop()
+
+    assert writer.n_dropped == 1
+    assert flushed == ["first", "b", "c"]
+
+
+class ListLogHandler(DatabaseLogHandler):
+    def __init__(self):
+        self.batches = []
+        super(ListLogHandler, self).__init__(flush_seconds=60)
+
+    def insert_logs(self, logs: list) -> None:
+        self.batches.append(logs)
+
+
+def test_log_records_keep_the_time_they_were_logged():
+    handler = ListLogHandler()
+    record = logging.makeLogRecord(
+        dict(levelname="INFO", msg="hello", created=1700000000.0)
+    )
+    handler.emit(record)
+    handler.close()
+
+    logged_at = datetime(2023, 11, 14, 22, 13, 20, tzinfo=timezone.utc)
+    assert handler.batches == [
+        [dict(level="INFO", message="hello", created_at=logged_at)]
+    ]
@@ -0,0 +1,64 @@
+import asyncio
+from collections import namedtuple
+
+import pytest
+from utils.catalog import (
+    CLOSING_ITEM_TEXT,
+    InstrumentCatalog,
+    UnknownItemError,
+)
+
+Row = namedtuple("Row", ["instrument_id", "item_id", "item_text", "is_active"])
+
+
+def test_texts_are_kept_for_inactive_instruments():
+    catalog = InstrumentCatalog()
+    catalog._load(
+        [
+            Row(1, 1, "Hvor store problemer har du med at gå omkring?", True),
+            Row(1, 2, "Hvor store smerter/meget ubehag har du?", True),
+            Row(2, 3, "Udgået spørgsmål", False),
+        ]
+    )
+
+    assert catalog.version == 1
+    assert catalog.item_ids(1) == [1, 2, None]
+    assert catalog.item_ids(2) == [None]
+    assert catalog.item_text(3) == "Udgået spørgsmål"
+    assert catalog.item_text(None) == CLOSING_ITEM_TEXT
+
+
+class ItemTextSession:
+    """Stands in for a session in which the item's text is item_text"""
+
+    def __init__(self, item_text):
+        self.item_text = item_text
+
+    def scalar(self, stmt):
+        return self.item_text
+
+
+class AsyncItemTextConnection(ItemTextSession):
+    async def scalar(self, stmt):
+        return self.item_text
+
+
+def test_items_missing_from_the_catalog_are_read_from_the_database():
+    catalog = InstrumentCatalog()
+    catalog._load([Row(1, 1, "Hvor store smerter/meget ubehag har du?", True)])
+
+    with pytest.raises(UnknownItemError, match="Item 4"):
+        catalog.item_text(4)
+    session = ItemTextSession("Nyt spørgsmål")
+    assert catalog.read_item_text(session, 4) == "Nyt spørgsmål"
+    with pytest.raises(UnknownItemError, match="Item 4 doesn't exist"):
+        catalog.read_item_text(ItemTextSession(None), 4)
+
+
+def test_steps_read_missing_items_on_their_own_connection():
+    catalog = InstrumentCatalog()  # cold, as right after startup
+    connection = AsyncItemTextConnection("Nyt spørgsmål")
+
+    resolved = asyncio.run(catalog.resolve_item_text(connection, 4))
+    assert resolved == "Nyt spørgsmål"
+    assert not catalog.is_loaded  # reloading is left to CatalogListener
@@ -0,0 +1,186 @@
+"""
+Conversations end to end: the starter invites through the outbox and a fake
+CPSMS, and the webhook (in-process) takes the respondent through the items.
+Needs the test database (see conftest.py).
+"""
+
+from datetime import (
+    datetime,
+    timezone,
+)
+
+from app_starter import open_iterations
+from sqlalchemy import (
+    func,
+    insert,
+    select,
+)
+from utils.api import to_xml_response
+from utils.catalog import InstrumentCatalog
+from utils.config import read_secret
+from utils.conversation import (
+    INVALID_ANSWER_TEXT,
+    NO_OPEN_ITEMS_TEXT,
+)
+from utils.db import make_session
+from utils.orm import (
+    Instrument,
+    Iteration,
+    Message,
+    Outbox,
+    Recipient,
+    Response,
+)
+from utils.outbox import OutboxSender
+from utils.starter import claim_iterations_to_open
+
+INSTRUMENT_NAME: str = "EQ-5D-5L"
+INVITATION: str = "Er du klar til en ny runde? Svar Ja."
+
+
+def schedule_iteration(bind, phone_number: str) -> int:
+    """A recipient with one iteration, due now but not yet open"""
+
+    with make_session(bind) as session:
+        instrument_id = session.scalar(
+            select(Instrument.instrument_id).where(
+                Instrument.instrument_name == INSTRUMENT_NAME
+            )
+        )
+        session.execute(
+            insert(Recipient),
+            dict(phone_number=phone_number, full_name="Test McPytest"),
+        )
+        return session.scalar(
+            insert(Iteration)
+            .values(
+                instrument_id=instrument_id,
+                phone_number=phone_number,
+                message_body=INVITATION,
+                is_open=False,
+                opens_datetime=datetime.now(timezone.utc),
+            )
+            .returning(Iteration.iteration_id)
+        )
+
+
+def invite(bind, dispatcher, iteration_id: int) -> InstrumentCatalog:
+    catalog = InstrumentCatalog(bind)
+    with make_session(bind) as session:
+        claimed = claim_iterations_to_open(session, [iteration_id])
+        open_iterations(session, claimed, catalog)
+    OutboxSender(bind, dispatcher).drain()
+    return catalog
+
+
+def test_invitation_is_sent_once(connection, dispatcher, fake_cpsms):
+    iteration_id = schedule_iteration(connection, "9800000001")
+
+    invite(connection, dispatcher, iteration_id)
+    OutboxSender(connection, dispatcher).drain()
+
+    assert [(s["to"], s["message"]) for s in fake_cpsms.sent] == [
+        (["9800000001"], INVITATION)
+    ]
+    with make_session(connection) as session:
+        n_queued, n_sent = (
+            session.scalar(
+                select(func.count()).where(
+                    table.phone_number == "9800000001"
+                )
+            )
+            for table in (Outbox, Message)
+        )
+    assert (n_queued, n_sent) == (0, 1)
+
+
+def test_opening_with_pooled_connections(engine):
+    """Claiming and prefilling share a transaction, or the prefill waits"""
+
+    iteration_id = schedule_iteration(engine, "9800000003")
+    catalog = InstrumentCatalog(engine)
+    with make_session(engine) as session:
+        claimed = claim_iterations_to_open(session, [iteration_id])
+        open_iterations(session, claimed, catalog)
+
+    with make_session(engine) as session:
+        n_responses = session.scalar(
+            select(func.count()).where(Response.iteration_id == iteration_id)
+        )
+    assert n_responses == len(catalog.item_ids(claimed[0].instrument_id))
+
+
+def test_conversation_from_invitation_to_close(client, engine, dispatcher):
+    phone_number = "9800000002"
+    iteration_id = schedule_iteration(engine, phone_number)
+    catalog = invite(engine, dispatcher, iteration_id)
+
+    def reply(message: str) -> str:
+        params = {
+            "token": read_secret("cpsms_webhook_token"),
+            "from": phone_number,
+            "message": message,
+        }
+        return client.get("/aquaicu", params=params).text
+
+    with make_session(engine) as session:
+        instrument_id = session.scalar(
+            select(Iteration.instrument_id).where(
+                Iteration.iteration_id == iteration_id
+            )
+        )
+    item_ids = catalog.item_ids(instrument_id)
+    item_texts = [catalog.item_text(item_id) for item_id in item_ids]
+
+    assert reply("Ja") == to_xml_response(item_texts[0])
+    assert reply("syv") == to_xml_response(INVALID_ANSWER_TEXT)
+    for answer, item_text in zip("12345", item_texts[1:]):
+        assert reply(answer) == to_xml_response(item_text)
+    assert reply("1") == to_xml_response(NO_OPEN_ITEMS_TEXT)
+
+    with make_session(engine) as session:
+        answers = session.execute(
+            select(Response.response, Response.status)
+            .where(
+                Response.iteration_id == iteration_id,
+                Response.item_id.is_not(None),
+            )
+            .order_by(Response.response_id)
+        ).all()
+    assert [tuple(a) for a in answers] == [(i, "closed") for i in range(1, 6)]
+
+    stats = client.get(
+        f"/stats/iterations/{iteration_id}",
+        params={"token": read_secret("cpsms_webhook_token")},
+    )
+    assert stats.json()["state"] == "closed"
+
+
+def test_retried_answer_moves_the_conversation_once(
+    client, engine, dispatcher
+):
+    phone_number = "9800000004"
+    iteration_id = schedule_iteration(engine, phone_number)
+    invite(engine, dispatcher, iteration_id)
+
+    def reply(message: str, message_id: str) -> str:
+        params = {
+            "token": read_secret("cpsms_webhook_token"),
+            "from": phone_number,
+            "message": message,
+            "id": message_id,
+        }
+        return client.get("/aquaicu", params=params).text
+
+    reply("Ja", "1")
+    first = reply("3", "2")
+    assert reply("3", "2") == first  # e.g. on another worker, or restarted
+
+    with make_session(engine) as session:
+        n_closed = session.scalar(
+            select(func.count()).where(
+                Response.iteration_id == iteration_id,
+                Response.status == "closed",
+            )
+        )
+    assert n_closed == 1
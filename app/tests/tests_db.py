@@ -0,0 +1,20 @@
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from utils.db import (
+    _SESSIONMAKERS,
+    get_or_create_sessionmaker,
+)
+
+
+def test_only_engines_keep_a_sessionmaker():
+    engine = create_engine("sqlite://")
+    try:
+        Session = get_or_create_sessionmaker(engine, sessionmaker)
+        assert get_or_create_sessionmaker(engine, sessionmaker) is Session
+
+        with engine.connect() as connection:
+            get_or_create_sessionmaker(connection, sessionmaker)
+            assert connection not in _SESSIONMAKERS
+    finally:
+        _SESSIONMAKERS.pop(engine, None)
+        engine.dispose()
@@ -0,0 +1,78 @@
+import io
+
+import pytest
+from utils.config import read_secret
+from utils.enrollment import (
+    RowError,
+    normalize_phone_number,
+    read_rows,
+    to_copy_file,
+    validate_rows,
+)
+
+CSV = b"""\
+phone_number,full_name,instrument_id,opens_datetime,message_body
++45 12 34 56 78,Anna,1,2024-03-01T09:00,Er du klar? Svar Ja.
+12345678,Anna,1,2024-03-01T09:00,Er du klar? Svar Ja.
+0045 8765-4321,Bo,1,2024-03-01T09:00:00+01:00,Er du klar? Svar Ja.
+123,Carl,1,2024-03-01T09:00,Er du klar? Svar Ja.
+87654321,Bent,1,2024-04-01T09:00,Er du klar? Svar Ja.
+11223344,Dorthe,x,2024-03-01T09:00,Er du klar? Svar Ja.
+"""
+
+
+def test_phone_numbers_are_normalized():
+    assert normalize_phone_number("+45 12 34 56 78") == "4512345678"
+    assert normalize_phone_number("0046 (70) 123-45-67") == "46701234567"
+    assert normalize_phone_number("12345678") == "4512345678"
+    assert normalize_phone_number("1234") is None
+    assert normalize_phone_number("45 12 34 56 7x") is None
+
+
+def test_invalid_rows_are_reported_not_loaded():
+    rows, errors = validate_rows(read_rows(io.BytesIO(CSV), "csv"))
+
+    assert sorted(rows) == [1, 3]
+    assert rows[3]["phone_number"] == "4587654321"
+    assert errors == [
+        RowError(2, "Duplicate of row 1"),
+        RowError(4, "Invalid phone number: '123'"),
+        RowError(5, "full_name differs from row 3"),
+        RowError(6, "Invalid instrument_id: 'x'"),
+    ]
+    assert to_copy_file(rows).read().decode().splitlines()[1] == (
+        "3,4587654321,Bo,1,2024-03-01T09:00:00+01:00,Er du klar? Svar Ja."
+    )
+
+
+def test_jsonl_rows_and_missing_columns():
+    jsonl = b'{"phone_number": "12345678"}\n\n[1, 2]\n'
+    rows, errors = validate_rows(read_rows(io.BytesIO(jsonl), "jsonl"))
+
+    assert rows == {}
+    assert errors == [
+        RowError(1, "Missing full_name"),
+        RowError(3, "Not a JSON object"),
+    ]
+    with pytest.raises(ValueError):
+        list(read_rows(io.BytesIO(b"phone_number,full_name\n"), "csv"))
+
+
+def test_enrollment_endpoint_reports_rows(client):
+    """Needs the test database (see conftest.py)"""
+
+    admin = {"Authorization": f"Bearer {read_secret('procus_admin_token')}"}
+    cohort = (
+        b"phone_number,full_name,instrument_id,opens_datetime,message_body\n"
+        b"+45 98 00 01 00,Anna,1,2024-03-01T09:00,Er du klar? Svar Ja.\n"
+        b"123,Carl,1,2024-03-01T09:00,Er du klar? Svar Ja.\n"
+    )
+    for already_scheduled in ([], [1]):
+        response = client.post(
+            "/enrollments",
+            headers=admin,
+            files={"file": ("cohort.csv", cohort, "text/csv")},
+        )
+        report = response.json()
+        assert report["already_scheduled"] == already_scheduled
+        assert [e["row_number"] for e in report["errors"]] == [2]
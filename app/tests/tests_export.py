@@ -0,0 +1,109 @@
+import io
+from collections import namedtuple
+from datetime import (
+    datetime,
+    timezone,
+)
+
+import pytest
+from utils.export import (
+    ChunkBuffer,
+    CsvChunkWriter,
+    ResponseExport,
+    chunked,
+    pivot,
+)
+
+Row = namedtuple(
+    "Row",
+    [
+        "iteration_id",
+        "phone_number",
+        "opens_datetime",
+        "item_id",
+        "response",
+        "changed",
+    ],
+)
+
+OPENS = datetime(2024, 3, 1, 9, tzinfo=timezone.utc)
+
+
+def day(n: int) -> datetime:
+    return datetime(2024, 3, n, 12, tzinfo=timezone.utc)
+
+
+def test_pivot_gives_one_row_per_iteration():
+    rows = [
+        Row(1, "4512345678", OPENS, 1, 3, day(1)),
+        Row(1, "4512345678", OPENS, 2, 5, day(2)),
+        Row(2, "4587654321", OPENS, 1, None, day(1)),
+        Row(2, "4587654321", OPENS, 4, 2, day(1)),  # not in item_ids
+    ]
+
+    wide = list(pivot(rows, [1, 2, 3]))
+
+    assert wide == [
+        dict(
+            iteration_id=1,
+            phone_number="4512345678",
+            opens_datetime=OPENS,
+            last_changed=day(2),
+            item_1=3,
+            item_2=5,
+            item_3=None,
+        ),
+        dict(
+            iteration_id=2,
+            phone_number="4587654321",
+            opens_datetime=OPENS,
+            last_changed=day(1),
+            item_1=None,
+            item_2=None,
+            item_3=None,
+        ),
+    ]
+    assert list(chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+
+
+def test_csv_chunks_can_be_drained_as_written():
+    buffer = ChunkBuffer()
+    writer = CsvChunkWriter(buffer, ["iteration_id", "item_1"])
+    writer.write([dict(iteration_id=1, item_1=3)])
+    first = buffer.drain()
+    writer.write([dict(iteration_id=2, item_1=None)])
+    writer.close()
+
+    assert first == b"iteration_id,item_1\r\n1,3\r\n"
+    assert buffer.drain() == b"2,\r\n"
+    assert buffer.tell() == len(first) + 4
+
+
+def test_parquet_needs_pyarrow_and_formats_are_checked():
+    with pytest.raises(ValueError):
+        ResponseExport(None, 1, format="xlsx")
+
+    pyarrow = pytest.importorskip("pyarrow")
+    from utils.export import ParquetChunkWriter
+
+    buffer = ChunkBuffer()
+    columns = ["iteration_id", "phone_number", "opens_datetime"]
+    columns += ["last_changed", "item_1"]
+    writer = ParquetChunkWriter(buffer, columns)
+    row = dict(
+        iteration_id=1,
+        phone_number="4512345678",
+        opens_datetime=OPENS,
+        last_changed=day(2),
+        item_1=None,
+    )
+    data = b""
+    for _ in range(2):
+        writer.write([row])
+        data += buffer.drain()
+    writer.close()
+    data += buffer.drain()
+
+    table = pyarrow.parquet.read_table(io.BytesIO(data))
+    assert table.num_rows == 2
+    assert table.column("item_1").null_count == 2
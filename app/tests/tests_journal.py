@@ -0,0 +1,100 @@
+import json
+import os
+import threading
+
+import psycopg2
+from utils.journal import (
+    MessageJournal,
+    to_csv,
+)
+
+
+class FlakyJournal(MessageJournal):
+    """
+    Fails to write until the database is back, and rejects messages from
+    numbers that aren't recipients
+    """
+
+    def __init__(self, spill_path: str, quarantine_path: str = ""):
+        super().__init__(
+            spill_path=spill_path, quarantine_path=quarantine_path
+        )
+        self.is_up = False
+        self.unknown_numbers = ()
+        self.copied = []
+
+    def copy(self, data: bytes) -> None:
+        if not self.is_up:
+            raise ConnectionError("Database is down")
+        if any(number.encode() in data for number in self.unknown_numbers):
+            raise psycopg2.IntegrityError("violates foreign key constraint")
+        self.copied.append(data)
+
+
+def test_empty_body_and_null_differ():
+    data = to_csv([("2024-01-01T00:00:00+00:00", "4512345678", "", None)])
+    assert data == b'"2024-01-01T00:00:00+00:00","4512345678","",\n'
+
+
+def test_spilled_messages_are_written_first(tmp_path):
+    spill_path = str(tmp_path / "journal.csv")
+    journal = FlakyJournal(spill_path)
+    first = [("t1", "4512345678", "Ja", "inbound")]
+    second = [("t2", "4512345678", "Tak", "outbound")]
+
+    journal.flush(first)
+    assert os.path.exists(spill_path)
+
+    journal.is_up = True
+    journal.flush(second)
+    assert journal.copied == [to_csv(first), to_csv(second)]
+    assert not os.path.exists(spill_path)
+
+
+def test_unknown_sender_is_quarantined(tmp_path):
+    spill_path = str(tmp_path / "journal.jsonl")
+    quarantine_path = str(tmp_path / "rejected.jsonl")
+    journal = FlakyJournal(spill_path, quarantine_path)
+    journal.is_up = True
+    journal.unknown_numbers = ("4599999999",)
+    messages = [
+        ("t1", "4512345678", "Ja", "inbound"),
+        ("t2", "4599999999", "Hej", "inbound"),
+        ("t3", "4512345678", "Tak", "outbound"),
+    ]
+
+    journal.flush(messages)
+    journal.flush([("t4", "4512345678", "1", "inbound")])
+
+    assert b"".join(journal.copied) == to_csv(messages[::2]) + to_csv(
+        [("t4", "4512345678", "1", "inbound")]
+    )
+    assert not os.path.exists(spill_path)
+    with open(quarantine_path) as f:
+        rejected = [json.loads(line)["message"] for line in f]
+    assert rejected == [list(messages[1])]
+
+
+class HangingJournal(MessageJournal):
+    """Its database hangs until released"""
+
+    def __init__(self):
+        super().__init__(spill_path="", max_buffer_size=1, flush_seconds=0)
+        self.writing = threading.Event()
+        self.release = threading.Event()
+
+    def copy(self, data: bytes) -> None:
+        self.writing.set()
+        self.release.wait()
+
+
+def test_recording_never_waits_for_a_full_buffer():
+    journal = HangingJournal()
+    journal.record("4512345678", "Ja", "inbound")  # being written
+    assert journal.writing.wait(10)
+    journal.record("4512345678", "Tak", "outbound")  # fills the buffer
+    journal.record("4512345678", "1", "inbound")  # would block the loop
+
+    assert journal.writer.n_dropped == 1
+    journal.release.set()
+    journal.stop()
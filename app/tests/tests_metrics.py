@@ -0,0 +1,20 @@
+from utils.metrics import (
+    GATEWAY_RESPONSES,
+    render_metrics,
+    time_stage,
+)
+
+
+def test_stages_are_timed():
+    with time_stage("tests_metrics"):
+        pass
+
+    content, media_type = render_metrics()
+    assert media_type.startswith("text/plain")
+    assert b'procus_stage_seconds_count{stage="tests_metrics"} 1.0' in content
+
+
+def test_gateway_status_codes_are_counted():
+    GATEWAY_RESPONSES.labels(503).inc()
+    content, _ = render_metrics()
+    assert b'procus_gateway_responses_total{status_code="503"}' in content
@@ -0,0 +1,54 @@
+from collections import namedtuple
+
+from tests.fake_cpsms import FakeCpsms
+from utils.outbox import (
+    OutboxSender,
+    group_by_body,
+)
+from utils.sms import SmsDispatcher
+
+Row = namedtuple("Row", ["outbox_id", "phone_number", "message_body"])
+
+
+def test_same_body_is_grouped_up_to_max_recipients():
+    bodies = ["Hej"] * 5 + ["Ja?"] * 2
+    rows = [Row(i, f"45000000{i:02}", body) for i, body in enumerate(bodies)]
+
+    groups = group_by_body(rows, max_recipients=2)
+
+    ids = [(body, [row.outbox_id for row in group]) for body, group in groups]
+    assert ids == [
+        ("Hej", [0, 1]),
+        ("Hej", [2, 3]),
+        ("Hej", [4]),
+        ("Ja?", [5, 6]),
+    ]
+
+
+def test_one_request_with_an_outcome_per_recipient():
+    rows = [Row(i, f"45000000{i:02}", "Hej") for i in range(3)]
+    with FakeCpsms(rejected_numbers=("4500000001",)) as fake:
+        dispatcher = SmsDispatcher(token="token", url=fake.url)
+        sender = OutboxSender(engine=None, dispatcher=dispatcher)
+        outcomes = sender.send_group("Hej", rows)
+        dispatcher.close()
+
+    assert len(fake.sent) == 1
+    assert [(o.outbox_id, o.status) for o in outcomes] == [
+        (0, "sent"),
+        (1, "failed"),
+        (2, "sent"),
+    ]
+    assert outcomes[1].error == "Invalid number"
+
+
+def test_lost_reply_leaves_the_group_unknown():
+    rows = [Row(i, f"45000000{i:02}", "Hej") for i in range(3)]
+    with FakeCpsms(drop_connections=True) as fake:
+        dispatcher = SmsDispatcher(token="token", url=fake.url)
+        sender = OutboxSender(engine=None, dispatcher=dispatcher)
+        outcomes = sender.send_group("Hej", rows)
+        dispatcher.close()
+
+    assert fake.n_requests == 1
+    assert {o.status for o in outcomes} == {"unknown"}
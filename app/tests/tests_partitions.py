@@ -0,0 +1,20 @@
+from datetime import date
+
+from utils.partitions import (
+    Partition,
+    add_months,
+    expired_partitions,
+)
+
+
+def test_months_before_the_retention_period_expire():
+    partitions = [
+        Partition("prod.log", f"prod.log_p{m:%Y%m}", m)
+        for m in (date(2024, 3, 1), date(2023, 12, 1), date(2024, 1, 1))
+    ]
+
+    expired = expired_partitions(partitions, 2, today=date(2024, 3, 15))
+
+    assert [p.month for p in expired] == [date(2023, 12, 1)]
+    assert add_months(date(2024, 1, 1), -1) == date(2023, 12, 1)
+    assert add_months(date(2024, 11, 1), 14) == date(2026, 1, 1)
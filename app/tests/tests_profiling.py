@@ -0,0 +1,61 @@
+import asyncio
+import time
+
+from utils.profiling import (
+    should_profile,
+    start_profile,
+    stop_profile,
+)
+
+
+def busy(seconds: float) -> None:
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        pass
+
+
+async def profiled_request():
+    await asyncio.sleep(0)
+    busy(0.02)
+
+
+async def other_request():
+    await asyncio.sleep(0)
+    busy(0.02)
+
+
+async def profile_request():
+    profile, token = start_profile("/aquaicu")
+    try:
+        await profiled_request()
+    finally:
+        stop_profile(token)
+    return profile
+
+
+async def handle_concurrently():
+    profile, _ = await asyncio.gather(profile_request(), other_request())
+    return profile
+
+
+def test_only_the_profiled_request_is_counted(tmp_path):
+    profile = asyncio.run(handle_concurrently())
+
+    stacks = profile.stacks
+    assert any("busy" in path for path in stacks)
+    assert not any("other_request" in path for path in stacks)
+    # Nearly all time in busy(), which is in profiled_request()
+    in_busy = sum(s for path, s in stacks.items() if "busy" in path)
+    assert 0.015 < in_busy < 0.1
+
+    prefix = profile.write(str(tmp_path))
+    folded = (tmp_path / f"{profile.profile_id}.folded").read_text()
+    assert prefix.endswith(profile.profile_id)
+    lines = folded.splitlines()
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+
+
+def test_sampling():
+    assert should_profile({"profile": "1"}, sample_rate=0)
+    assert not should_profile({}, sample_rate=0)
+    assert should_profile({}, sample_rate=1)
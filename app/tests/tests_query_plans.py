@@ -0,0 +1,175 @@
+"""
+Checks that the hot queries of the webhook and the starter are backed by
+indexes, and stay within a latency budget, on a large synthetic dataset.
+Runs against the test database (see conftest.py); everything is rolled back
+afterwards.
+"""
+
+import os
+
+import pytest
+from sqlalchemy import (
+    select,
+    text,
+)
+from utils.api import select_awaiting_responses
+from utils.conversation import build_step_statement
+from utils.orm import (
+    Iteration,
+    Response,
+)
+from utils.reminders import (
+    select_due_expiries,
+    select_due_reminders,
+)
+from utils.starter import (
+    select_iterations_to_claim,
+    select_prefilled_iterations,
+    select_scheduled_iterations,
+)
+from utils.stats import (
+    select_instrument_stats,
+    select_iteration_stats,
+)
+
+N_RECIPIENTS = int(os.getenv("QUERY_PLAN_N_RECIPIENTS", "20000"))
+BUDGET_MS = float(os.getenv("QUERY_PLAN_BUDGET_MS", "5"))
+LARGE_TABLES = ("responses", "iterations")
+
+SEED = [
+    """
+    INSERT INTO prod.recipients (phone_number, full_name)
+    SELECT '99' || lpad(i::text, 8, '0'), 'Synthetic ' || i
+    FROM generate_series(1, :n) AS i
+    """,
+    """
+    INSERT INTO prod.iterations (phone_number, message_body, is_open,
+        opens_datetime)
+    SELECT '99' || lpad(i::text, 8, '0'), 'Invitation', i % 10 <> 0,
+        now() + (i % 100 - 50) * interval '1 day'
+    FROM generate_series(1, :n) AS i
+    """,
+    # Most conversations are done, every tenth is halfway through
+    """
+    INSERT INTO prod.responses (iteration_id, phone_number, opens_datetime,
+        status, remind_at, expires_at)
+    SELECT it.iteration_id, it.phone_number, now(),
+        CASE
+            WHEN it.iteration_id % 10 <> 0 THEN 'closed'
+            WHEN k < 3 THEN 'closed'
+            WHEN k = 3 THEN 'awaiting'
+            ELSE 'open'
+        END,
+        now() + (it.iteration_id % 100 - 1) * interval '1 hour',
+        now() + (it.iteration_id % 100 + 24) * interval '1 hour'
+    FROM prod.iterations AS it
+    CROSS JOIN generate_series(1, 6) AS k
+    WHERE it.phone_number LIKE '99%'
+    """,
+    "ANALYZE prod.recipients",
+    "ANALYZE prod.iterations",
+    "ANALYZE prod.responses",
+]
+
+
+@pytest.fixture(scope="module")
+def connection(engine):
+    connection = engine.connect()
+    transaction = connection.begin()
+    for stmt in SEED:
+        connection.execute(text(stmt), {"n": N_RECIPIENTS})
+
+    yield connection
+
+    transaction.rollback()
+    connection.close()
+
+
+def explain(connection, stmt) -> dict:
+    compiled = stmt.compile(
+        dialect=connection.dialect,
+        compile_kwargs={"render_postcompile": True},
+    )
+    result = connection.exec_driver_sql(
+        f"EXPLAIN (ANALYZE, FORMAT JSON) {compiled.string}", compiled.params
+    )
+    return result.scalar()[0]
+
+
+def plan_nodes(node: dict):
+    yield node
+    for child in node.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def awaiting_phone_number(connection) -> str:
+    stmt = select(Response.phone_number).where(Response.status == "awaiting")
+    return connection.scalar(stmt.limit(1))
+
+
+def closed_iteration_ids(connection) -> list[int]:
+    stmt = select_scheduled_iterations().limit(50)
+    return [row.iteration_id for row in connection.execute(stmt)]
+
+
+HOT_QUERIES = {
+    "step_valid_answer": lambda c: build_step_statement(
+        awaiting_phone_number(c), 3
+    ),
+    "step_invalid_answer": lambda c: build_step_statement(
+        awaiting_phone_number(c), None
+    ),
+    "awaiting_responses": lambda c: select_awaiting_responses(limit=10000),
+    "scheduled_iterations": lambda c: select_scheduled_iterations(),
+    "claim_iterations": lambda c: select_iterations_to_claim(
+        closed_iteration_ids(c)
+    ),
+    "prefilled_iterations": lambda c: select_prefilled_iterations(
+        closed_iteration_ids(c)
+    ),
+    "due_reminders": lambda c: select_due_reminders(),
+    "due_expiries": lambda c: select_due_expiries(),
+    "instrument_stats": lambda c: select_instrument_stats(1),
+    "iteration_stats": lambda c: select_iteration_stats(
+        closed_iteration_ids(c)[0]
+    ),
+}
+
+
+@pytest.mark.parametrize("name", HOT_QUERIES)
+def test_hot_query_uses_indexes(connection, name):
+    stmt = HOT_QUERIES[name](connection)
+    nodes = list(plan_nodes(explain(connection, stmt)["Plan"]))
+
+    seq_scans = [
+        node["Relation Name"]
+        for node in nodes
+        if node["Node Type"] == "Seq Scan"
+        and node.get("Relation Name") in LARGE_TABLES
+    ]
+    assert not seq_scans, f"{name} scans {seq_scans} sequentially"
+
+
+@pytest.mark.parametrize("name", ["step_valid_answer", "step_invalid_answer"])
+def test_step_uses_partial_indexes(connection, name):
+    stmt = HOT_QUERIES[name](connection)
+    nodes = plan_nodes(explain(connection, stmt)["Plan"])
+    used = {node.get("Index Name") for node in nodes}
+
+    assert {"idx__responses__awaiting", "idx__responses__open"} <= used
+
+
+@pytest.mark.parametrize("name", HOT_QUERIES)
+def test_hot_query_within_budget(connection, name):
+    stmt = HOT_QUERIES[name](connection)
+    explain(connection, stmt)  # warm up caches
+    execution_ms = explain(connection, stmt)["Execution Time"]
+
+    assert execution_ms < BUDGET_MS, f"{name} took {execution_ms:.2f} ms"
+
+
+def test_seeded(connection):
+    stmt = select(Iteration.iteration_id).where(
+        Iteration.phone_number.like("99%")
+    )
+    assert len(connection.execute(stmt).all()) == N_RECIPIENTS
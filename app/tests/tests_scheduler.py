@@ -0,0 +1,39 @@
+from utils.scheduler import IterationScheduler
+
+
+def make_scheduler(batch_size: int = 10) -> IterationScheduler:
+    return IterationScheduler(
+        engine=None, open_iterations=None, batch_size=batch_size
+    )
+
+
+def test_pops_due_iterations_in_order():
+    scheduler = make_scheduler()
+    scheduler.schedule(1, 30.0)
+    scheduler.schedule(2, 10.0)
+    scheduler.schedule(3, 20.0)
+
+    assert scheduler.next_due() == 10.0
+    assert scheduler.pop_due(now=25.0) == [2, 3]
+    assert scheduler.next_due() == 30.0
+
+
+def test_rescheduling_replaces_earlier_entry():
+    scheduler = make_scheduler()
+    scheduler.schedule(1, 10.0)
+    scheduler.schedule(1, 50.0)
+
+    assert scheduler.pop_due(now=20.0) == []
+    assert scheduler.next_due() == 50.0
+
+    scheduler.unschedule(1)
+    assert scheduler.next_due() is None
+
+
+def test_pops_at_most_a_batch():
+    scheduler = make_scheduler(batch_size=2)
+    for iteration_id in range(5):
+        scheduler.schedule(iteration_id, float(iteration_id))
+
+    assert scheduler.pop_due(now=10.0) == [0, 1]
+    assert scheduler.pop_due(now=10.0) == [2, 3]
@@ -0,0 +1,75 @@
+import time
+
+from tests.fake_cpsms import FakeCpsms
+from utils.sms import (
+    RateLimiter,
+    SmsDispatcher,
+)
+
+
+def test_send_many_keeps_order():
+    with FakeCpsms(latency_seconds=0.01) as fake:
+        dispatcher = SmsDispatcher(
+            token="token", url=fake.url, max_workers=4, rate_per_second=1000
+        )
+        messages = [(f"45000000{i:02}", f"Hej {i}") for i in range(20)]
+        responses = dispatcher.send_many(messages)
+        dispatcher.close()
+
+    assert [r.status_code for r in responses] == [200] * 20
+    assert [r.json()["success"][0]["to"] for r in responses] == [
+        to for to, _ in messages
+    ]
+    assert len(fake.sent) == 20
+
+
+def test_transient_failures_are_retried():
+    with FakeCpsms(failure_rate=0.3, seed=1) as fake:
+        dispatcher = SmsDispatcher(
+            token="token",
+            url=fake.url,
+            rate_per_second=1000,
+            max_retries=10,
+            backoff_seconds=0.001,
+        )
+        responses = dispatcher.send_many(
+            (f"45000000{i:02}", "Hej") for i in range(20)
+        )
+        dispatcher.close()
+
+    assert all(r.status_code == 200 for r in responses)
+    assert fake.n_failed > 0
+    assert len(fake.sent) == 20
+
+
+def test_failures_after_sending_are_not_retried():
+    fakes = (
+        FakeCpsms(failure_rate=1.0, failure_status=502),
+        FakeCpsms(drop_connections=True),
+    )
+    for fake in fakes:
+        with fake:
+            dispatcher = SmsDispatcher(
+                token="token", url=fake.url, backoff_seconds=0.001
+            )
+            dispatcher.send_many([("4500000000", "Hej")])
+            dispatcher.close()
+        assert fake.n_requests == 1
+
+
+def test_unreachable_gateway_gives_none():
+    dispatcher = SmsDispatcher(
+        token="token",
+        url="http://127.0.0.1:9/v2/send",
+        max_retries=1,
+        backoff_seconds=0.001,
+    )
+    assert dispatcher.send_many([("4500000000", "Hej")]) == [None]
+
+
+def test_rate_limiter_spaces_calls():
+    limiter = RateLimiter(rate_per_second=100, burst=1)
+    start = time.monotonic()
+    for _ in range(11):
+        limiter.acquire()
+    assert time.monotonic() - start >= 0.09
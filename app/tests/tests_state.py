@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+from utils.state import (
+    AwaitingStateStore,
+    LRUAwaitingStore,
+    NotifyListener,
+    PhoneNumberLocks,
+    PostgresNotifyListener,
+    apply_notification,
+)
+
+
+def test_lru_store_evicts_least_recently_used():
+    store = LRUAwaitingStore(max_size=2)
+    store.set("4500000001", 1)
+    store.set("4500000002", 2)
+    store.get("4500000001")
+    store.set("4500000003", 3)
+
+    assert len(store) == 2
+    assert store.get("4500000001") == 1
+    assert store.get("4500000002") is None
+    assert store.get("4500000003") == 3
+
+
+def test_invalidate_only_matching_response():
+    store = LRUAwaitingStore()
+    store.set("4500000001", 2)
+
+    store.invalidate("4500000001", 1)
+    assert store.get("4500000001") == 2
+
+    store.invalidate("4500000001", 2)
+    assert store.get("4500000001") is None
+
+
+def test_notifications_commute_within_a_step():
+    # Closing response 1 and marking response 2 happen in one statement, so
+    # the two notifications may arrive in either order
+    for payloads in (
+        ["4500000001,1,closed", "4500000001,2,awaiting"],
+        ["4500000001,2,awaiting", "4500000001,1,closed"],
+    ):
+        store = LRUAwaitingStore()
+        store.set("4500000001", 1)
+        for payload in payloads:
+            apply_notification(store, payload)
+        assert store.get("4500000001") == 2
+
+
+def test_phone_number_locks_serialise_replies_in_order():
+    locks = PhoneNumberLocks()
+    handled = []
+
+    async def reply(phone_number, i, seconds=0.0):
+        async with locks.hold(phone_number):
+            await asyncio.sleep(seconds)
+            handled.append((phone_number, i))
+
+    async def main():
+        await asyncio.gather(
+            reply("4500000001", 0, seconds=0.05),
+            *(reply("4500000001", i) for i in (1, 2)),
+            reply("4500000002", 0),
+        )
+
+    asyncio.run(main())
+
+    assert [i for p, i in handled if p == "4500000001"] == [0, 1, 2]
+    assert handled[0] == ("4500000002", 0)  # didn't wait for the others
+    assert len(locks) == 0
+
+
+def test_base_classes_are_abstract():
+    with pytest.raises(TypeError):
+        AwaitingStateStore()
+    with pytest.raises(TypeError):
+        NotifyListener("channel")
+
+    class PrintingListener(NotifyListener):
+        def on_notification(self, payload: str) -> None:
+            print(payload)
+
+    assert PrintingListener("channel").on_disconnect() is None
+
+
+def test_notifications_during_warm_up_win():
+    store = LRUAwaitingStore()
+
+    async def warm(warming_store):
+        rows = [("4500000001", 1), ("4500000002", 2)]  # read, then:
+        listener.on_notification("4500000001,1,closed")
+        for phone_number, response_id in rows:
+            warming_store.set(phone_number, response_id)
+
+    listener = PostgresNotifyListener(store, warm=warm)
+    asyncio.run(listener.on_connect())
+
+    assert store.get("4500000001") is None
+    assert store.get("4500000002") == 2
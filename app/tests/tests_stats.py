@@ -0,0 +1,48 @@
+from collections import namedtuple
+
+from utils.stats import (
+    FINISH_BUCKET_BOUNDS,
+    estimate_median,
+    summarize_instrument,
+)
+
+Slot = namedtuple(
+    "Slot", ["n_open", "n_awaiting", "n_closed", "n_stalled", "finish_buckets"]
+)
+
+
+def buckets(**counts) -> list[int]:
+    """A histogram with counts by bucket index, e.g. b3=2"""
+
+    histogram = [0] * (len(FINISH_BUCKET_BOUNDS) + 1)
+    for name, n in counts.items():
+        histogram[int(name[1:])] = n
+    return histogram
+
+
+def test_median_is_interpolated_within_its_bucket():
+    # Two in [0, 60), two in [60, 300): the median is at the boundary
+    assert estimate_median(buckets(b0=2, b1=2)) == 60
+    # All in [300, 900): half way through
+    assert estimate_median(buckets(b2=4)) == 600
+    assert estimate_median(buckets()) is None
+    # Beyond a week, only the lower bound is known
+    assert estimate_median(buckets(b12=1)) == FINISH_BUCKET_BOUNDS[-1]
+
+
+def test_slots_are_summed():
+    slots = [
+        Slot(1, 2, 3, 0, buckets(b2=3)),
+        Slot(0, 1, 1, 1, buckets(b2=1)),
+    ]
+
+    summary = summarize_instrument(7, slots)
+
+    assert summary == dict(
+        instrument_id=7,
+        n_open=1,
+        n_awaiting=3,
+        n_closed=4,
+        n_stalled=1,
+        median_seconds_to_finish=600,
+    )
@@ -1,15 +1,29 @@
-import datetime
-import json
-from collections import namedtuple
+import hmac
+import os
+from typing import Optional
 
-from dotenv import load_dotenv
 from fastapi import Request
 from fastapi import Response as BaseResponse
-from sqlalchemy.engine import Engine
-from utils.db import make_session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.sql import Select
+from utils.archive import (
+    REQUEST_ARCHIVE,
+    RequestArchive,
+)
+from utils.config import read_secret
+from utils.db_async import make_async_session
 from utils.orm import Response
+from utils.state import AwaitingStateStore
 
-load_dotenv(".env")
+# Query parameters with which the gateway identifies an inbound message; a
+# retried webhook call repeats them
+WEBHOOK_MESSAGE_ID_PARAMS: list[str] = os.getenv(
+    "WEBHOOK_MESSAGE_ID_PARAMS", "id,messageid,time"
+).split(",")
+
+# Rows per query when warming the awaiting-state store
+WARM_PAGE_SIZE: int = int(os.getenv("WARM_PAGE_SIZE", "1000"))
 
 
 class XmlResponse(BaseResponse):
@@ -42,31 +56,93 @@ def parse_response(x: str, lower: int = 1, upper: int = 5) -> int | None:
         return None
 
 
-def fetch_next_item(engine: Engine, phone_number: str) -> namedtuple:
-    with make_session(engine) as session:
-        item = (
-            session.query(Response.item_text, Response.response_id)
-            .filter_by(status="open", phone_number=phone_number)
-            .order_by(Response.response_id)
-            .first()
-        )
-    return item
-
-
-# Build dict of awaiting responses when app launches
-# the dict is updated when the /aquaicu endpoint is invoked (when appropriate)
-def fetch_awaiting_responses(engine: Engine) -> dict:
-    with make_session(engine) as session:
-        rows = (
-            session.query(Response.phone_number, Response.response_id)
-            .filter_by(status="awaiting")
-            .all()
-        )
-
-    return {row.phone_number: row.response_id for row in rows}
+def is_admin(authorization: Optional[str]) -> bool:
+    """
+    Whether an Authorization header carries the admin token (the
+    procus_admin_token secret) as a bearer token. Never true without one.
+    """
 
+    try:
+        admin_token = read_secret("procus_admin_token").strip()
+    except FileNotFoundError:
+        return False
+    scheme, _, token = (authorization or "").partition(" ")
+    return (
+        bool(admin_token)
+        and scheme.lower() == "bearer"
+        and hmac.compare_digest(token.strip(), admin_token)
+    )
+
+
+def idempotency_key(query_params) -> Optional[str]:
+    """
+    Identify an inbound message by the gateway's identifiers, together with
+    sender and text. None if the gateway sent no identifiers, as identical
+    replies can't then be told apart from retries.
+    """
+
+    ids = [
+        f"{param}={query_params[param]}"
+        for param in WEBHOOK_MESSAGE_ID_PARAMS
+        if query_params.get(param)
+    ]
+    if not ids:
+        return None
 
-async def dump_request(request: Request, file_path: str = None) -> None:
+    parts = [query_params.get("from", ""), query_params.get("message", "")]
+    return "\x1f".join(parts + ids)
+
+
+def select_awaiting_responses(
+    limit: int = None, before_response_id: int = None
+) -> Select:
+    """The most recent responses awaiting an answer, newest first"""
+
+    stmt = (
+        select(Response.phone_number, Response.response_id)
+        .filter_by(status="awaiting")
+        .order_by(Response.response_id.desc())
+        .limit(limit)
+    )
+    if before_response_id is not None:
+        stmt = stmt.where(Response.response_id < before_response_id)
+    return stmt
+
+
+# Load awaiting responses into the store when the app launches (and whenever
+# it has to catch up); the /aquaicu endpoint keeps it current afterwards
+async def fetch_awaiting_responses(
+    engine: AsyncEngine,
+    store: AwaitingStateStore,
+    page_size: int = WARM_PAGE_SIZE,
+) -> None:
+    """
+    Fetch the newest store.max_size awaiting responses, page_size at a time,
+    so that no single query (or transaction) holds up requests for long
+    """
+
+    rows, before_response_id = [], None
+    while store.max_size is None or len(rows) < store.max_size:
+        limit = page_size
+        if store.max_size is not None:
+            limit = min(page_size, store.max_size - len(rows))
+        stmt = select_awaiting_responses(limit, before_response_id)
+        async with make_async_session(engine) as session:
+            page = (await session.execute(stmt)).all()
+
+        rows.extend(page)
+        if len(page) < limit:
+            break
+        before_response_id = page[-1].response_id
+
+    # Oldest first, so the most recent ones are the last to be evicted
+    for row in reversed(rows):
+        store.set(row.phone_number, row.response_id)
+
+
+async def dump_request(
+    request: Request, archive: RequestArchive = REQUEST_ARCHIVE
+) -> None:
     request_as_dict = {
         "method": request.method,
         "url_path": request.url.path,
@@ -76,6 +152,4 @@ async def dump_request(request: Request, file_path: str = None) -> None:
         "body_content": (await request.body()).decode(),
     }
 
-    unix_epochs = int(datetime.datetime.now().timestamp())
-    with open(f"/persistent_storage/{file_path}_{unix_epochs}.json", "w") as f:
-        json.dump(request_as_dict, f, indent=2)
+    archive.submit(request_as_dict)
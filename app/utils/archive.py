@@ -0,0 +1,194 @@
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+from datetime import (
+    datetime,
+    timezone,
+)
+from typing import (
+    Iterator,
+    Optional,
+)
+
+from utils.logging import LOGGER
+
+ARCHIVE_DIR: str = os.getenv("REQUEST_ARCHIVE_DIR", "/persistent_storage")
+ARCHIVE_MAX_SEGMENT_BYTES: int = int(
+    os.getenv("REQUEST_ARCHIVE_MAX_SEGMENT_BYTES", str(64 * 1024 * 1024))
+)
+ARCHIVE_MAX_SEGMENT_SECONDS: int = int(
+    os.getenv("REQUEST_ARCHIVE_MAX_SEGMENT_SECONDS", str(24 * 60 * 60))
+)
+ARCHIVE_COMPRESS: bool = (
+    os.getenv("REQUEST_ARCHIVE_COMPRESS", "true").lower() == "true"
+)
+
+
+class RequestArchive:
+    """
+    Appends request snapshots to rotated JSONL segments from a background
+    thread, so archiving a request costs the caller no more than a queue put.
+
+    Each segment has an index next to it with one tab-separated line per
+    request (unix time, phone number, byte offset, byte length), so single
+    requests can be found without reading whole segments. Compressed
+    segments store every request as its own gzip member, which keeps them
+    valid .gz files while still allowing seeks to a single request.
+    """
+
+    def __init__(
+        self,
+        directory: str = ARCHIVE_DIR,
+        prefix: str = "request",
+        max_segment_bytes: int = ARCHIVE_MAX_SEGMENT_BYTES,
+        max_segment_seconds: int = ARCHIVE_MAX_SEGMENT_SECONDS,
+        compress: bool = ARCHIVE_COMPRESS,
+        max_queue_size: int = 10000,
+    ):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_seconds = max_segment_seconds
+        self.compress = compress
+        self.n_dropped = 0
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._segment = None
+        self._index = None
+        self._segment_opened_at = 0.0
+
+    def submit(self, snapshot: dict) -> None:
+        """Queue a snapshot for archiving, without ever blocking"""
+
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((time.time(), snapshot))
+        except queue.Full:
+            self.n_dropped += 1
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="request-archive", daemon=True
+                )
+                self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Write what is queued and close the current segment"""
+
+        if self._thread is None:
+            return
+        self._queue.put((None, None))
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 1000:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for received_at, snapshot in batch:
+                if snapshot is None:
+                    self._close_segment()
+                    return
+                try:
+                    self._write(received_at, snapshot)
+                except (OSError, TypeError, ValueError) as e:
+                    LOGGER.error(f"Could not archive request: {e!r}")
+
+            if self._segment is not None:
+                self._segment.flush()
+                self._index.flush()
+
+    def _segment_path(self, opened_at: float) -> str:
+        stamp = datetime.fromtimestamp(opened_at, timezone.utc)
+        suffix = ".jsonl.gz" if self.compress else ".jsonl"
+        return os.path.join(
+            self.directory,
+            f"{self.prefix}_{stamp.strftime('%Y%m%dT%H%M%S_%f')}{suffix}",
+        )
+
+    def _open_segment(self, now: float) -> None:
+        self._close_segment()
+        path = self._segment_path(now)
+        self._segment = open(path, "ab")
+        self._index = open(f"{path}.idx", "a", encoding="utf-8")
+        self._segment_opened_at = now
+
+    def _close_segment(self) -> None:
+        if self._segment is not None:
+            self._segment.close()
+            self._index.close()
+            self._segment = self._index = None
+
+    def _write(self, received_at: float, snapshot: dict) -> None:
+        segment_age = received_at - self._segment_opened_at
+        if (
+            self._segment is None
+            or self._segment.tell() >= self.max_segment_bytes
+            or segment_age >= self.max_segment_seconds
+        ):
+            self._open_segment(received_at)
+
+        record = dict(received_at=received_at, **snapshot)
+        data = (json.dumps(record, default=str) + "\n").encode("utf-8")
+        if self.compress:
+            data = gzip.compress(data)
+
+        offset = self._segment.tell()
+        self._segment.write(data)
+        phone_number = snapshot.get("query_params", {}).get("from", "")
+        self._index.write(
+            f"{received_at:.6f}\t{phone_number}\t{offset}\t{len(data)}\n"
+        )
+
+    def find(
+        self,
+        phone_number: str = None,
+        since: float = None,
+        until: float = None,
+    ) -> Iterator[dict]:
+        """Archived requests, optionally by phone number and unix time span"""
+
+        index_paths = sorted(
+            os.path.join(self.directory, file_name)
+            for file_name in os.listdir(self.directory)
+            if file_name.startswith(f"{self.prefix}_")
+            and file_name.endswith(".idx")
+        )
+
+        for index_path in index_paths:
+            segment_path = index_path[: -len(".idx")]
+            with open(index_path, encoding="utf-8") as index, open(
+                segment_path, "rb"
+            ) as segment:
+                for line in index:
+                    received_at, phone, offset, length = line.split("\t")
+                    received_at = float(received_at)
+                    if (
+                        (phone_number and phone != phone_number)
+                        or (since and received_at < since)
+                        or (until and received_at > until)
+                    ):
+                        continue
+
+                    segment.seek(int(offset))
+                    data = segment.read(int(length))
+                    if segment_path.endswith(".gz"):
+                        data = gzip.decompress(data)
+                    yield json.loads(data)
+
+
+REQUEST_ARCHIVE = RequestArchive()
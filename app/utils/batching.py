@@ -0,0 +1,125 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from typing import (
+    Callable,
+    Optional,
+)
+
+# Never the database logger: failing to write logs mustn't produce more logs
+_LOGGER: logging.Logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES: tuple = ("block", "drop_newest", "drop_oldest")
+
+_STOP = object()
+
+
+class BatchWriter:
+    """
+    Hands items to a background thread that passes them on to flush_fn in
+    batches, whenever batch_size items are waiting or flush_seconds have
+    passed since the first of them arrived. The buffer is bounded; when it
+    is full, overflow decides whether to block the caller, drop the new
+    item or drop the oldest one. Whatever is buffered is flushed on stop()
+    and when the interpreter exits.
+    """
+
+    def __init__(
+        self,
+        flush_fn: Callable[[list], None],
+        batch_size: int = 500,
+        flush_seconds: float = 1.0,
+        max_buffer_size: int = 10000,
+        overflow: str = "drop_oldest",
+        name: str = "batch-writer",
+    ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"overflow must be one of {OVERFLOW_POLICIES}, not {overflow}"
+            )
+
+        self.flush_fn = flush_fn
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.overflow = overflow
+        self.name = name
+        self.n_dropped = 0
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max_buffer_size)
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    def put(self, item) -> None:
+        self._ensure_started()
+
+        if self.overflow == "block":
+            self._queue.put(item)
+            return
+
+        try:
+            self._queue.put_nowait(item)
+            return
+        except queue.Full:
+            self.n_dropped += 1
+            if self.overflow == "drop_newest":
+                return
+
+        try:
+            self._queue.get_nowait()
+            self._queue.put_nowait(item)
+        except (queue.Empty, queue.Full):
+            pass
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name=self.name, daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Flush everything buffered and stop the background thread"""
+
+        with self._start_lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._queue.put(_STOP)
+        thread.join(timeout)
+
+    def _flush(self, batch: list) -> None:
+        try:
+            self.flush_fn(batch)
+        except Exception as e:
+            _LOGGER.error(
+                f"{self.name} failed to flush {len(batch)} items: {e!r}"
+            )
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+
+            batch = [item]
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    self._flush(batch)
+                    return
+                batch.append(item)
+
+            self._flush(batch)
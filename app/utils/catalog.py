@@ -0,0 +1,199 @@
+import asyncio
+import threading
+from collections import namedtuple
+from typing import Optional
+
+from sqlalchemy import select
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import (
+    AsyncConnection,
+    AsyncEngine,
+    AsyncSession,
+)
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select
+from utils.db import make_session
+from utils.db_async import make_async_session
+from utils.logging import LOGGER
+from utils.orm import (
+    Instrument,
+    Item,
+)
+from utils.state import NotifyListener
+
+# Must match the channel used by prod.notify_catalog_change() in init_ddl.sql
+CATALOG_CHANNEL: str = "catalog_changed"
+
+# Last "item" of every iteration, which needs no answer; its response rows
+# have no item_id
+CLOSING_ITEM_TEXT: str = "Tak for din hjælp!"
+
+CatalogItem = namedtuple("CatalogItem", ["item_id", "item_text"])
+
+
+class UnknownItemError(LookupError):
+    """An item_id that is neither in the catalog nor in the database"""
+
+
+def select_catalog() -> Select:
+    return (
+        select(
+            Item.instrument_id,
+            Item.item_id,
+            Item.item_text,
+            Instrument.is_active,
+        )
+        .join(Instrument, Instrument.instrument_id == Item.instrument_id)
+        .order_by(Item.instrument_id, Item.item_id)
+    )
+
+
+def select_item_text(item_id: int) -> Select:
+    return select(Item.item_text).where(Item.item_id == item_id)
+
+
+class InstrumentCatalog:
+    """
+    The instruments and their items, loaded from the database once and then
+    served from memory, so that responses only need to store item_ids.
+    Items of inactive instruments are kept too, as they may still be awaiting
+    an answer. Call reload() (or reload_async()) to pick up changes; version
+    counts the loads.
+    """
+
+    def __init__(self, engine: Engine = None):
+        self.engine = engine
+        self.version = 0
+        self._items: dict = None  # instrument_id: items, active ones only
+        self._texts: dict = {}  # item_id: item_text
+        self._lock = threading.Lock()
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._items is not None
+
+    def _load(self, rows: list) -> None:
+        items: dict = {}
+        texts: dict = {}
+        for row in rows:
+            texts[row.item_id] = row.item_text
+            if row.is_active:
+                items.setdefault(row.instrument_id, []).append(
+                    CatalogItem(row.item_id, row.item_text)
+                )
+
+        with self._lock:
+            self._items, self._texts = items, texts
+            self.version += 1
+
+    def reload(self) -> None:
+        with make_session(self.engine) as session:
+            rows = session.execute(select_catalog()).all()
+        self._load(rows)
+
+    async def reload_async(self, engine: AsyncEngine) -> None:
+        async with make_async_session(engine) as session:
+            rows = (await session.execute(select_catalog())).all()
+        self._load(rows)
+
+    def items(self, instrument_id: int) -> list[CatalogItem]:
+        """Items of an active instrument, in the order they are asked"""
+
+        if self._items is None:
+            self.reload()
+        return self._items.get(instrument_id, [])
+
+    def item_ids(self, instrument_id: int) -> list[Optional[int]]:
+        """What to ask in an iteration, ending with the closing item (None)"""
+
+        return [item.item_id for item in self.items(instrument_id)] + [None]
+
+    def is_stale(self, item_id: Optional[int]) -> bool:
+        """Whether the catalog must be (re)loaded to know item_id"""
+
+        return not self.is_loaded or (
+            item_id is not None and item_id not in self._texts
+        )
+
+    def item_text(self, item_id: Optional[int]) -> str:
+        if item_id is None:
+            return CLOSING_ITEM_TEXT
+        try:
+            return self._texts[item_id]
+        except KeyError:
+            raise UnknownItemError(
+                f"Item {item_id} isn't in the instrument catalog "
+                f"(version {self.version})"
+            ) from None
+
+    def _fallback(self, item_id: int, item_text: Optional[str]) -> str:
+        if item_text is None:
+            raise UnknownItemError(f"Item {item_id} doesn't exist")
+        if self.is_loaded:  # not yet loaded is expected right after startup
+            LOGGER.warning(
+                f"Item {item_id} was missing from the instrument catalog "
+                f"(version {self.version}) and was read from the database"
+            )
+        return item_text
+
+    def read_item_text(self, session: Session, item_id: Optional[int]) -> str:
+        """
+        item_text, reading an item the catalog doesn't know from the database,
+        e.g. while a reload that missed it is being served
+        """
+
+        try:
+            return self.item_text(item_id)
+        except UnknownItemError:
+            item_text = session.scalar(select_item_text(item_id))
+            return self._fallback(item_id, item_text)
+
+    async def resolve_item_text(
+        self,
+        connection: AsyncConnection | AsyncSession,
+        item_id: Optional[int],
+    ) -> str:
+        """
+        item_text, reading an item the catalog doesn't know (yet) on
+        connection, i.e. in the caller's transaction rather than on another
+        pooled connection; CatalogListener (re)loads the catalog
+        """
+
+        try:
+            return self.item_text(item_id)
+        except UnknownItemError:
+            item_text = await connection.scalar(select_item_text(item_id))
+            return self._fallback(item_id, item_text)
+
+
+class CatalogListener(NotifyListener):
+    """
+    Reloads a catalog whenever prod.items or prod.instruments change, and on
+    (re)connecting, in case changes were missed in between.
+    """
+
+    def __init__(
+        self,
+        catalog: InstrumentCatalog,
+        engine: AsyncEngine,
+        channel: str = CATALOG_CHANNEL,
+        reconnect_seconds: float = 5.0,
+    ):
+        super().__init__(channel, reconnect_seconds)
+        self.catalog = catalog
+        self.engine = engine
+        self._reloads: set = set()
+
+    async def on_connect(self) -> None:
+        await self.catalog.reload_async(self.engine)
+
+    def on_notification(self, payload: str) -> None:
+        task = asyncio.create_task(self._reload())
+        self._reloads.add(task)  # keep a reference until done
+        task.add_done_callback(self._reloads.discard)
+
+    async def _reload(self) -> None:
+        try:
+            await self.catalog.reload_async(self.engine)
+        except Exception as e:
+            LOGGER.error(f"Reloading the instrument catalog failed: {e!r}")
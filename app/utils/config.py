@@ -0,0 +1,23 @@
+import os
+from functools import lru_cache
+
+from dotenv import load_dotenv
+
+load_dotenv(".env")
+
+SECRETS_DIR: str = os.getenv("SECRETS_DIR", "/run/secrets")
+
+
+@lru_cache(maxsize=None)
+def read_secret(name: str) -> str:
+    """
+    Read a Docker secret when first needed, rather than on import. An
+    environment variable named like it in upper case (e.g. POSTGRES_PASSWORD)
+    takes precedence, so that the app runs without the secrets, e.g. in tests.
+    """
+
+    value = os.getenv(name.upper())
+    if value is not None:
+        return value
+    with open(os.path.join(SECRETS_DIR, name), "r") as f:
+        return f.readline()
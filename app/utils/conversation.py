@@ -0,0 +1,261 @@
+import inspect
+from typing import (
+    NamedTuple,
+    Optional,
+)
+
+from sqlalchemy import (
+    and_,
+    case,
+    exists,
+    func,
+    literal,
+    null,
+    select,
+    update,
+)
+from sqlalchemy.ext.asyncio import (
+    AsyncConnection,
+    AsyncEngine,
+    AsyncSession,
+)
+from sqlalchemy.sql import Select
+from utils.catalog import (
+    InstrumentCatalog,
+    UnknownItemError,
+)
+from utils.db_async import make_async_session
+from utils.logging import LOGGER
+from utils.orm import (
+    Iteration,
+    Response,
+)
+from utils.reminders import due_times
+from utils.replies import (
+    fetch_sent_reply,
+    record_sent_reply,
+)
+
+INVALID_ANSWER_TEXT: str = "Husk svare med blot èt heltal fra listen ovenfor."
+
+# TODO: consider to mention we'll be in touch again
+NO_OPEN_ITEMS_TEXT: str = inspect.cleandoc(
+    """\
+    Der ser ikke ud til at være nogle åbne spørgsmål til dig.
+    Svar 'Restart' for at starte forfra.\
+    """
+)
+
+# When the step can't be taken (see conversation_step); nothing has changed,
+# so the answer can simply be sent again
+TRY_AGAIN_TEXT: str = (
+    "Vi kunne ikke modtage dit svar lige nu. Prøv igen senere."
+)
+
+
+class ConversationStep(NamedTuple):
+    """Outcome of handling one inbound message"""
+
+    outbound_body: str
+    awaiting_response_id: Optional[int]  # None if nothing is left to answer
+    # The message was handled before (a retry by the gateway); outbound_body
+    # is the reply sent then, and nothing changed now
+    is_duplicate: bool = False
+
+
+async def lock_phone_number(
+    connection: AsyncConnection | AsyncSession, phone_number: str
+) -> None:
+    """
+    Serialise transactions for phone_number across workers and replicas, until
+    the transaction ends. A separate statement, so that the statements after
+    it see what the previous holder committed.
+    """
+
+    lock_id = func.hashtext(phone_number)
+    await connection.execute(select(func.pg_advisory_xact_lock(lock_id)))
+
+
+def build_step_statement(
+    phone_number: str, parsed_response: Optional[int]
+) -> Select:
+    """
+    Build the single statement that moves a conversation one step forward.
+
+    Data-modifying CTEs close the awaiting response (if the answer is valid)
+    and mark the next open item as awaiting. All CTEs see the same snapshot,
+    so the row closed here is still 'awaiting' when the next 'open' item is
+    picked. Returns the marked
+    response and its item_id, whose text is in the catalog, or else the
+    body to reply with and the response still awaiting an answer.
+    """
+
+    awaiting = (
+        select(Response.response_id)
+        .where(
+            and_(
+                Response.phone_number == phone_number,
+                Response.status == "awaiting",
+            )
+        )
+        .order_by(Response.response_id)
+        .limit(1)
+        .with_for_update()
+        .cte("awaiting")
+    )
+    is_awaiting = exists(select(awaiting.c.response_id))
+
+    next_item = (
+        select(Response.response_id)
+        .where(
+            and_(
+                Response.phone_number == phone_number,
+                Response.status == "open",
+            )
+        )
+        .order_by(Response.response_id)
+        .limit(1)
+        .with_for_update()
+    )
+    extra_ctes = []
+
+    if parsed_response is None:
+        # An invalid answer keeps the current item awaiting, but anything
+        # will do when we're not waiting for an answer (e.g. the invitation)
+        next_item = next_item.where(~is_awaiting)
+        fallback_body = case(
+            (is_awaiting, literal(INVALID_ANSWER_TEXT)),
+            else_=literal(NO_OPEN_ITEMS_TEXT),
+        )
+        still_awaiting = select(awaiting.c.response_id).scalar_subquery()
+    else:
+        closed = (
+            update(Response)
+            .where(Response.response_id.in_(select(awaiting.c.response_id)))
+            .values(
+                response=parsed_response, status="closed", updated_by="fastapi"
+            )
+        )
+        extra_ctes.append(closed.cte("closed"))
+        fallback_body = literal(NO_OPEN_ITEMS_TEXT)
+        still_awaiting = null()
+
+    next_item = next_item.cte("next_item")
+    marked = (
+        update(Response)
+        .where(Response.response_id == next_item.c.response_id)
+        .values(status="awaiting", updated_by="fastapi", **due_times())
+        .returning(Response.response_id, Response.item_id)
+        .cte("marked")
+    )
+
+    return select(
+        select(marked.c.response_id).scalar_subquery().label("marked_id"),
+        select(marked.c.item_id).scalar_subquery().label("item_id"),
+        fallback_body.label("fallback_body"),
+        still_awaiting.label("still_awaiting_id"),
+    ).add_cte(*extra_ctes)
+
+
+async def conversation_step(
+    engine: AsyncEngine,
+    phone_number: str,
+    parsed_response: Optional[int],
+    catalog: InstrumentCatalog,
+    reply_key: str = None,
+) -> ConversationStep:
+    """
+    Handle an inbound answer atomically, in one transaction, unless the
+    message reply_key identifies was handled before. If the next item
+    doesn't exist, the step is rolled back and the respondent asked to try
+    again.
+    """
+
+    stmt = build_step_statement(phone_number, parsed_response)
+    try:
+        async with make_async_session(engine) as session:
+            await lock_phone_number(session, phone_number)
+            sent_reply = await fetch_sent_reply(session, reply_key)
+            if sent_reply is not None:
+                return ConversationStep(sent_reply, None, is_duplicate=True)
+
+            row = (await session.execute(stmt)).one()
+
+            if row.marked_id is not None:
+                item_text = await catalog.resolve_item_text(
+                    session, row.item_id
+                )
+                step = ConversationStep(item_text, row.marked_id)
+            else:
+                body, awaiting_id = row.fallback_body, row.still_awaiting_id
+                step = ConversationStep(body, awaiting_id)
+
+            await record_sent_reply(
+                session, reply_key, phone_number, step.outbound_body
+            )
+    except UnknownItemError as e:
+        LOGGER.error(f"Conversation step for {phone_number} failed: {e}")
+        return ConversationStep(TRY_AGAIN_TEXT, None)
+
+    return step
+
+
+async def reject_answer(
+    engine: AsyncEngine, awaiting_response_id: int, reply_key: str = None
+) -> ConversationStep:
+    """
+    Ask for a valid answer again; nothing changes state. Unless the message
+    was handled before, i.e. while nothing was awaited: the awaiting state
+    is only known after that step committed, so its reply is already there.
+    """
+
+    if reply_key is not None:
+        async with make_async_session(engine) as session:
+            sent_reply = await fetch_sent_reply(session, reply_key)
+        if sent_reply is not None:
+            return ConversationStep(sent_reply, None, is_duplicate=True)
+
+    return ConversationStep(INVALID_ANSWER_TEXT, awaiting_response_id)
+
+
+async def restart_conversation(
+    engine: AsyncEngine, phone_number: str, reply_key: str = None
+) -> ConversationStep:
+    """Reopen all items of a recipient, in a single transaction"""
+
+    async with make_async_session(engine) as session:
+        await lock_phone_number(session, phone_number)
+        sent_reply = await fetch_sent_reply(session, reply_key)
+        if sent_reply is not None:
+            return ConversationStep(sent_reply, None, is_duplicate=True)
+
+        stmt = (
+            update(Iteration)
+            .where(Iteration.phone_number == phone_number)
+            .values(is_open=False, updated_by="fastapi")
+        )
+        await session.execute(stmt)
+
+        stmt = (
+            update(Response)
+            .where(Response.phone_number == phone_number)
+            .values(status="open", response=None, updated_by="fastapi")
+        )
+        await session.execute(stmt)
+
+        stmt = (
+            select(Iteration.message_body)
+            .where(
+                and_(
+                    Iteration.phone_number == phone_number,
+                    Iteration.is_open,
+                )
+            )
+            .order_by(Iteration.iteration_id.desc())
+        )
+        outbound_body = (await session.scalars(stmt)).first()
+        await record_sent_reply(
+            session, reply_key, phone_number, outbound_body or ""
+        )
+
+    return ConversationStep(outbound_body, None)
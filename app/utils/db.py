@@ -1,40 +1,55 @@
+import os
+import threading
+import time
 from contextlib import contextmanager
+from functools import partial
 from typing import (
+    BinaryIO,
+    Callable,
     Final,
     Iterator,
     NamedTuple,
     Optional,
 )
 
-from dotenv import load_dotenv
 from sqlalchemy import create_engine
 from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.session import Session as SQLAlchemySession
+from sqlalchemy.pool import QueuePool
+from utils.config import read_secret
 
-load_dotenv(".env")
-
-with open("/run/secrets/postgres_password", "r") as f:
-    POSTGRES_PASSWORD: str = f.readline()
-
+# The password is read from the postgres_password secret when connecting,
+# unless given (as for the test database, with TEST_DB_PASSWORD)
 DB_CONN_PARAMS: dict = {
-    "dbname": "postgres",
-    "user": "postgres",
-    "password": POSTGRES_PASSWORD,
-    "host": "db",
-    "port": "5432",
+    "dbname": os.getenv("DB_NAME", "postgres"),
+    "user": os.getenv("DB_USER", "postgres"),
+    "host": os.getenv("DB_HOST", "db"),
+    "port": os.getenv("DB_PORT", "5432"),
 }
 
 DB_CONN_PARAMS_TEST: dict = {
-    "dbname": "postgres",
-    "user": "postgres",
-    "password": POSTGRES_PASSWORD,
-    "host": "db",
-    "port": "6432",
+    "dbname": os.getenv("TEST_DB_NAME", "postgres"),
+    "user": os.getenv("TEST_DB_USER", "postgres"),
+    "host": os.getenv("TEST_DB_HOST", "db"),
+    "port": os.getenv("TEST_DB_PORT", "6432"),
 }
+if os.getenv("TEST_DB_PASSWORD") is not None:
+    DB_CONN_PARAMS_TEST["password"] = os.getenv("TEST_DB_PASSWORD")
 
 PROD_SCHEMA: Final[str] = "prod"
 
+# Keep pool_size + max_overflow, summed over all services, below
+# max_connections in postgres/postgresql.conf
+POOL_SETTINGS: dict = {
+    "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+    "max_overflow": int(os.getenv("DB_POOL_MAX_OVERFLOW", "2")),
+    "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() == "true",
+}
+
 
 class ConnectionDetails(NamedTuple):
     """A simple type for storing connection details"""
@@ -48,6 +63,115 @@ class ConnectionDetails(NamedTuple):
     schema: Optional[str] = ""
 
 
+def connection_details(params: dict) -> ConnectionDetails:
+    if "password" in params:
+        return ConnectionDetails(**params)
+    return ConnectionDetails(
+        password=read_secret("postgres_password"), **params
+    )
+
+
+class TimedPoolMixin:
+    """Keeps track of how long checkouts wait for a pooled connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._wait_lock = threading.Lock()
+        self.n_checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            with self._wait_lock:
+                self.n_checkouts += 1
+                self.wait_seconds_total += waited
+                self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    pass
+
+
+# Engines and sessionmakers live for the lifetime of the process, so that
+# requests share pooled connections instead of reconnecting every time
+_ENGINES: dict = {}
+_SESSIONMAKERS: dict = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+def get_or_create_engine(url: str, factory: Callable):
+    """Return the engine registered for url, creating it on first use"""
+
+    with _REGISTRY_LOCK:
+        if url not in _ENGINES:
+            _ENGINES[url] = factory(url)
+        return _ENGINES[url]
+
+
+def get_or_create_sessionmaker(bind, factory: Callable):
+    """
+    Return the sessionmaker bound to bind, creating it on first use if bind
+    is an engine. Connections (e.g. a test's) come and go, so they get one
+    of their own that isn't kept.
+    """
+
+    if not isinstance(bind, (Engine, AsyncEngine)):
+        return factory(bind=bind)
+    with _REGISTRY_LOCK:
+        if bind not in _SESSIONMAKERS:
+            _SESSIONMAKERS[bind] = factory(bind=bind)
+        return _SESSIONMAKERS[bind]
+
+
+def registered_engines() -> list:
+    with _REGISTRY_LOCK:
+        return list(_ENGINES.values())
+
+
+def unregister_engines(engine_type: type) -> list:
+    """Remove engines of the given type (and their sessionmakers)"""
+
+    engines = []
+    with _REGISTRY_LOCK:
+        for url, engine in list(_ENGINES.items()):
+            if isinstance(engine, engine_type):
+                engines.append(_ENGINES.pop(url))
+                _SESSIONMAKERS.pop(engine, None)
+    return engines
+
+
+def dispose_engines() -> None:
+    """Close all pooled connections, e.g. when the process shuts down"""
+
+    for engine in unregister_engines(Engine):
+        engine.dispose()
+
+
+def pool_stats(engine) -> dict:
+    """Current usage of an engine's connection pool, for sizing it"""
+
+    pool = engine.pool
+    stats = {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+    }
+    if isinstance(pool, TimedPoolMixin):
+        with pool._wait_lock:
+            stats.update(
+                n_checkouts=pool.n_checkouts,
+                wait_seconds_total=pool.wait_seconds_total,
+                wait_seconds_max=pool.wait_seconds_max,
+            )
+    return stats
+
+
 def _create_engine(
     user: Optional[str] = "postgres",
     password: Optional[str] = "",
@@ -58,18 +182,23 @@ def _create_engine(
     schema: Optional[str] = None,  # we do this in ProcusBase
     **kwargs,
 ) -> Engine:
-    """Create a Postgres database engine based on connection details"""
-    url = f"{dbms}://{user}:{password}@{host}:{port}/{dbname}"
-    return create_engine(url)
+    """Get the pooled Postgres database engine for the connection details"""
+    url = f"{dbms}+psycopg2://{user}:{password}@{host}:{port}/{dbname}"
+    return get_or_create_engine(
+        url,
+        lambda url: create_engine(
+            url, poolclass=TimedQueuePool, **POOL_SETTINGS
+        ),
+    )
 
 
 def make_engine() -> Engine:
-    cnxn = ConnectionDetails(**DB_CONN_PARAMS)
+    cnxn = connection_details(DB_CONN_PARAMS)
     return _create_engine(**cnxn._asdict())
 
 
 def make_engine_test() -> Engine:
-    cnxn = ConnectionDetails(**DB_CONN_PARAMS_TEST)
+    cnxn = connection_details(DB_CONN_PARAMS_TEST)
     return _create_engine(**cnxn._asdict())
 
 
@@ -77,7 +206,9 @@ def make_engine_test() -> Engine:
 def make_session(engine: Engine) -> Iterator[SQLAlchemySession]:
     """Provide a transactional scope around a series of operations."""
 
-    Session = sessionmaker(bind=engine)
+    Session = get_or_create_sessionmaker(
+        engine, partial(sessionmaker, expire_on_commit=False)
+    )
     session = Session()
     try:
         yield session
@@ -86,3 +217,21 @@ def make_session(engine: Engine) -> Iterator[SQLAlchemySession]:
         session.rollback()
     finally:
         session.close()
+
+
+def _driver_cursor(session: SQLAlchemySession):
+    """A cursor on the session's connection, i.e. in its transaction"""
+
+    return session.connection().connection.driver_connection.cursor()
+
+
+def copy_out(session: SQLAlchemySession, statement: str, file: BinaryIO):
+    """Run a COPY ... TO STDOUT statement into file"""
+
+    _driver_cursor(session).copy_expert(statement, file)
+
+
+def copy_in(session: SQLAlchemySession, statement: str, file: BinaryIO):
+    """Run a COPY ... FROM STDIN statement reading file"""
+
+    _driver_cursor(session).copy_expert(statement, file)
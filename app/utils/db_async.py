@@ -0,0 +1,93 @@
+import os
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import (
+    AsyncIterator,
+    Optional,
+)
+
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from utils.db import (
+    DB_CONN_PARAMS,
+    DB_CONN_PARAMS_TEST,
+    POOL_SETTINGS,
+    TimedPoolMixin,
+    connection_details,
+    get_or_create_engine,
+    get_or_create_sessionmaker,
+    unregister_engines,
+)
+
+# asyncpg prepares every statement server-side, and keeps this many of them
+# per connection
+DB_STATEMENT_CACHE_SIZE: int = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+
+
+class TimedAsyncQueuePool(TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def _create_async_engine(
+    user: Optional[str] = "postgres",
+    password: Optional[str] = "",
+    host: Optional[str] = "localhost",
+    dbms: Optional[str] = "postgresql",
+    dbname: Optional[str] = "postgres",
+    port: Optional[int] = 5432,
+    schema: Optional[str] = None,  # we do this in ProcusBase
+    **kwargs,
+) -> AsyncEngine:
+    """Get the pooled async Postgres engine for the connection details"""
+    query = f"prepared_statement_cache_size={DB_STATEMENT_CACHE_SIZE}"
+    url = f"{dbms}+asyncpg://{user}:{password}@{host}:{port}/{dbname}?{query}"
+    return get_or_create_engine(
+        url,
+        lambda url: create_async_engine(
+            url, poolclass=TimedAsyncQueuePool, **POOL_SETTINGS
+        ),
+    )
+
+
+def make_async_engine() -> AsyncEngine:
+    cnxn = connection_details(DB_CONN_PARAMS)
+    return _create_async_engine(**cnxn._asdict())
+
+
+def make_async_engine_test() -> AsyncEngine:
+    cnxn = connection_details(DB_CONN_PARAMS_TEST)
+    return _create_async_engine(**cnxn._asdict())
+
+
+async def dispose_async_engines() -> None:
+    """Close all pooled async connections, from within the event loop"""
+
+    for engine in unregister_engines(AsyncEngine):
+        await engine.dispose()
+
+
+@asynccontextmanager
+async def make_async_session(
+    engine: AsyncEngine,
+) -> AsyncIterator[AsyncSession]:
+    """
+    Provide a transactional scope around a series of operations, without
+    blocking the event loop while waiting for the database.
+    """
+
+    Session = get_or_create_sessionmaker(
+        engine, partial(async_sessionmaker, expire_on_commit=False)
+    )
+    session = Session()
+    try:
+        yield session
+        await session.commit()
+    except AttributeError:
+        await session.rollback()
+    finally:
+        await session.close()
@@ -0,0 +1,326 @@
+import csv
+import io
+import json
+import os
+import re
+from datetime import datetime
+from typing import (
+    BinaryIO,
+    Iterator,
+    NamedTuple,
+    Optional,
+)
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    Table,
+    Text,
+    and_,
+    exists,
+    false,
+    literal,
+    not_,
+    select,
+    text,
+)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine import Engine
+from utils.db import (
+    copy_in,
+    make_session,
+)
+from utils.orm import (
+    Instrument,
+    Iteration,
+    Recipient,
+)
+
+ENROLLMENT_FORMATS: tuple = ("csv", "jsonl")
+ENROLLMENT_COLUMNS: list = [
+    "phone_number",
+    "full_name",
+    "instrument_id",
+    "opens_datetime",
+    "message_body",
+]
+
+# Prepended to phone numbers given without one; CPSMS wants the country code
+# without + or 00
+DEFAULT_COUNTRY_CODE: str = os.getenv("DEFAULT_COUNTRY_CODE", "45")
+# How opens_datetime without a UTC offset is read (by the database)
+ENROLLMENT_TIMEZONE: str = os.getenv("ENROLLMENT_TZ", "Europe/Copenhagen")
+MAX_MESSAGE_BODY_LENGTH: int = 720
+
+_PHONE_NUMBER_SEPARATORS = re.compile(r"[\s\-().]")
+
+# Dropped when the enrollment transaction ends
+_staging = Table(
+    "enrollment_staging",
+    MetaData(),
+    Column("row_number", Integer, primary_key=True, autoincrement=False),
+    Column("phone_number", Text, nullable=False),
+    Column("full_name", Text, nullable=False),
+    Column("instrument_id", Integer, nullable=False),
+    Column("opens_datetime", DateTime(timezone=True), nullable=False),
+    Column("message_body", Text, nullable=False),
+    prefixes=["TEMPORARY"],
+    postgresql_on_commit="DROP",
+)
+
+
+class RowError(NamedTuple):
+    row_number: int  # 1 for the first row after the header, if any
+    message: str
+
+
+class EnrollmentReport(NamedTuple):
+    n_rows: int
+    n_recipients_created: int
+    n_iterations_created: int
+    already_scheduled: list[int]  # row numbers, skipped
+    errors: list[RowError]  # rows not enrolled
+
+    def to_json(self) -> dict:
+        report = self._asdict()
+        report["errors"] = [error._asdict() for error in self.errors]
+        return report
+
+
+def normalize_phone_number(phone_number: str) -> Optional[str]:
+    """Digits only, with country code, or None if it can't be valid"""
+
+    digits = _PHONE_NUMBER_SEPARATORS.sub("", phone_number or "")
+    if digits.startswith("+"):
+        digits = digits[1:]
+    elif digits.startswith("00"):
+        digits = digits[2:]
+    elif len(digits) == 8:  # a national number
+        digits = DEFAULT_COUNTRY_CODE + digits
+
+    if not digits.isdigit() or not 8 < len(digits) <= 15:  # E.164
+        return None
+    return digits
+
+
+def read_rows(file: BinaryIO, format: str) -> Iterator[tuple[int, dict]]:
+    """(row number, row) from a CSV file with a header, or a JSONL file"""
+
+    text_file = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    if format == "csv":
+        reader = csv.DictReader(text_file)
+        missing = set(ENROLLMENT_COLUMNS) - set(reader.fieldnames or [])
+        if missing:
+            raise ValueError(f"Missing columns: {', '.join(sorted(missing))}")
+        yield from enumerate(reader, start=1)
+    elif format == "jsonl":
+        for row_number, line in enumerate(text_file, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                row = None
+            yield row_number, row if isinstance(row, dict) else None
+    else:
+        raise ValueError(f"Unknown enrollment format: {format}")
+
+
+def validate_row(row: Optional[dict]) -> tuple[Optional[dict], Optional[str]]:
+    """The row as staged, or the reason it can't be"""
+
+    if row is None:
+        return None, "Not a JSON object"
+
+    phone_number = normalize_phone_number(str(row.get("phone_number") or ""))
+    if phone_number is None:
+        return None, f"Invalid phone number: {row.get('phone_number')!r}"
+
+    full_name = str(row.get("full_name") or "").strip()
+    if not full_name:
+        return None, "Missing full_name"
+
+    try:
+        instrument_id = int(row.get("instrument_id"))
+    except (TypeError, ValueError):
+        return None, f"Invalid instrument_id: {row.get('instrument_id')!r}"
+
+    try:
+        opens_datetime = datetime.fromisoformat(str(row.get("opens_datetime")))
+    except ValueError:
+        return None, f"Invalid opens_datetime: {row.get('opens_datetime')!r}"
+
+    message_body = str(row.get("message_body") or "").strip()
+    if not message_body:
+        return None, "Missing message_body"
+    if len(message_body) > MAX_MESSAGE_BODY_LENGTH:
+        return None, f"message_body is over {MAX_MESSAGE_BODY_LENGTH} chars"
+
+    return (
+        dict(
+            phone_number=phone_number,
+            full_name=full_name,
+            instrument_id=instrument_id,
+            opens_datetime=opens_datetime,  # may lack a UTC offset
+            message_body=message_body,
+        ),
+        None,
+    )
+
+
+def validate_rows(
+    rows: Iterator[tuple[int, dict]]
+) -> tuple[dict, list[RowError]]:
+    """
+    Valid rows, by row number, and errors for the others. Of rows scheduling
+    the same recipient for the same instrument and time, only the first is
+    kept; a recipient must have the same name in all rows.
+    """
+
+    valid: dict = {}
+    errors: list = []
+    first_rows: dict = {}  # schedule: row number
+    full_names: dict = {}  # phone number: (full name, row number)
+    for row_number, row in rows:
+        staged, error = validate_row(row)
+        if staged is not None:
+            phone_number = staged["phone_number"]
+            schedule = (
+                phone_number,
+                staged["instrument_id"],
+                staged["opens_datetime"],
+            )
+            full_name, name_row = full_names.setdefault(
+                phone_number, (staged["full_name"], row_number)
+            )
+            if schedule in first_rows:
+                error = f"Duplicate of row {first_rows[schedule]}"
+            elif full_name != staged["full_name"]:
+                error = f"full_name differs from row {name_row}"
+            else:
+                first_rows[schedule] = row_number
+
+        if error is None:
+            valid[row_number] = staged
+        else:
+            errors.append(RowError(row_number, error))
+    return valid, errors
+
+
+def to_copy_file(rows: dict) -> BinaryIO:
+    """Rows as CSV for COPY, in the column order of the staging table"""
+
+    file = io.BytesIO()
+    text_file = io.TextIOWrapper(file, encoding="utf-8", newline="")
+    writer = csv.writer(text_file)
+    for row_number, row in rows.items():
+        row = dict(row, opens_datetime=row["opens_datetime"].isoformat())
+        writer.writerow([row_number] + [row[c] for c in ENROLLMENT_COLUMNS])
+    text_file.detach()
+    file.seek(0)
+    return file
+
+
+def enroll(engine: Engine, file: BinaryIO, format: str) -> EnrollmentReport:
+    """
+    Enroll recipients and schedule their iterations from a CSV or JSONL file
+    with ENROLLMENT_COLUMNS, one scheduled iteration per row. Rows are
+    validated here, then loaded through COPY into a staging table and merged
+    into prod.recipients and prod.iterations in one transaction. Rows that
+    can't be enrolled are reported instead of failing the whole file. Known
+    recipients keep their name, and iterations already scheduled (same
+    recipient, instrument and opens_datetime) are skipped, so a file can
+    safely be loaded again.
+    """
+
+    rows, errors = validate_rows(read_rows(file, format))
+    n_rows = len(rows) + len(errors)
+    if not rows:
+        return EnrollmentReport(n_rows, 0, 0, [], sorted(errors))
+
+    s = _staging.c
+    with make_session(engine) as session:
+        session.execute(
+            text("SELECT set_config('TimeZone', :tz, true)"),
+            {"tz": ENROLLMENT_TIMEZONE},
+        )
+        _staging.create(session.connection())
+        columns = ", ".join(["row_number"] + ENROLLMENT_COLUMNS)
+        copy_in(
+            session,
+            f"COPY {_staging.name} ({columns}) FROM STDIN WITH (FORMAT csv)",
+            to_copy_file(rows),
+        )
+        # Temporary tables aren't analyzed automatically, and the merge below
+        # should be planned as joins of whole tables, not row by row
+        session.execute(text(f"ANALYZE {_staging.name}"))
+
+        # Unknown or inactive instruments
+        is_active = exists().where(
+            and_(
+                Instrument.instrument_id == s.instrument_id,
+                Instrument.is_active,
+            )
+        )
+        invalid = _staging.delete().where(not_(is_active))
+        for row_number, instrument_id in session.execute(
+            invalid.returning(s.row_number, s.instrument_id)
+        ):
+            message = f"Unknown or inactive instrument_id: {instrument_id}"
+            errors.append(RowError(row_number, message))
+
+        is_scheduled = exists().where(
+            and_(
+                Iteration.phone_number == s.phone_number,
+                Iteration.instrument_id == s.instrument_id,
+                Iteration.opens_datetime == s.opens_datetime,
+            )
+        )
+        already_scheduled = list(
+            session.scalars(
+                _staging.delete().where(is_scheduled).returning(s.row_number)
+            )
+        )
+
+        recipients = (
+            insert(Recipient)
+            .from_select(
+                ["phone_number", "full_name"],
+                select(s.phone_number, s.full_name)
+                .distinct(s.phone_number)
+                .order_by(s.phone_number, s.row_number),
+            )
+            .on_conflict_do_nothing(index_elements=["phone_number"])
+            .returning(Recipient.phone_number)
+        )
+        n_recipients = len(session.scalars(recipients).all())
+
+        iterations = insert(Iteration).from_select(
+            [
+                "instrument_id",
+                "phone_number",
+                "message_body",
+                "is_open",
+                "opens_datetime",
+                "updated_by",
+            ],
+            select(
+                s.instrument_id,
+                s.phone_number,
+                s.message_body,
+                false(),
+                s.opens_datetime,
+                literal("enrollment"),
+            ).order_by(s.row_number),
+        )
+        n_iterations = session.execute(iterations).rowcount
+
+    return EnrollmentReport(
+        n_rows,
+        n_recipients,
+        n_iterations,
+        sorted(already_scheduled),
+        sorted(errors),
+    )
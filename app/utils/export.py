@@ -0,0 +1,291 @@
+import csv
+import io
+import os
+from datetime import datetime
+from itertools import islice
+from typing import (
+    BinaryIO,
+    Iterable,
+    Iterator,
+    Optional,
+)
+
+from sqlalchemy import (
+    and_,
+    column,
+    func,
+    select,
+    table,
+)
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import Select
+from utils.db import make_session
+from utils.orm import (
+    Item,
+    Iteration,
+    Response,
+)
+
+try:  # only needed for Parquet, which is optional
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+EXPORT_FORMATS: tuple = ("csv", "parquet")
+EXPORT_MEDIA_TYPES: dict = {
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+# Rows fetched per round trip from the server-side cursor, and iterations per
+# chunk written (i.e. per Parquet row group); together they bound the memory
+EXPORT_YIELD_PER: int = int(os.getenv("EXPORT_YIELD_PER", "10000"))
+EXPORT_CHUNK_SIZE: int = int(os.getenv("EXPORT_CHUNK_SIZE", "5000"))
+
+ITERATION_COLUMNS: list = [
+    "iteration_id",
+    "phone_number",
+    "opens_datetime",
+    "last_changed",
+]
+
+_pg_stat_activity = table(
+    "pg_stat_activity",
+    column("pid"),
+    column("datname"),
+    column("xact_start"),
+)
+
+
+def item_column(item_id: int) -> str:
+    return f"item_{item_id}"
+
+
+def select_item_ids(instrument_id: int) -> Select:
+    return (
+        select(Item.item_id)
+        .where(Item.instrument_id == instrument_id)
+        .order_by(Item.item_id)
+    )
+
+
+def select_watermark() -> Select:
+    """
+    Where the next incremental export should start. Rows get the start of the
+    transaction changing them as lower(sys_period), so transactions still in
+    progress hold the watermark back; they would be missed otherwise.
+    """
+
+    oldest_transaction = (
+        select(func.min(_pg_stat_activity.c.xact_start))
+        .where(
+            and_(
+                _pg_stat_activity.c.datname == func.current_database(),
+                _pg_stat_activity.c.pid != func.pg_backend_pid(),
+            )
+        )
+        .scalar_subquery()
+    )
+    return select(func.least(func.now(), oldest_transaction))
+
+
+def select_responses(instrument_id: int, since: datetime = None) -> Select:
+    """
+    Answers to the items of an instrument, ordered so that the responses of
+    each iteration come together. With since, only iterations with responses
+    changed since then (lower(sys_period) covers created_datetime, too).
+    """
+
+    stmt = (
+        select(
+            Response.iteration_id,
+            Iteration.phone_number,
+            Iteration.opens_datetime,
+            Response.item_id,
+            Response.response,
+            func.lower(Response.sys_period).label("changed"),
+        )
+        .join(Iteration, Iteration.iteration_id == Response.iteration_id)
+        .where(
+            and_(
+                Iteration.instrument_id == instrument_id,
+                Response.item_id.is_not(None),
+            )
+        )
+        .order_by(Response.iteration_id, Response.response_id)
+    )
+
+    if since is not None:
+        changed = select(Response.iteration_id).where(
+            func.lower(Response.sys_period) > since
+        )
+        stmt = stmt.where(Response.iteration_id.in_(changed))
+
+    return stmt
+
+
+def pivot(rows: Iterable, item_ids: list[int]) -> Iterator[dict]:
+    """
+    One wide row per iteration, with one column per item in item_ids; answers
+    to other items are left out. Needs rows ordered by iteration and only
+    holds one iteration at a time.
+    """
+
+    empty = dict.fromkeys(item_column(item_id) for item_id in item_ids)
+    wide = None
+    for row in rows:
+        if wide is None or wide["iteration_id"] != row.iteration_id:
+            if wide is not None:
+                yield wide
+            wide = dict(
+                iteration_id=row.iteration_id,
+                phone_number=row.phone_number,
+                opens_datetime=row.opens_datetime,
+                last_changed=row.changed,
+                **empty,
+            )
+        wide["last_changed"] = max(wide["last_changed"], row.changed)
+        if item_column(row.item_id) in empty:
+            wide[item_column(row.item_id)] = row.response
+
+    if wide is not None:
+        yield wide
+
+
+def chunked(rows: Iterable, size: int) -> Iterator[list]:
+    rows = iter(rows)
+    while chunk := list(islice(rows, size)):
+        yield chunk
+
+
+class CsvChunkWriter:
+    def __init__(self, file: BinaryIO, columns: list[str]):
+        self._text = io.TextIOWrapper(
+            file, encoding="utf-8", newline="", write_through=True
+        )
+        self._writer = csv.DictWriter(self._text, fieldnames=columns)
+        self._writer.writeheader()
+
+    def write(self, rows: list[dict]) -> None:
+        self._writer.writerows(rows)
+
+    def close(self) -> None:
+        self._text.detach()  # leave file open for the caller
+
+
+class ParquetChunkWriter:
+    """Writes each chunk as a row group"""
+
+    def __init__(self, file: BinaryIO, columns: list[str]):
+        fields = [
+            ("iteration_id", pyarrow.int64()),
+            ("phone_number", pyarrow.string()),
+            ("opens_datetime", pyarrow.timestamp("us", tz="UTC")),
+            ("last_changed", pyarrow.timestamp("us", tz="UTC")),
+        ] + [(name, pyarrow.int64()) for name in columns[4:]]
+        self._schema = pyarrow.schema(fields)
+        self._writer = pyarrow.parquet.ParquetWriter(file, self._schema)
+
+    def write(self, rows: list[dict]) -> None:
+        table = pyarrow.Table.from_pylist(rows, schema=self._schema)
+        self._writer.write_table(table)
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+class ChunkBuffer(io.RawIOBase):
+    """A write-only file whose contents are taken out chunk by chunk"""
+
+    def __init__(self):
+        self._data = bytearray()
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._data += data
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = bytes(self._data)
+        self._data.clear()
+        return data
+
+
+class ResponseExport:
+    """
+    The answers to an instrument in wide format, one row per iteration and one
+    column per item, written chunk by chunk from a server-side cursor, so
+    memory stays constant however large the study. Pass the watermark of an
+    export as since to the next one to only get what changed in between;
+    iterations may then be exported again, with their latest answers.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        instrument_id: int,
+        format: str = "csv",
+        since: datetime = None,
+        chunk_size: int = EXPORT_CHUNK_SIZE,
+    ):
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format: {format}")
+        if format == "parquet" and pyarrow is None:
+            raise RuntimeError("Exporting to Parquet requires pyarrow")
+
+        self.engine = engine
+        self.instrument_id = instrument_id
+        self.format = format
+        self.since = since
+        self.chunk_size = chunk_size
+        self.watermark: Optional[datetime] = None
+        self.n_iterations = 0
+
+    def write_chunks(self, file: BinaryIO) -> Iterator[int]:
+        """Write to file, yielding the number of iterations after each chunk"""
+
+        with make_session(self.engine) as session:
+            # One snapshot for all three, so the items are those answered
+            session.connection(
+                execution_options={"isolation_level": "REPEATABLE READ"}
+            )
+            self.watermark = session.scalar(select_watermark())
+            item_ids = list(
+                session.scalars(select_item_ids(self.instrument_id))
+            )
+            columns = ITERATION_COLUMNS + [item_column(i) for i in item_ids]
+
+            rows = session.execute(
+                select_responses(self.instrument_id, self.since),
+                execution_options={"yield_per": EXPORT_YIELD_PER},
+            )
+            if self.format == "parquet":
+                writer = ParquetChunkWriter(file, columns)
+            else:
+                writer = CsvChunkWriter(file, columns)
+
+            for chunk in chunked(pivot(rows, item_ids), self.chunk_size):
+                writer.write(chunk)
+                self.n_iterations += len(chunk)
+                yield len(chunk)
+            writer.close()
+
+    def write(self, file: BinaryIO) -> None:
+        for _ in self.write_chunks(file):
+            pass
+
+    def stream(self) -> Iterator[bytes]:
+        """The export as bytes, e.g. for a streaming HTTP response"""
+
+        buffer = ChunkBuffer()
+        for _ in self.write_chunks(buffer):
+            yield buffer.drain()
+        yield buffer.drain()
@@ -0,0 +1,209 @@
+import io
+import json
+import logging
+import os
+import threading
+from datetime import (
+    datetime,
+    timezone,
+)
+
+import psycopg2
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import (
+    DataError,
+    IntegrityError,
+)
+from utils.batching import BatchWriter
+from utils.db import (
+    copy_in,
+    make_engine,
+    make_session,
+)
+
+# Never the database logger: it fails for the same reasons the journal does
+_LOGGER: logging.Logger = logging.getLogger(__name__)
+
+MESSAGE_JOURNAL_BATCH_SIZE: int = int(
+    os.getenv("MESSAGE_JOURNAL_BATCH_SIZE", "1000")
+)
+MESSAGE_JOURNAL_FLUSH_SECONDS: float = float(
+    os.getenv("MESSAGE_JOURNAL_FLUSH_SECONDS", "1")
+)
+MESSAGE_JOURNAL_BUFFER_SIZE: int = int(
+    os.getenv("MESSAGE_JOURNAL_BUFFER_SIZE", "100000")
+)
+# Where messages go while the database can't be written to; without one,
+# they are lost then
+MESSAGE_JOURNAL_SPILL_PATH: str = os.getenv(
+    "MESSAGE_JOURNAL_SPILL_PATH", "/persistent_storage/message_journal.jsonl"
+)
+# Where messages the database rejects go (e.g. from a number that isn't a
+# recipient); without one, they are only logged
+MESSAGE_JOURNAL_QUARANTINE_PATH: str = os.getenv(
+    "MESSAGE_JOURNAL_QUARANTINE_PATH",
+    "/persistent_storage/message_journal_rejected.jsonl",
+)
+
+# The database rejected the data, rather than being unreachable; raised by
+# psycopg2 through copy_in, or by SQLAlchemy
+DATA_ERRORS: tuple = (
+    DataError,
+    IntegrityError,
+    psycopg2.DataError,
+    psycopg2.IntegrityError,
+)
+
+MESSAGE_COLUMNS: list = [
+    "sent_datetime",
+    "phone_number",
+    "message_body",
+    "direction",
+]
+
+
+def to_csv(messages: list[tuple]) -> bytes:
+    """
+    Messages as CSV for COPY. Strings are quoted, so that an empty body stays
+    empty, and None becomes NULL.
+    """
+
+    def field(value) -> str:
+        if value is None:
+            return ""
+        return '"' + str(value).replace('"', '""') + '"'
+
+    lines = (",".join(map(field, message)) + "\n" for message in messages)
+    return "".join(lines).encode("utf-8")
+
+
+class MessageJournal:
+    """
+    Writes messages to prod.messages from a background thread, with COPY,
+    whenever batch_size of them are waiting or flush_seconds have passed. The
+    messages table is an audit log, not conversation state, so journaling a
+    message costs the caller an enqueue rather than a commit.
+
+    Messages keep the time they were recorded. Messages that can't be written
+    because the database can't be reached are kept in spill_path (if given),
+    and written, in a statement of their own, ahead of the next batch.
+    Messages the database rejects are found by halving the batch, and moved
+    to quarantine_path (if given), so they hold up neither the rest of their
+    batch nor later ones. Whatever is buffered is flushed on stop() and when
+    the interpreter exits.
+
+    record() is called from the event loop, so it never waits: if the buffer
+    is full, because neither the database nor the spill file keeps up, the
+    message is dropped and counted in writer.n_dropped.
+    """
+
+    def __init__(
+        self,
+        engine: Engine = None,
+        batch_size: int = MESSAGE_JOURNAL_BATCH_SIZE,
+        flush_seconds: float = MESSAGE_JOURNAL_FLUSH_SECONDS,
+        max_buffer_size: int = MESSAGE_JOURNAL_BUFFER_SIZE,
+        spill_path: str = MESSAGE_JOURNAL_SPILL_PATH,
+        quarantine_path: str = MESSAGE_JOURNAL_QUARANTINE_PATH,
+    ):
+        self.engine = engine  # make_engine() on first write, not on import
+        self.spill_path = spill_path
+        self.quarantine_path = quarantine_path
+        self.writer = BatchWriter(
+            self.flush,
+            batch_size=batch_size,
+            flush_seconds=flush_seconds,
+            max_buffer_size=max_buffer_size,
+            overflow="drop_newest",
+            name="message-journal",
+        )
+        self._spill_lock = threading.Lock()
+
+    def record(
+        self, phone_number: str, message_body: str, direction: str
+    ) -> None:
+        sent_datetime = datetime.now(timezone.utc).isoformat()
+        self.writer.put((sent_datetime, phone_number, message_body, direction))
+
+    def copy(self, data: bytes) -> None:
+        if self.engine is None:
+            self.engine = make_engine()
+        columns = ", ".join(MESSAGE_COLUMNS)
+        with make_session(self.engine) as session:
+            copy_in(
+                session,
+                f"COPY prod.messages ({columns}) FROM STDIN WITH (FORMAT csv)",
+                io.BytesIO(data),
+            )
+
+    def write(self, messages: list[tuple]) -> list[tuple]:
+        """
+        Copy messages to the database, quarantining those it rejects. Returns
+        those that couldn't be written because it couldn't be reached.
+        """
+
+        try:
+            self.copy(to_csv(messages))
+            return []
+        except DATA_ERRORS as e:
+            if len(messages) == 1:
+                self.quarantine(messages[0], e)
+                return []
+            middle = len(messages) // 2
+            unwritten = self.write(messages[:middle])
+            return unwritten + self.write(messages[middle:])
+        except Exception as e:
+            _LOGGER.error(f"Could not write {len(messages)} messages: {e!r}")
+            return messages
+
+    def quarantine(self, message: tuple, error: Exception) -> None:
+        _LOGGER.error(f"The database rejected {message}: {error!r}")
+        if self.quarantine_path:
+            line = dict(message=message, error=repr(error))
+            with open(self.quarantine_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(line) + "\n")
+
+    def flush(self, messages: list[tuple]) -> None:
+        with self._spill_lock:
+            spilled = self._read_spilled()
+            unwritten = self.write(spilled) if spilled else []
+            if unwritten:  # no point trying the rest now
+                unwritten += messages
+            else:
+                unwritten = self.write(messages)
+
+            if not self.spill_path:
+                if unwritten:
+                    _LOGGER.error(f"Lost {len(unwritten)} messages")
+                return
+            if unwritten:
+                self._write_spilled(unwritten)
+                _LOGGER.error(
+                    f"Spilled {len(unwritten)} messages to {self.spill_path}"
+                )
+            elif spilled:
+                os.remove(self.spill_path)
+                _LOGGER.info(f"Wrote the messages in {self.spill_path}")
+
+    def _read_spilled(self) -> list[tuple]:
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return []
+        with open(self.spill_path, "r", encoding="utf-8") as spill:
+            return [tuple(json.loads(line)) for line in spill if line.strip()]
+
+    def _write_spilled(self, messages: list[tuple]) -> None:
+        """Replace the spill file, so no message is in it twice"""
+
+        path = f"{self.spill_path}.tmp"
+        with open(path, "w", encoding="utf-8") as spill:
+            for message in messages:
+                spill.write(json.dumps(message) + "\n")
+        os.replace(path, self.spill_path)
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Flush everything buffered and stop the background thread"""
+
+        self.writer.stop(timeout)
+
+
+MESSAGE_JOURNAL = MessageJournal()
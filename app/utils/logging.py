@@ -1,30 +1,73 @@
 import logging
+import os
+from datetime import (
+    datetime,
+    timezone,
+)
 
-from fastapi import Depends
+from sqlalchemy import insert
 from sqlalchemy.engine import Engine
+from utils.batching import BatchWriter
 from utils.db import (
     make_engine,
     make_session,
 )
 from utils.orm import Log
 
+LOG_BATCH_SIZE: int = int(os.getenv("LOG_BATCH_SIZE", "200"))
+LOG_FLUSH_SECONDS: float = float(os.getenv("LOG_FLUSH_SECONDS", "2"))
+LOG_BUFFER_SIZE: int = int(os.getenv("LOG_BUFFER_SIZE", "10000"))
+LOG_OVERFLOW: str = os.getenv("LOG_OVERFLOW", "drop_oldest")
+
 
 class DatabaseLogHandler(logging.Handler):
+    """
+    Writes log records to prod.log from a background thread, in multi-row
+    inserts, so a log call only costs the caller an enqueue
+    """
+
     def __init__(
         self,
-        engine: Engine = Depends(make_engine),
+        engine: Engine = None,
+        batch_size: int = LOG_BATCH_SIZE,
+        flush_seconds: float = LOG_FLUSH_SECONDS,
+        max_buffer_size: int = LOG_BUFFER_SIZE,
+        overflow: str = LOG_OVERFLOW,
     ):
         super(DatabaseLogHandler, self).__init__()
-        self.engine = engine
+        self.engine = engine  # make_engine() on first write, not on import
+        self.writer = BatchWriter(
+            self.insert_logs,
+            batch_size=batch_size,
+            flush_seconds=flush_seconds,
+            max_buffer_size=max_buffer_size,
+            overflow=overflow,
+            name="database-log-handler",
+        )
 
     def emit(self, record):
-        with make_session(self.engine) as session:
-            log = Log(
-                level=record.levelname,
-                message=record.msg,
+        try:
+            # When it was logged, not when the batch happens to be written
+            created_at = datetime.fromtimestamp(record.created, timezone.utc)
+            self.writer.put(
+                dict(
+                    level=record.levelname,
+                    message=record.getMessage(),
+                    created_at=created_at,
+                )
             )
-            session.add(log)
-            session.commit()
+        except Exception:
+            self.handleError(record)
+
+    def insert_logs(self, logs: list) -> None:
+        if self.engine is None:
+            self.engine = make_engine()
+        with make_session(self.engine) as session:
+            session.execute(insert(Log), logs)
+
+    def close(self):
+        self.writer.stop()
+        super(DatabaseLogHandler, self).close()
 
 
 LOGGER: logging.Logger = logging.getLogger("database_logger")
@@ -0,0 +1,135 @@
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client.core import (
+    CounterMetricFamily,
+    GaugeMetricFamily,
+)
+from utils.db import (
+    pool_stats,
+    registered_engines,
+)
+
+# The starter has no web server of its own, so it serves /metrics here
+STARTER_METRICS_PORT: int = int(os.getenv("STARTER_METRICS_PORT", "9100"))
+
+# Most stages take (sub)milliseconds, sending an SMS can take seconds
+STAGE_BUCKETS: tuple = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+STAGE_SECONDS = Histogram(
+    "procus_stage_seconds",
+    "Time spent in each stage of handling a request or opening iterations",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+
+REPLIES = Counter("procus_replies", "Inbound messages handled by the webhook")
+INVALID_ANSWERS = Counter(
+    "procus_invalid_answers", "Replies that weren't a valid answer"
+)
+DUPLICATE_REPLIES = Counter(
+    "procus_duplicate_replies",
+    "Retried webhook calls answered with the reply sent before",
+)
+RESTARTS = Counter("procus_restarts", "Conversations restarted by recipients")
+SMS_SEND_FAILURES = Counter(
+    "procus_sms_send_failures", "SMSs that couldn't be sent, after retries"
+)
+GATEWAY_RESPONSES = Counter(
+    "procus_gateway_responses",
+    "Responses from the SMS gateway, including those retried",
+    ["status_code"],
+)
+OUTBOX_MESSAGES = Counter(
+    "procus_outbox_messages",
+    "Messages sent from the outbox, or not, by outcome",
+    ["status"],
+)
+REMINDERS = Counter(
+    "procus_reminders", "Reminders sent to respondents who went silent"
+)
+EXPIRED_RESPONSES = Counter(
+    "procus_expired_responses", "Responses that expired without an answer"
+)
+STARTUP_SECONDS = Gauge(
+    "procus_startup_seconds", "Time from startup until ready to serve"
+)
+AWAITING_STORE_SIZE = Gauge(
+    "procus_awaiting_store_size", "Phone numbers in the awaiting-state cache"
+)
+JOURNAL_DROPPED_MESSAGES = Gauge(
+    "procus_journal_dropped_messages",
+    "Messages not journaled since startup, as the journal's buffer was full",
+)
+
+
+def time_stage(stage: str):
+    """Context manager (or decorator) timing a stage into STAGE_SECONDS"""
+
+    return STAGE_SECONDS.labels(stage).time()
+
+
+class PoolCollector:
+    """Usage of the connection pools of all engines, read when scraped"""
+
+    def collect(self):
+        connections = GaugeMetricFamily(
+            "procus_db_pool_connections",
+            "Pooled database connections, by state",
+            labels=["database", "state"],
+        )
+        checkouts = CounterMetricFamily(
+            "procus_db_pool_checkouts",
+            "Connections checked out of the pool",
+            labels=["database"],
+        )
+        wait_seconds = CounterMetricFamily(
+            "procus_db_pool_wait_seconds",
+            "Time spent waiting for a pooled connection",
+            labels=["database"],
+        )
+
+        for engine in registered_engines():
+            database = str(engine.url)  # without the password
+            stats = pool_stats(getattr(engine, "sync_engine", engine))
+            for state in ("checked_out", "checked_in", "overflow"):
+                connections.add_metric([database, state], stats[state])
+            if "n_checkouts" in stats:
+                waited = stats["wait_seconds_total"]
+                checkouts.add_metric([database], stats["n_checkouts"])
+                wait_seconds.add_metric([database], waited)
+
+        yield connections
+        yield checkouts
+        yield wait_seconds
+
+
+REGISTRY.register(PoolCollector())
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """The current metrics in Prometheus' text format, and its content type"""
+
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -5,6 +5,10 @@ from sqlalchemy import (
     Column,
     Enum,
 )
+from sqlalchemy.dialects.postgresql import (
+    ARRAY,
+    TSTZRANGE,
+)
 from sqlalchemy.orm import (
     DeclarativeBase,
     Mapped,
@@ -12,9 +16,11 @@ from sqlalchemy.orm import (
 )
 from sqlalchemy.sql import func
 from sqlalchemy.types import (
+    BigInteger,
     Boolean,
     DateTime,
     Integer,
+    SmallInteger,
     String,
     Text,
 )
@@ -56,9 +62,9 @@ class Response(ProcusBase):
     __tablename__ = "responses"
 
     response_id: Mapped[int] = Column(Integer, primary_key=True)
+    iteration_id: Mapped[int] = Column(Integer, nullable=True)
     phone_number: Mapped[str] = Column(Text, nullable=True)
     item_id: Mapped[int] = Column(Integer, nullable=True)
-    item_text: Mapped[str] = Column(Text, nullable=True)
     opens_datetime: Mapped[DateTime] = Column(
         DateTime(timezone=True), nullable=True
     )
@@ -68,12 +74,23 @@ class Response(ProcusBase):
         DateTime(timezone=True), default=func.now(), nullable=True
     )
     updated_by: Mapped[str] = Column(Text, nullable=True)
+    # Timers of a response awaiting an answer (see utils/reminders.py)
+    remind_at: Mapped[datetime.datetime] = Column(
+        DateTime(timezone=True), nullable=True
+    )
+    expires_at: Mapped[datetime.datetime] = Column(
+        DateTime(timezone=True), nullable=True
+    )
+    n_reminders: Mapped[int] = Column(Integer, nullable=False, default=0)
+    # Set by the database (see versioning() in init_ddl.sql); its lower bound
+    # is when the row last changed
+    sys_period: Mapped[object] = Column(TSTZRANGE, nullable=True)
 
     def __repr__(self) -> str:
         return f"""<Response(response_id={self.response_id},
+        iteration_id={self.iteration_id},
         phone_number={self.phone_number},
         item_id={self.item_id},
-        item_text={self.item_text},
         opens_datetime={self.opens_datetime},
         response={self.response},
         status={self.status},
@@ -114,7 +131,40 @@ class Message(ProcusBase):
     )
     phone_number: Mapped[str] = Column(Text, nullable=False)
     message_body: Mapped[str] = Column(Text, nullable=False)
-    direction: Mapped[str] = Column(Enum(DirectionEnum))
+    # Non-native: the column is plain text with a CHECK constraint
+    direction: Mapped[str] = Column(Enum(DirectionEnum, native_enum=False))
+
+
+class Outbox(ProcusBase):
+    __tablename__ = "outbox"
+
+    outbox_id: Mapped[int] = Column(Integer, primary_key=True, nullable=False)
+    phone_number: Mapped[str] = Column(Text, nullable=False)
+    message_body: Mapped[str] = Column(Text, nullable=False)
+    # pending, sending, failed or unknown; sent messages move to messages
+    status: Mapped[str] = Column(Text, nullable=False, default="pending")
+    n_attempts: Mapped[int] = Column(Integer, nullable=False, default=0)
+    not_before: Mapped[datetime.datetime] = Column(
+        DateTime(timezone=True), default=func.now(), nullable=False
+    )
+    claimed_at: Mapped[datetime.datetime] = Column(
+        DateTime(timezone=True), nullable=True
+    )
+    error: Mapped[str] = Column(Text, nullable=True)
+    created_datetime: Mapped[datetime.datetime] = Column(
+        DateTime(timezone=True), default=func.now(), nullable=False
+    )
+
+
+class SentReply(ProcusBase):
+    __tablename__ = "sent_replies"
+
+    idempotency_key: Mapped[str] = Column(Text, primary_key=True)
+    phone_number: Mapped[str] = Column(Text, nullable=False)
+    reply: Mapped[str] = Column(Text, nullable=False)
+    created_datetime: Mapped[datetime.datetime] = Column(
+        DateTime(timezone=True), default=func.now(), nullable=False
+    )
 
 
 class Item(ProcusBase):
@@ -152,3 +202,36 @@ class Log(ProcusBase):
     created_at: Mapped[datetime.datetime] = Column(
         DateTime(timezone=True), default=func.now(), nullable=False
     )
+
+
+class IterationStats(ProcusBase):
+    """Maintained by triggers on responses, see init_ddl.sql"""
+
+    __tablename__ = "iteration_stats"
+
+    iteration_id: Mapped[int] = Column(Integer, primary_key=True)
+    instrument_id: Mapped[int] = Column(Integer, nullable=False)
+    n_open: Mapped[int] = Column(Integer, nullable=False)
+    n_awaiting: Mapped[int] = Column(Integer, nullable=False)
+    n_closed: Mapped[int] = Column(Integer, nullable=False)
+    n_expired: Mapped[int] = Column(Integer, nullable=False)
+    opened_at: Mapped[datetime.datetime] = Column(
+        DateTime(timezone=True), nullable=False
+    )
+    finished_at: Mapped[datetime.datetime] = Column(
+        DateTime(timezone=True), nullable=True
+    )
+
+
+class InstrumentStats(ProcusBase):
+    """Maintained by triggers on responses, see init_ddl.sql"""
+
+    __tablename__ = "instrument_stats"
+
+    instrument_id: Mapped[int] = Column(Integer, primary_key=True)
+    slot: Mapped[int] = Column(SmallInteger, primary_key=True)
+    n_open: Mapped[int] = Column(BigInteger, nullable=False)
+    n_awaiting: Mapped[int] = Column(BigInteger, nullable=False)
+    n_closed: Mapped[int] = Column(BigInteger, nullable=False)
+    n_stalled: Mapped[int] = Column(BigInteger, nullable=False)
+    finish_buckets: Mapped[list] = Column(ARRAY(BigInteger), nullable=False)
@@ -0,0 +1,304 @@
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import (
+    datetime,
+    timedelta,
+    timezone,
+)
+from typing import Iterable
+
+import requests
+from sqlalchemy import (
+    and_,
+    delete,
+    insert,
+    select,
+    update,
+)
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm.session import Session as SQLAlchemySession
+from sqlalchemy.sql import (
+    Select,
+    func,
+)
+from utils.db import make_session
+from utils.logging import LOGGER
+from utils.metrics import (
+    OUTBOX_MESSAGES,
+    time_stage,
+)
+from utils.orm import (
+    Message,
+    Outbox,
+)
+from utils.sms import (
+    RETRY_STATUS_CODES,
+    SmsDispatcher,
+    never_reached_gateway,
+)
+
+OUTBOX_BATCH_SIZE: int = int(os.getenv("OUTBOX_BATCH_SIZE", "1000"))
+# Recipients per gateway request, for messages with the same body
+OUTBOX_MAX_RECIPIENTS: int = int(os.getenv("OUTBOX_MAX_RECIPIENTS", "1000"))
+OUTBOX_POLL_SECONDS: float = float(os.getenv("OUTBOX_POLL_SECONDS", "1"))
+OUTBOX_MAX_ATTEMPTS: int = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_RETRY_SECONDS: float = float(os.getenv("OUTBOX_RETRY_SECONDS", "60"))
+# Messages claimed longer ago than this were being sent by a starter that
+# died; whether the gateway got them is unknown
+OUTBOX_SENDING_TIMEOUT: timedelta = timedelta(
+    seconds=float(os.getenv("OUTBOX_SENDING_TIMEOUT_SECONDS", "600"))
+)
+
+# What happened to one message of a gateway request; error is None if sent
+Outcome = namedtuple("Outcome", ["outbox_id", "status", "error"])
+
+
+def enqueue(session: SQLAlchemySession, messages: Iterable[tuple]) -> int:
+    """
+    Queue (to, message) pairs for sending, in session's transaction, so they
+    are sent if and only if it commits. Returns the number queued.
+    """
+
+    rows = [dict(phone_number=to, message_body=body) for to, body in messages]
+    if rows:
+        session.execute(insert(Outbox), rows)
+    return len(rows)
+
+
+def select_pending(batch_size: int = OUTBOX_BATCH_SIZE) -> Select:
+    return (
+        select(Outbox.outbox_id)
+        .where(
+            and_(
+                Outbox.status == "pending",
+                Outbox.not_before <= func.now(),
+            )
+        )
+        .order_by(Outbox.outbox_id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+
+
+def group_by_body(rows: list, max_recipients: int) -> list[tuple]:
+    """(message body, rows) for each gateway request to make"""
+
+    by_body: dict = {}
+    for row in rows:
+        by_body.setdefault(row.message_body, []).append(row)
+
+    return [
+        (body, same_body[start : start + max_recipients])  # noqa: E203
+        for body, same_body in by_body.items()
+        for start in range(0, len(same_body), max_recipients)
+    ]
+
+
+def recipient_errors(response: requests.Response) -> dict:
+    """Errors by recipient from a successful gateway reply"""
+
+    try:
+        errors = response.json().get("error", [])
+    except ValueError:
+        return {}
+    if not isinstance(errors, list):
+        return {}
+    return {str(e.get("to")): e.get("message", "Rejected") for e in errors}
+
+
+class OutboxSender:
+    """
+    Sends the messages queued in prod.outbox, so that state changes and the
+    messages they call for are committed together, and nothing is sent twice
+    because a process died in between.
+
+    Pending messages are claimed in batches (FOR UPDATE SKIP LOCKED, so
+    several starters can share the queue) and marked as sending before any
+    is sent. Messages with the same body go to the gateway together, in one
+    request for up to max_recipients recipients. Sent messages move to
+    prod.messages. A message is only sent again if the gateway can't have
+    sent it; one whose fate is unknown (the gateway timed out, the connection
+    dropped, a proxy failed, or its sender died) is marked so, for a human to
+    check.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        dispatcher: SmsDispatcher,
+        batch_size: int = OUTBOX_BATCH_SIZE,
+        max_recipients: int = OUTBOX_MAX_RECIPIENTS,
+        poll_seconds: float = OUTBOX_POLL_SECONDS,
+        max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+        retry_seconds: float = OUTBOX_RETRY_SECONDS,
+    ):
+        self.engine = engine
+        self.dispatcher = dispatcher
+        self.batch_size = batch_size
+        self.max_recipients = max_recipients
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self._stopped = threading.Event()
+
+    def claim(self) -> list:
+        due = select_pending(self.batch_size).cte("due")
+        stmt = (
+            update(Outbox)
+            .where(Outbox.outbox_id.in_(select(due.c.outbox_id)))
+            .values(
+                status="sending",
+                n_attempts=Outbox.n_attempts + 1,
+                claimed_at=func.now(),
+            )
+            .returning(
+                Outbox.outbox_id,
+                Outbox.phone_number,
+                Outbox.message_body,
+                Outbox.n_attempts,
+            )
+        )
+        # Committed before sending, see the class docstring
+        with make_session(self.engine) as session:
+            return session.execute(stmt).all()
+
+    def send_group(self, body: str, rows: list) -> list[Outcome]:
+        to = [row.phone_number for row in rows]
+        try:
+            response = self.dispatcher.send(to, body)
+        except requests.RequestException as e:
+            # Retried by the dispatcher already, if it can't have been sent
+            status = "retry" if never_reached_gateway(e) else "unknown"
+            return [Outcome(row.outbox_id, status, repr(e)) for row in rows]
+
+        if response.status_code == requests.codes.ok:
+            errors = recipient_errors(response)
+            return [
+                Outcome(
+                    row.outbox_id,
+                    "failed" if row.phone_number in errors else "sent",
+                    errors.get(row.phone_number),
+                )
+                for row in rows
+            ]
+
+        # Only a refusal by the gateway itself shows that nothing was sent
+        if response.status_code in RETRY_STATUS_CODES:
+            status = "retry"
+        elif response.status_code < 500:
+            status = "failed"
+        else:
+            status = "unknown"
+        error = f"{response.status_code}: {response.text[:200]}"
+        return [Outcome(row.outbox_id, status, error) for row in rows]
+
+    def record(self, rows: list, outcomes: list[Outcome]) -> None:
+        """Move sent messages to prod.messages and update the others"""
+
+        by_id = {row.outbox_id: row for row in rows}
+        now = datetime.now(timezone.utc)
+        retry_at = now + timedelta(seconds=self.retry_seconds)
+        sent, updates = [], []
+        for outcome in outcomes:
+            row = by_id[outcome.outbox_id]
+            status = outcome.status
+            if status == "retry" and row.n_attempts >= self.max_attempts:
+                status = "failed"
+            OUTBOX_MESSAGES.labels(status).inc()
+
+            if status == "sent":
+                sent.append(row)
+                continue
+            updates.append(
+                dict(
+                    outbox_id=row.outbox_id,
+                    status="pending" if status == "retry" else status,
+                    not_before=retry_at,
+                    error=outcome.error,
+                )
+            )
+
+        with make_session(self.engine) as session:
+            if sent:
+                session.execute(
+                    insert(Message),
+                    [
+                        dict(
+                            phone_number=row.phone_number,
+                            message_body=row.message_body,
+                            direction="outbound",
+                        )
+                        for row in sent
+                    ],
+                )
+                sent_ids = [row.outbox_id for row in sent]
+                session.execute(
+                    delete(Outbox).where(Outbox.outbox_id.in_(sent_ids))
+                )
+            if updates:
+                session.execute(update(Outbox), updates)
+
+    def send_due(self) -> int:
+        """Send one batch of pending messages; returns the number claimed"""
+
+        rows = self.claim()
+        if not rows:
+            return 0
+
+        groups = group_by_body(rows, self.max_recipients)
+        with ThreadPoolExecutor(self.dispatcher.max_workers) as executor:
+            futures = [
+                executor.submit(self.send_group, body, group)
+                for body, group in groups
+            ]
+            outcomes = [o for future in futures for o in future.result()]
+        self.record(rows, outcomes)
+        return len(rows)
+
+    def mark_stuck(self) -> int:
+        """Mark messages claimed by a sender that died as unknown"""
+
+        stmt = (
+            update(Outbox)
+            .where(
+                and_(
+                    Outbox.status == "sending",
+                    Outbox.claimed_at < func.now() - OUTBOX_SENDING_TIMEOUT,
+                )
+            )
+            .values(status="unknown", error="The sender stopped")
+        )
+        with make_session(self.engine) as session:
+            n_stuck = session.execute(stmt).rowcount
+        if n_stuck:
+            OUTBOX_MESSAGES.labels("unknown").inc(n_stuck)
+            LOGGER.error(f"{n_stuck} messages may or may not have been sent")
+        return n_stuck
+
+    def drain(self) -> None:
+        """Send everything that is due now, a batch at a time"""
+
+        with time_stage("send_outbox"):
+            while self.send_due() == self.batch_size:
+                pass
+
+    def run_forever(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self.mark_stuck()
+                self.drain()
+            except Exception as e:
+                LOGGER.error(f"Sending from the outbox failed: {e!r}")
+            self._stopped.wait(self.poll_seconds)
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(
+            target=self.run_forever, name="outbox", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def stop(self) -> None:
+        self._stopped.set()
@@ -0,0 +1,179 @@
+import gzip
+import os
+import re
+from datetime import date
+from typing import NamedTuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm.session import Session as SQLAlchemySession
+from utils.db import (
+    copy_out,
+    make_session,
+)
+from utils.logging import LOGGER
+
+PARTITION_ARCHIVE_DIR: str = os.getenv(
+    "PARTITION_ARCHIVE_DIR", "/persistent_storage/partitions"
+)
+PARTITION_MAINTENANCE_SECONDS: float = float(
+    os.getenv("PARTITION_MAINTENANCE_SECONDS", str(24 * 60 * 60))
+)
+PARTITION_MONTHS_AHEAD: int = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+RETENTION_MONTHS: int = int(os.getenv("RETENTION_MONTHS", "12"))
+LOG_RETENTION_MONTHS: int = int(os.getenv("LOG_RETENTION_MONTHS", "3"))
+# Give up (until the next run) rather than queue other statements behind the
+# lock that detaching a partition takes on its parent
+DETACH_LOCK_TIMEOUT: str = os.getenv("PARTITION_DETACH_LOCK_TIMEOUT", "5s")
+
+# Parent table: months to keep besides the current one. Must match the
+# partitioned tables in init_ddl.sql
+PARTITIONED_TABLES: dict = {
+    "history.instruments": RETENTION_MONTHS,
+    "history.items": RETENTION_MONTHS,
+    "history.iterations": RETENTION_MONTHS,
+    "history.responses": RETENTION_MONTHS,
+    "prod.messages": RETENTION_MONTHS,
+    "prod.log": LOG_RETENTION_MONTHS,
+}
+
+_PARTITION_SUFFIX = re.compile(r"_p(\d{4})(\d{2})$")
+
+
+class Partition(NamedTuple):
+    parent: str
+    name: str  # schema-qualified
+    month: date
+
+
+def add_months(month: date, n: int) -> date:
+    months = month.year * 12 + month.month - 1 + n
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def expired_partitions(
+    partitions: list[Partition], retention_months: int, today: date
+) -> list[Partition]:
+    """Partitions of months before the last retention_months, oldest first"""
+
+    cutoff = add_months(today.replace(day=1), -retention_months)
+    expired = [p for p in partitions if p.month < cutoff]
+    return sorted(expired, key=lambda p: p.month)
+
+
+def list_partitions(session: SQLAlchemySession, parent: str) -> list:
+    """The monthly partitions of parent; not its default partition"""
+
+    stmt = text(
+        "SELECT n.nspname || '.' || c.relname "
+        "FROM pg_inherits AS i "
+        "JOIN pg_class AS c ON c.oid = i.inhrelid "
+        "JOIN pg_namespace AS n ON n.oid = c.relnamespace "
+        "WHERE i.inhparent = CAST(:parent AS regclass)"
+    )
+    partitions = []
+    for name in session.scalars(stmt, {"parent": parent}):
+        match = _PARTITION_SUFFIX.search(name)
+        if match:
+            month = date(int(match[1]), int(match[2]), 1)
+            partitions.append(Partition(parent, name, month))
+    return partitions
+
+
+def create_partitions(
+    engine: Engine, months_ahead: int = PARTITION_MONTHS_AHEAD
+) -> int:
+    """Create the coming months' partitions that are missing"""
+
+    stmt = text("SELECT prod.create_monthly_partitions(:parent, :months)")
+    n_created = 0
+    with make_session(engine) as session:
+        for parent in PARTITIONED_TABLES:
+            params = {"parent": parent, "months": months_ahead}
+            n_created += session.scalar(stmt, params)
+    return n_created
+
+
+def archive_partition(
+    engine: Engine, partition: Partition, directory: str
+) -> str:
+    """
+    Export a partition to a gzipped CSV file and drop it, in one transaction,
+    so it's either archived and gone or still in place. Writes to it are
+    blocked meanwhile, which is fine for a month that is over; its parent
+    is only locked for the detach and drop at the end.
+    """
+
+    path = os.path.join(directory, f"{partition.name}.csv.gz")
+    temporary_path = f"{path}.tmp"
+    with make_session(engine) as session:
+        session.execute(text(f"LOCK TABLE {partition.name} IN SHARE MODE"))
+        with gzip.open(temporary_path, "wb") as f:
+            copy_out(
+                session,
+                f"COPY {partition.name} TO STDOUT WITH (FORMAT csv, HEADER)",
+                f,
+            )
+        os.replace(temporary_path, path)
+
+        session.execute(
+            text(f"SET LOCAL lock_timeout = '{DETACH_LOCK_TIMEOUT}'")
+        )
+        session.execute(
+            text(
+                f"ALTER TABLE {partition.parent} "
+                + f"DETACH PARTITION {partition.name}"
+            )
+        )
+        session.execute(text(f"DROP TABLE {partition.name}"))
+    return path
+
+
+def archive_expired_partitions(
+    engine: Engine, directory: str = PARTITION_ARCHIVE_DIR, today: date = None
+) -> list[str]:
+    """
+    Archive and drop all partitions past their retention, a whole month at a
+    time. Returns the archive files written.
+    """
+
+    today = today or date.today()
+    with make_session(engine) as session:
+        expired = [
+            partition
+            for parent, retention_months in PARTITIONED_TABLES.items()
+            for partition in expired_partitions(
+                list_partitions(session, parent), retention_months, today
+            )
+        ]
+
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for partition in expired:
+        try:
+            paths.append(archive_partition(engine, partition, directory))
+            LOGGER.info(f"Archived and dropped partition {partition.name}")
+        except Exception as e:
+            LOGGER.error(f"Could not archive {partition.name}: {e!r}")
+    return paths
+
+
+def warn_about_default_partitions(engine: Engine) -> None:
+    """
+    Rows in a default partition stop their month's partition from being
+    created, so they need moving by hand
+    """
+
+    with make_session(engine) as session:
+        for parent in PARTITIONED_TABLES:
+            stmt = text(f"SELECT EXISTS (SELECT FROM {parent}_default)")
+            if session.scalar(stmt):
+                LOGGER.warning(f"{parent}_default isn't empty")
+
+
+def maintain_partitions(engine: Engine) -> None:
+    warn_about_default_partitions(engine)
+    n_created = create_partitions(engine)
+    if n_created:
+        LOGGER.info(f"Created {n_created} partitions")
+    archive_expired_partitions(engine)
@@ -0,0 +1,179 @@
+import contextvars
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from utils.db import registered_engines
+
+# Off unless enabled; then requests are profiled when they carry
+# PROFILE_QUERY_PARAMETER, or at random with PROFILE_SAMPLE_RATE
+PROFILE_ENABLED: bool = os.getenv("PROFILE_ENABLED", "false").lower() == "true"
+PROFILE_SAMPLE_RATE: float = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_QUERY_PARAMETER: str = "profile"
+PROFILE_DIR: str = os.getenv("PROFILE_DIR", "/persistent_storage/profiles")
+
+# The profile of the request being handled, if it is profiled. Copied into
+# the tasks and greenlets serving the request, so the profile must be mutable
+_current_profile = contextvars.ContextVar("current_profile", default=None)
+
+
+def should_profile(query_params, sample_rate: float = None) -> bool:
+    if PROFILE_QUERY_PARAMETER in query_params:
+        return True
+    sample_rate = PROFILE_SAMPLE_RATE if sample_rate is None else sample_rate
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    file_name = os.path.basename(code.co_filename)
+    return f"{code.co_qualname} ({file_name}:{code.co_firstlineno})"
+
+
+def function_label(function) -> str:
+    name = getattr(function, "__qualname__", repr(function))
+    module = getattr(function, "__module__", None)
+    return f"{module}.{name}" if module else name
+
+
+class RequestProfile:
+    """
+    Wall-clock time of one request by call stack, and its SQL statements.
+
+    Built from profiling events of its own task(s) only, also when requests
+    are handled concurrently. A coroutine's frames leave the stack while it
+    awaits, so waiting (e.g. for the database) isn't counted in the stacks;
+    the statement log has that.
+    """
+
+    def __init__(self, path: str):
+        self.profile_id = f"{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}"
+        self.path = path
+        self.started = time.perf_counter()
+        self.stacks: dict = defaultdict(float)  # path: self seconds
+        self.statements: list = []
+        # [label, started, seconds in children, id of frame or function]
+        self._stack: list = []
+
+    def on_event(self, frame, event: str, arg) -> None:
+        now = time.perf_counter()
+        if event == "call":
+            self._stack.append([frame_label(frame), now, 0.0, id(frame)])
+        elif event == "c_call":
+            self._stack.append([function_label(arg), now, 0.0, id(arg)])
+        else:  # return, c_return or c_exception
+            key = id(frame) if event == "return" else id(arg)
+            keys = [entry[3] for entry in self._stack]
+            if key in keys:
+                # Frames above it left the stack without an event, e.g. when
+                # SQLAlchemy switched greenlets
+                depth = len(keys) - keys[::-1].index(key) - 1
+                while len(self._stack) > depth:
+                    self._close(now)
+
+    def _close(self, now: float) -> None:
+        label, started, in_children, _ = self._stack[-1]
+        seconds = now - started
+        path = ";".join(entry[0] for entry in self._stack)
+        self.stacks[path] += seconds - in_children
+        self._stack.pop()
+        if self._stack:
+            self._stack[-1][2] += seconds
+
+    def on_statement(self, statement: str, started: float) -> None:
+        self.statements.append(
+            dict(
+                started_ms=round((started - self.started) * 1000, 3),
+                duration_ms=round((time.perf_counter() - started) * 1000, 3),
+                statement=" ".join(statement.split()),
+            )
+        )
+
+    def write(self, directory: str = PROFILE_DIR) -> str:
+        """
+        Write collapsed stacks (for flamegraph.pl or speedscope), in
+        microseconds, and the statement log as JSONL. Returns their prefix.
+        """
+
+        os.makedirs(directory, exist_ok=True)
+        prefix = os.path.join(directory, self.profile_id)
+        with open(f"{prefix}.folded", "w", encoding="utf-8") as f:
+            for path, seconds in sorted(self.stacks.items()):
+                if seconds > 0:
+                    f.write(f"{path} {round(seconds * 1e6)}\n")
+        with open(f"{prefix}.sql.jsonl", "w", encoding="utf-8") as f:
+            header = dict(path=self.path, n_statements=len(self.statements))
+            f.write(json.dumps(header) + "\n")
+            for statement in self.statements:
+                f.write(json.dumps(statement) + "\n")
+        return prefix
+
+
+def _dispatch(frame, event: str, arg) -> None:
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.on_event(frame, event, arg)
+
+
+_listening: set = set()  # ids of engines with statement timing
+_n_active = 0
+_lock = threading.Lock()
+
+
+def _before_cursor_execute(conn, cursor, statement, *args):
+    if _current_profile.get() is not None:
+        conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, *args):
+    profile = _current_profile.get()
+    if profile is not None and conn.info.get("profile_started"):
+        profile.on_statement(statement, conn.info["profile_started"].pop())
+
+
+def listen_for_statements(engine: Engine) -> None:
+    engine = getattr(engine, "sync_engine", engine)
+    with _lock:
+        if id(engine) in _listening:
+            return
+        _listening.add(id(engine))
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def start_profile(path: str) -> tuple[RequestProfile, contextvars.Token]:
+    """
+    Profile what runs in the current context (and tasks started from it) on
+    this thread, until stop_profile. Other requests run meanwhile pay for a
+    profiling callback that ignores them.
+    """
+
+    global _n_active
+
+    for engine in registered_engines():
+        listen_for_statements(engine)
+
+    profile = RequestProfile(path)
+    token = _current_profile.set(profile)
+    with _lock:
+        _n_active += 1
+        if _n_active == 1:
+            sys.setprofile(_dispatch)
+    return profile, token
+
+
+def stop_profile(token: contextvars.Token) -> None:
+    global _n_active
+
+    _current_profile.reset(token)
+    with _lock:
+        _n_active -= 1
+        if _n_active == 0:
+            sys.setprofile(None)
@@ -0,0 +1,220 @@
+import os
+import threading
+from datetime import timedelta
+
+from sqlalchemy import (
+    and_,
+    case,
+    null,
+    select,
+    update,
+)
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import (
+    Select,
+    func,
+)
+from utils.catalog import InstrumentCatalog
+from utils.db import make_session
+from utils.logging import LOGGER
+from utils.metrics import (
+    EXPIRED_RESPONSES,
+    REMINDERS,
+    time_stage,
+)
+from utils.orm import Response
+from utils.outbox import enqueue
+
+# When a respondent who went silent is reminded of the item awaiting an
+# answer, how often at most, and when the rest of the iteration expires
+REMINDER_AFTER: timedelta = timedelta(
+    seconds=float(os.getenv("REMINDER_AFTER_SECONDS", str(24 * 60 * 60)))
+)
+REMINDER_MAX_COUNT: int = int(os.getenv("REMINDER_MAX_COUNT", "1"))
+EXPIRE_AFTER: timedelta = timedelta(
+    seconds=float(os.getenv("EXPIRE_AFTER_SECONDS", str(3 * 24 * 60 * 60)))
+)
+REMINDER_BATCH_SIZE: int = int(os.getenv("REMINDER_BATCH_SIZE", "500"))
+REMINDER_TICK_SECONDS: float = float(os.getenv("REMINDER_TICK_SECONDS", "60"))
+
+REMINDER_PREFIX: str = "Påmindelse: vi mangler stadig dit svar.\n\n"
+
+
+def due_times() -> dict:
+    """
+    Values that (re)start the timers of a response being marked as awaiting.
+    The closing item needs no answer, so it only expires.
+    """
+
+    return dict(
+        remind_at=case(
+            (Response.item_id.is_(None), null()),
+            else_=func.now() + REMINDER_AFTER,
+        ),
+        expires_at=func.now() + EXPIRE_AFTER,
+        n_reminders=0,
+    )
+
+
+def select_due_reminders(batch_size: int = REMINDER_BATCH_SIZE) -> Select:
+    return (
+        select(Response.response_id)
+        .where(
+            and_(
+                Response.status == "awaiting",
+                Response.remind_at <= func.now(),
+            )
+        )
+        .order_by(Response.remind_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+
+
+def select_due_expiries(batch_size: int = REMINDER_BATCH_SIZE) -> Select:
+    return (
+        select(Response.response_id)
+        .where(
+            and_(
+                Response.status == "awaiting",
+                Response.expires_at <= func.now(),
+            )
+        )
+        .order_by(Response.expires_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+
+
+class ReminderEngine:
+    """
+    Reminds respondents who haven't answered the item awaiting an answer, and
+    expires their iterations when they stay silent.
+
+    Timers live in the database as remind_at and expires_at of awaiting
+    responses, set when a response is marked as awaiting. Partial indexes on
+    them only hold awaiting responses, so finding what is due costs the same
+    however many conversations are open. Due responses are handled in
+    batches, locked with SKIP LOCKED, so neither a respondent answering at the
+    same moment nor another starter is waited for.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        catalog: InstrumentCatalog,
+        batch_size: int = REMINDER_BATCH_SIZE,
+        tick_seconds: float = REMINDER_TICK_SECONDS,
+        max_reminders: int = REMINDER_MAX_COUNT,
+    ):
+        self.engine = engine
+        self.catalog = catalog
+        self.batch_size = batch_size
+        self.tick_seconds = tick_seconds
+        self.max_reminders = max_reminders
+        self._stopped = threading.Event()
+
+    def expire_due(self) -> int:
+        """
+        Expire one batch of responses awaiting an answer for too long, with
+        the items of their iterations not asked yet. Returns the number of
+        responses expired, i.e. of iterations.
+        """
+
+        due = select_due_expiries(self.batch_size).cte("due")
+        expired = (
+            update(Response)
+            .where(Response.response_id.in_(select(due.c.response_id)))
+            .values(status="expired", updated_by="reminders")
+            .returning(Response.iteration_id)
+            .cte("expired")
+        )
+        # Sees the same snapshot, i.e. doesn't touch the rows expired above
+        not_asked = (
+            update(Response)
+            .where(
+                and_(
+                    Response.iteration_id.in_(select(expired.c.iteration_id)),
+                    Response.status == "open",
+                )
+            )
+            .values(status="expired", updated_by="reminders")
+            .cte("not_asked")
+        )
+        stmt = select(func.count()).select_from(expired).add_cte(not_asked)
+
+        with make_session(self.engine) as session:
+            n_expired = session.scalar(stmt)
+        EXPIRED_RESPONSES.inc(n_expired)
+        return n_expired
+
+    def remind_due(self) -> int:
+        """
+        Queue one batch of due reminders, repeating the item awaiting an
+        answer, in the same transaction as their timers are moved on. Returns
+        the number of reminders queued.
+        """
+
+        due = select_due_reminders(self.batch_size).cte("due")
+        n_reminders = Response.n_reminders + 1
+        next_reminder = func.now() + REMINDER_AFTER
+        stmt = (
+            update(Response)
+            .where(Response.response_id.in_(select(due.c.response_id)))
+            .values(
+                n_reminders=n_reminders,
+                remind_at=case(
+                    (n_reminders < self.max_reminders, next_reminder),
+                    else_=null(),
+                ),
+                updated_by="reminders",
+            )
+            .returning(Response.phone_number, Response.item_id)
+        )
+
+        with make_session(self.engine) as session:
+            due_reminders = session.execute(stmt).all()
+            if any(self.catalog.is_stale(r.item_id) for r in due_reminders):
+                self.catalog.reload()
+            n_queued = enqueue(
+                session,
+                (
+                    (r.phone_number, self.reminder_text(session, r.item_id))
+                    for r in due_reminders
+                ),
+            )
+
+        REMINDERS.inc(n_queued)
+        return n_queued
+
+    def reminder_text(self, session: Session, item_id: int) -> str:
+        return REMINDER_PREFIX + self.catalog.read_item_text(session, item_id)
+
+    def run_once(self) -> None:
+        """Handle everything that is due now, a batch at a time"""
+
+        with time_stage("expire_responses"):
+            while self.expire_due() == self.batch_size:
+                pass
+        with time_stage("queue_reminders"):
+            while self.remind_due() == self.batch_size:
+                pass
+
+    def run_forever(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                LOGGER.error(f"Reminders failed: {e!r}")
+            self._stopped.wait(self.tick_seconds)
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(
+            target=self.run_forever, name="reminders", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def stop(self) -> None:
+        self._stopped.set()
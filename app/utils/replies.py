@@ -0,0 +1,69 @@
+import os
+from datetime import timedelta
+from typing import Optional
+
+from sqlalchemy import (
+    delete,
+    select,
+)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import (
+    AsyncConnection,
+    AsyncSession,
+)
+from sqlalchemy.sql import func
+from utils.db import make_session
+from utils.orm import SentReply
+
+# Longer than the gateway keeps retrying a webhook call
+SENT_REPLY_RETENTION: timedelta = timedelta(
+    seconds=float(os.getenv("SENT_REPLY_RETENTION_SECONDS", "86400"))
+)
+
+
+async def fetch_sent_reply(
+    connection: AsyncConnection | AsyncSession, reply_key: Optional[str]
+) -> Optional[str]:
+    """
+    The reply already sent to the inbound message reply_key identifies, if
+    any. Only conclusive while holding the phone number's lock (see
+    utils.conversation.lock_phone_number), which the original held too.
+    """
+
+    if reply_key is None:
+        return None
+    key = SentReply.idempotency_key
+    return await connection.scalar(
+        select(SentReply.reply).where(key == reply_key)
+    )
+
+
+async def record_sent_reply(
+    connection: AsyncConnection | AsyncSession,
+    reply_key: Optional[str],
+    phone_number: str,
+    reply: str,
+) -> None:
+    """Record reply in the transaction of the step it comes from"""
+
+    if reply_key is None:
+        return
+    stmt = (
+        insert(SentReply)
+        .values(
+            idempotency_key=reply_key, phone_number=phone_number, reply=reply
+        )
+        .on_conflict_do_nothing()
+    )
+    await connection.execute(stmt)
+
+
+def purge_sent_replies(engine: Engine) -> int:
+    """Forget replies older than SENT_REPLY_RETENTION"""
+
+    stmt = delete(SentReply).where(
+        SentReply.created_datetime < func.now() - SENT_REPLY_RETENTION
+    )
+    with make_session(engine) as session:
+        return session.execute(stmt).rowcount
@@ -0,0 +1,182 @@
+import heapq
+import os
+import select
+import time
+from typing import (
+    Callable,
+    Optional,
+)
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm.session import Session as SQLAlchemySession
+from utils.catalog import (
+    CATALOG_CHANNEL,
+    InstrumentCatalog,
+)
+from utils.db import make_session
+from utils.logging import LOGGER
+from utils.metrics import time_stage
+from utils.orm import Iteration
+from utils.starter import (
+    claim_iterations_to_open,
+    fetch_scheduled_iterations,
+)
+
+# Must match the channel used by prod.notify_iteration_change() in init_ddl.sql
+ITERATIONS_CHANNEL: str = "iterations_scheduled"
+
+SCHEDULER_BATCH_SIZE: int = int(os.getenv("SCHEDULER_BATCH_SIZE", "500"))
+SCHEDULER_RESYNC_SECONDS: float = float(
+    os.getenv("SCHEDULER_RESYNC_SECONDS", "3600")
+)
+
+OpenIterations = Callable[[SQLAlchemySession, list[Iteration]], None]
+
+
+class IterationScheduler:
+    """
+    Opens iterations when they are due, instead of polling for them.
+
+    Closed iterations are kept in a priority queue by opens_datetime, and the
+    scheduler sleeps until the first of them is due, or until the database
+    notifies it that iterations were added or rescheduled. Due iterations
+    are claimed with FOR UPDATE SKIP LOCKED and handed to open_iterations
+    while still locked, so several starters can run side by side without
+    sending the same invitation twice.
+
+    The queue is rebuilt from the database every resync_seconds and after
+    losing the listening connection, in case notifications were missed. The
+    catalog, if given, is reloaded then too, and whenever it changes.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        open_iterations: OpenIterations,
+        batch_size: int = SCHEDULER_BATCH_SIZE,
+        resync_seconds: float = SCHEDULER_RESYNC_SECONDS,
+        reconnect_seconds: float = 5.0,
+        channel: str = ITERATIONS_CHANNEL,
+        catalog: InstrumentCatalog = None,
+    ):
+        self.engine = engine
+        self.open_iterations = open_iterations
+        self.catalog = catalog
+        self.batch_size = batch_size
+        self.resync_seconds = resync_seconds
+        self.reconnect_seconds = reconnect_seconds
+        self.channel = channel
+
+        self._heap: list = []
+        self._scheduled: dict = {}  # iteration_id: when, to skip stale entries
+        self._connection = None
+        self._resynced_at = 0.0
+
+    def schedule(self, iteration_id: int, opens_at: float) -> None:
+        self._scheduled[iteration_id] = opens_at
+        heapq.heappush(self._heap, (opens_at, iteration_id))
+
+    def unschedule(self, iteration_id: int) -> None:
+        self._scheduled.pop(iteration_id, None)
+
+    def next_due(self) -> Optional[float]:
+        while self._heap:
+            opens_at, iteration_id = self._heap[0]
+            if self._scheduled.get(iteration_id) == opens_at:
+                return opens_at
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now: float) -> list[int]:
+        due = []
+        while len(due) < self.batch_size:
+            opens_at = self.next_due()
+            if opens_at is None or opens_at > now:
+                break
+            _, iteration_id = heapq.heappop(self._heap)
+            del self._scheduled[iteration_id]
+            due.append(iteration_id)
+        return due
+
+    def resync(self) -> None:
+        self._heap, self._scheduled = [], {}
+        with time_stage("fetch_scheduled_iterations"):
+            iterations = fetch_scheduled_iterations(self.engine)
+        for iter in iterations:
+            self.schedule(iter.iteration_id, iter.opens_datetime.timestamp())
+        if self.catalog is not None:
+            self.catalog.reload()
+        self._resynced_at = time.monotonic()
+
+    def _listen(self) -> None:
+        url = self.engine.url.set(drivername="postgresql")
+        self._connection = psycopg2.connect(
+            url.render_as_string(hide_password=False)
+        )
+        self._connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with self._connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {self.channel}")
+            if self.catalog is not None:
+                cursor.execute(f"LISTEN {CATALOG_CHANNEL}")
+
+    def _close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _wait(self, timeout: float) -> None:
+        """Sleep up to timeout seconds, waking up early on notifications"""
+
+        if select.select([self._connection], [], [], timeout) == ([], [], []):
+            return
+
+        self._connection.poll()
+        while self._connection.notifies:
+            notify = self._connection.notifies.pop(0)
+            if notify.channel == CATALOG_CHANNEL:
+                self.catalog.reload()
+                continue
+
+            iteration_id, opens_at = notify.payload.split(",")
+            if opens_at:
+                self.schedule(int(iteration_id), float(opens_at))
+            else:
+                self.unschedule(int(iteration_id))
+
+    def run_once(self) -> None:
+        """Open all iterations that are due now"""
+
+        while due := self.pop_due(time.time()):
+            # Those we can't claim are already open or being opened elsewhere
+            with make_session(self.engine) as session:
+                with time_stage("claim_iterations"):
+                    claimed = claim_iterations_to_open(session, due)
+                if claimed:
+                    with time_stage("open_iterations"):
+                        self.open_iterations(session, claimed)
+
+    def run_forever(self) -> None:
+        self._close()  # whatever was popped before may be lost, so start over
+
+        while True:
+            try:
+                # Listen before (re)loading, so nothing falls in between
+                since_resync = time.monotonic() - self._resynced_at
+                if self._connection is None:
+                    self._listen()
+                    self.resync()
+                elif since_resync > self.resync_seconds:
+                    self.resync()
+                self.run_once()
+
+                next_due = self.next_due()
+                timeout = self.resync_seconds
+                if next_due is not None:
+                    timeout = min(timeout, max(next_due - time.time(), 0))
+                self._wait(timeout)
+            except (psycopg2.Error, OSError) as e:
+                LOGGER.error(f"Scheduler lost its connection: {e!r}")
+                self._close()
+                time.sleep(self.reconnect_seconds)
@@ -1,29 +1,59 @@
 import json
 import logging
-from datetime import (
-    datetime,
-    timezone,
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Iterable,
+    Optional,
+    Union,
 )
 
 import requests
 from fastapi import Response
-from sqlalchemy.engine import Engine
-from utils.db import make_session
-from utils.orm import Message
-
-
-def document_sms(
-    engine: Engine, phone_number: str, message_body: str, direction: str
-) -> None:
-    with make_session(engine) as session:
-        session.add(
-            Message(
-                sent_datime=datetime.now(timezone.utc),
-                phone_number=phone_number,
-                message_body=message_body,
-                direction=direction,
-            )
-        )
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import (
+    ConnectTimeoutError,
+    NewConnectionError,
+)
+from utils.journal import MESSAGE_JOURNAL
+from utils.metrics import (
+    GATEWAY_RESPONSES,
+    SMS_SEND_FAILURES,
+    time_stage,
+)
+
+CPSMS_API_URL: str = os.getenv("CPSMS_API_URL", "https://api.cpsms.dk/v2/send")
+SMS_TIMEOUT_SECONDS: float = float(os.getenv("SMS_TIMEOUT_SECONDS", "10"))
+SMS_MAX_WORKERS: int = int(os.getenv("SMS_MAX_WORKERS", "8"))
+SMS_RATE_PER_SECOND: float = float(os.getenv("SMS_RATE_PER_SECOND", "10"))
+SMS_MAX_RETRIES: int = int(os.getenv("SMS_MAX_RETRIES", "3"))
+SMS_BACKOFF_SECONDS: float = float(os.getenv("SMS_BACKOFF_SECONDS", "0.5"))
+
+# Statuses by which the gateway turns a request away without handling it.
+# Not 502 or 504: those come from a proxy, which may have passed the request
+# on, so the gateway may have sent the message
+RETRY_STATUS_CODES: tuple = (429, 503)
+
+
+def never_reached_gateway(error: requests.RequestException) -> bool:
+    """
+    Whether a request failed while connecting, before any of it was sent.
+    Other connection errors (e.g. the connection dropped while waiting for
+    the reply) leave it unknown whether the gateway sent the message.
+    """
+
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.ConnectionError) or not error.args:
+        return False
+    reason = getattr(error.args[0], "reason", error.args[0])  # MaxRetryError
+    return isinstance(reason, (ConnectTimeoutError, NewConnectionError))
+
+
+def document_sms(phone_number: str, message_body: str, direction: str) -> None:
+    MESSAGE_JOURNAL.record(phone_number, message_body, direction)
 
 
 def send_sms(
@@ -31,6 +61,9 @@ def send_sms(
     message: str = None,
     token: str = None,
     logger: logging.Logger = None,
+    session: requests.Session = None,
+    url: str = CPSMS_API_URL,
+    timeout: float = SMS_TIMEOUT_SECONDS,
 ) -> Response:
     payload = {"to": to, "message": message}
     headers = {"Authorization": f"Basic {token}"}
@@ -38,11 +71,149 @@ def send_sms(
     if logger:
         logger.info(f"Trying to send payload {json.dumps(payload)} to {to}")
 
-    message = requests.post(
-        url="https://api.cpsms.dk/v2/send", json=payload, headers=headers
+    message = (session or requests).post(
+        url=url, json=payload, headers=headers, timeout=timeout
     )
 
     if logger:
         logger.info(message.text)
 
     return message
+
+
+class RateLimiter:
+    """Token bucket allowing rate_per_second calls, in bursts up to burst"""
+
+    def __init__(self, rate_per_second: float, burst: int = 1):
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst,
+                    self._tokens
+                    + (now - self._updated_at) * self.rate_per_second,
+                )
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate_per_second
+            time.sleep(wait)
+
+
+class SmsDispatcher:
+    """
+    Sends SMSs through send_sms with a pool of keep-alive connections, at
+    most max_workers at a time and no faster than the gateway allows.
+
+    Failures to connect and responses in RETRY_STATUS_CODES are retried with
+    exponential backoff (or as told by Retry-After). Nothing else is, e.g.
+    read timeouts or dropped connections, as the gateway may already have
+    sent the message.
+    """
+
+    def __init__(
+        self,
+        token: str,
+        url: str = CPSMS_API_URL,
+        max_workers: int = SMS_MAX_WORKERS,
+        rate_per_second: float = SMS_RATE_PER_SECOND,
+        timeout: float = SMS_TIMEOUT_SECONDS,
+        max_retries: int = SMS_MAX_RETRIES,
+        backoff_seconds: float = SMS_BACKOFF_SECONDS,
+        logger: logging.Logger = None,
+    ):
+        self.token = token
+        self.url = url
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.logger = logger
+        self.rate_limiter = RateLimiter(rate_per_second, burst=max_workers)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=max_workers, pool_block=True
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _backoff(self, attempt: int, response: Response = None) -> float:
+        retry_after = (
+            response.headers.get("Retry-After")
+            if response is not None
+            else None
+        )
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        return self.backoff_seconds * 2**attempt
+
+    def send(self, to: Union[str, list], message: str) -> Response:
+        """
+        Send one SMS, to one recipient or a list of them, retrying transient
+        failures
+        """
+
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                with time_stage("send_sms"):
+                    response = send_sms(
+                        to=to,
+                        message=message,
+                        token=self.token,
+                        logger=self.logger,
+                        session=self.session,
+                        url=self.url,
+                        timeout=self.timeout,
+                    )
+            except requests.RequestException as e:
+                if not never_reached_gateway(e) or attempt == self.max_retries:
+                    raise
+                time.sleep(self._backoff(attempt))
+                continue
+
+            GATEWAY_RESPONSES.labels(response.status_code).inc()
+
+            if (
+                response.status_code not in RETRY_STATUS_CODES
+                or attempt == self.max_retries
+            ):
+                return response
+            time.sleep(self._backoff(attempt, response))
+
+    def _send_or_log(self, to: str, message: str) -> Optional[Response]:
+        try:
+            response = self.send(to, message)
+        except requests.RequestException as e:
+            if self.logger:
+                self.logger.error(f"Could not send SMS to {to}: {e!r}")
+            response = None
+
+        if response is None or response.status_code != requests.codes.ok:
+            SMS_SEND_FAILURES.inc()
+        return response
+
+    def send_many(self, messages: Iterable[tuple]) -> list:
+        """
+        Send (to, message) pairs concurrently. Returns the responses in the
+        same order, with None for messages that couldn't be sent at all.
+        """
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [
+                executor.submit(self._send_or_log, to, message)
+                for to, message in messages
+            ]
+            return [future.result() for future in futures]
+
+    def close(self) -> None:
+        self.session.close()
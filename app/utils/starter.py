@@ -6,10 +6,14 @@ from datetime import (
 
 from sqlalchemy import (
     and_,
-    func,
+    insert,
     not_,
+    select,
 )
 from sqlalchemy.engine import Engine
+from sqlalchemy.orm.session import Session as SQLAlchemySession
+from sqlalchemy.sql import Select
+from utils.catalog import InstrumentCatalog
 from utils.db import make_session
 from utils.orm import (
     Iteration,
@@ -17,60 +21,98 @@ from utils.orm import (
 )
 
 
-def fetch_iterations_to_open(engine: Engine) -> list[namedtuple]:
-    """
-    Fetch iterations to open from the database. These are iterations that
-    are still closed by are set to open before now()
-    """
+def select_scheduled_iterations() -> Select:
+    return select(Iteration.iteration_id, Iteration.opens_datetime).where(
+        not_(Iteration.is_open)
+    )
 
-    with make_session(engine) as session:
-        iterations = (
-            session.query(Iteration)
-            .filter(
-                and_(
-                    not_(Iteration.is_open),
-                    Iteration.opens_datetime <= func.now(),
-                )
+
+def select_iterations_to_claim(iteration_ids: list[int]) -> Select:
+    return (
+        select(Iteration)
+        .where(
+            and_(
+                Iteration.iteration_id.in_(iteration_ids),
+                not_(Iteration.is_open),
             )
-            .all()
         )
-    return iterations
+        .order_by(Iteration.opens_datetime)
+        .with_for_update(skip_locked=True)
+    )
+
 
+def select_prefilled_iterations(iteration_ids: list[int]) -> Select:
+    return (
+        select(Response.iteration_id)
+        .where(Response.iteration_id.in_(iteration_ids))
+        .distinct()
+    )
 
-def fetch_items(engine: Engine, instrument_id: int) -> list[namedtuple]:
-    """Fetch items for a given instrument_id from the database."""
+
+def fetch_scheduled_iterations(engine: Engine) -> list[namedtuple]:
+    """Fetch iterations that are still closed, and when they are set to open"""
 
     with make_session(engine) as session:
-        items = (
-            session.query(Response.item_id, Response.item_text)
-            .filter(Response.instrument_id == instrument_id)
-            .all()
-        )
-    return items
+        iterations = session.execute(select_scheduled_iterations()).all()
+    return iterations
 
 
-def add_item_to_responses(
-    engine: Engine,
-    phone_number: str,
-    item_text: str,
-    item_id: int,
+def claim_iterations_to_open(
+    session: SQLAlchemySession, iteration_ids: list[int]
+) -> list[Iteration]:
+    """
+    Lock those of iteration_ids that are still closed. Iterations locked by
+    another starter are skipped, so replicas can split a batch between them.
+    Locks are held until session ends.
+    """
+
+    stmt = select_iterations_to_claim(iteration_ids)
+    return list(session.scalars(stmt))
+
+
+def prefill_responses(
+    session: SQLAlchemySession,
+    iterations: list[Iteration],
+    catalog: InstrumentCatalog,
     opens_datetime: datetime = None,
-) -> None:
+) -> int:
     """
     The responses table will be pre-filled with items, and responses will be
-    stored here by the API when invoked through SMS gateway
+    stored here by the API when invoked through SMS gateway.
+
+    All rows for all iterations are written in one multi-row insert, in
+    session's transaction, which must be the one holding the iterations'
+    locks: the foreign key checks of the insert wait for those locks, so
+    inserting through another connection waits forever. Iterations that
+    already have responses (e.g. because their invitation couldn't be sent
+    last time) are skipped. Returns the number of rows written.
     """
 
+    if not iterations:
+        return 0
+
     if not opens_datetime:
         opens_datetime = datetime.now(timezone.utc)
 
-    with make_session(engine) as session:
-        session.add(
-            Response(
-                phone_number=phone_number,
-                item_text=item_text,
-                item_id=item_id,
-                opens_datetime=opens_datetime,
-                status="open",
-            )
+    stmt = select_prefilled_iterations(
+        [iter.iteration_id for iter in iterations]
+    )
+    prefilled = set(session.scalars(stmt))
+
+    rows = [
+        dict(
+            iteration_id=iter.iteration_id,
+            phone_number=iter.phone_number,
+            item_id=item_id,
+            opens_datetime=opens_datetime,
+            status="open",
         )
+        for iter in iterations
+        if iter.iteration_id not in prefilled
+        for item_id in catalog.item_ids(iter.instrument_id)
+    ]
+
+    if rows:
+        session.execute(insert(Response), rows)
+
+    return len(rows)
@@ -0,0 +1,280 @@
+import asyncio
+import os
+import threading
+from abc import (
+    ABC,
+    abstractmethod,
+)
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Optional,
+)
+
+import asyncpg
+from utils.db import (
+    DB_CONN_PARAMS,
+    connection_details,
+)
+from utils.logging import LOGGER
+
+# Must match the channel used by prod.notify_awaiting_change() in init_ddl.sql
+AWAITING_CHANNEL: str = "awaiting_responses"
+
+AWAITING_STORE_MAX_SIZE: int = int(
+    os.getenv("AWAITING_STORE_MAX_SIZE", "10000")
+)
+
+
+class AwaitingStateStore(ABC):
+    """
+    Keeps track of which response_id a phone number is awaiting an answer
+    to. The database is the source of truth, so a miss (None) only means the
+    store doesn't know; callers then go through the database.
+    """
+
+    max_size: Optional[int] = None
+
+    @abstractmethod
+    def get(self, phone_number: str) -> Optional[int]:
+        ...
+
+    @abstractmethod
+    def set(self, phone_number: str, response_id: int) -> None:
+        ...
+
+    @abstractmethod
+    def invalidate(self, phone_number: str, response_id: int = None) -> None:
+        """Forget phone_number, or only if it is awaiting response_id"""
+
+    @abstractmethod
+    def clear(self) -> None:
+        ...
+
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+
+class LRUAwaitingStore(AwaitingStateStore):
+    """In-process store that evicts the least recently used phone numbers"""
+
+    def __init__(self, max_size: int = AWAITING_STORE_MAX_SIZE):
+        self.max_size = max_size
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, phone_number: str) -> Optional[int]:
+        with self._lock:
+            response_id = self._entries.get(phone_number)
+            if response_id is not None:
+                self._entries.move_to_end(phone_number)
+            return response_id
+
+    def set(self, phone_number: str, response_id: int) -> None:
+        with self._lock:
+            self._entries[phone_number] = response_id
+            self._entries.move_to_end(phone_number)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, phone_number: str, response_id: int = None) -> None:
+        with self._lock:
+            if response_id is None or (
+                self._entries.get(phone_number) == response_id
+            ):
+                self._entries.pop(phone_number, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class WarmingStore(AwaitingStateStore):
+    """
+    A store being warmed while notifications already come in. What is loaded
+    for a phone number notified about since is older than the notification,
+    so it is skipped rather than overwriting it.
+    """
+
+    def __init__(self, store: AwaitingStateStore):
+        self.store = store
+        self.max_size = store.max_size
+        self.notified: set = set()
+
+    def get(self, phone_number: str) -> Optional[int]:
+        return self.store.get(phone_number)
+
+    def set(self, phone_number: str, response_id: int) -> None:
+        if phone_number not in self.notified:
+            self.store.set(phone_number, response_id)
+
+    def invalidate(self, phone_number: str, response_id: int = None) -> None:
+        self.store.invalidate(phone_number, response_id)
+
+    def clear(self) -> None:
+        self.store.clear()
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+
+class PhoneNumberLocks:
+    """
+    One asyncio lock per phone number, so that replies from one respondent
+    are handled one at a time, in the order they arrived, while different
+    respondents are handled concurrently. Locks only exist while in use.
+    Only within this process; steps also take the phone number's advisory
+    lock (see utils.conversation.lock_phone_number), which holds across
+    workers and replicas.
+    """
+
+    def __init__(self):
+        self._locks: dict = {}  # phone_number: [lock, number of holders]
+
+    @asynccontextmanager
+    async def hold(self, phone_number: str) -> AsyncIterator[None]:
+        entry = self._locks.setdefault(phone_number, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[phone_number]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+def apply_notification(store: AwaitingStateStore, payload: str) -> str:
+    """
+    Apply a '<phone_number>,<response_id>,<status>' notification; returns
+    the phone number
+    """
+
+    phone_number, response_id, status = payload.rsplit(",", 2)
+    if status == "awaiting":
+        store.set(phone_number, int(response_id))
+    else:
+        store.invalidate(phone_number, int(response_id))
+    return phone_number
+
+
+class NotifyListener(ABC):
+    """
+    Listens on a Postgres channel from within the event loop, reconnecting
+    whenever the connection is lost. Subclasses handle the notifications in
+    on_notification, and catch up on what they may have missed in
+    on_connect, which runs once notifications are coming in. warmed is set
+    while listening, after on_connect.
+    """
+
+    def __init__(self, channel: str, reconnect_seconds: float = 5.0):
+        self.channel = channel
+        self.reconnect_seconds = reconnect_seconds
+        self.warmed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def on_connect(self) -> None:
+        pass
+
+    @abstractmethod
+    def on_notification(self, payload: str) -> None:
+        ...
+
+    def on_disconnect(self) -> None:
+        pass
+
+    def _on_notification(self, connection, pid, channel, payload) -> None:
+        try:
+            self.on_notification(payload)
+        except ValueError:
+            LOGGER.error(f"Malformed notification on {channel}: {payload}")
+
+    async def _listen(self) -> None:
+        cnxn = connection_details(DB_CONN_PARAMS)
+        dsn = (
+            f"postgresql://{cnxn.user}:{cnxn.password}"
+            f"@{cnxn.host}:{cnxn.port}/{cnxn.dbname}"
+        )
+
+        while True:
+            lost = asyncio.Event()
+            connection = None
+            try:
+                connection = await asyncpg.connect(dsn)
+                connection.add_termination_listener(lambda _: lost.set())
+                await connection.add_listener(
+                    self.channel, self._on_notification
+                )
+                await self.on_connect()
+                self.warmed.set()
+                await lost.wait()
+            except Exception as e:
+                LOGGER.error(f"Listening on {self.channel} failed: {e!r}")
+            finally:
+                if connection is not None and not connection.is_closed():
+                    await connection.close()
+
+            self.warmed.clear()
+            self.on_disconnect()
+            await asyncio.sleep(self.reconnect_seconds)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class PostgresNotifyListener(NotifyListener):
+    """
+    Keeps a store coherent across workers and replicas by listening for the
+    notifications sent when a response starts or stops awaiting an answer.
+    """
+
+    def __init__(
+        self,
+        store: AwaitingStateStore,
+        warm: Callable[[AwaitingStateStore], Awaitable] = None,
+        channel: str = AWAITING_CHANNEL,
+        reconnect_seconds: float = 5.0,
+    ):
+        super().__init__(channel, reconnect_seconds)
+        self.store = store
+        self.warm = warm
+        self._warming: Optional[WarmingStore] = None
+
+    async def on_connect(self) -> None:
+        # Anything could have changed while we weren't listening, so
+        # (re)load the store only once notifications are coming in
+        self.store.clear()
+        if self.warm is not None:
+            self._warming = WarmingStore(self.store)
+            try:
+                await self.warm(self._warming)
+            finally:
+                self._warming = None
+
+    def on_notification(self, payload: str) -> None:
+        phone_number = apply_notification(self.store, payload)
+        if self._warming is not None:
+            self._warming.notified.add(phone_number)
+
+    def on_disconnect(self) -> None:
+        self.store.clear()
@@ -0,0 +1,127 @@
+from typing import Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.sql import (
+    Select,
+    func,
+)
+from utils.db_async import make_async_session
+from utils.orm import (
+    InstrumentStats,
+    IterationStats,
+)
+
+# Lower bounds, in seconds, of the buckets of the time to finish an iteration
+# after the first (from 0): a minute, 5 and 15 minutes, half an hour, 1, 2, 4
+# and 8 hours, 1, 2 and 3 days and a week. Must match prod.finish_bucket()
+FINISH_BUCKET_BOUNDS: tuple = (
+    60,
+    300,
+    900,
+    1800,
+    3600,
+    7200,
+    14400,
+    28800,
+    86400,
+    172800,
+    259200,
+    604800,
+)
+
+ITERATION_STATES: tuple = ("open", "awaiting", "closed", "stalled")
+
+
+def estimate_median(buckets: list[int]) -> Optional[float]:
+    """
+    The median of a histogram with FINISH_BUCKET_BOUNDS, interpolated within
+    its bucket, or None if it's empty. In the last (open-ended) bucket, its
+    lower bound.
+    """
+
+    n_total = sum(buckets)
+    if n_total <= 0:
+        return None
+
+    bounds = (0,) + FINISH_BUCKET_BOUNDS
+    n_below = 0
+    for i, n in enumerate(buckets):
+        if n > 0 and n_below + n >= n_total / 2:
+            if i + 1 == len(bounds):
+                return float(bounds[i])
+            share = (n_total / 2 - n_below) / n
+            return bounds[i] + share * (bounds[i + 1] - bounds[i])
+        n_below += n
+    return None
+
+
+def select_instrument_stats(instrument_id: int) -> Select:
+    """At most one row per slot, so as cheap however large the study"""
+
+    return select(InstrumentStats).where(
+        InstrumentStats.instrument_id == instrument_id
+    )
+
+
+def select_iteration_stats(iteration_id: int) -> Select:
+    s = IterationStats
+    state = func.prod.iteration_state(
+        s.n_open, s.n_awaiting, s.n_closed, s.n_expired
+    )
+    stmt = select(s, state.label("state"))
+    return stmt.where(s.iteration_id == iteration_id)
+
+
+def summarize_instrument(instrument_id: int, slots: list) -> dict:
+    """Iterations by state, and the median time to finish, over all slots"""
+
+    summary = dict(instrument_id=instrument_id)
+    for state in ITERATION_STATES:
+        summary[f"n_{state}"] = sum(getattr(s, f"n_{state}") for s in slots)
+
+    buckets = [0] * (len(FINISH_BUCKET_BOUNDS) + 1)
+    for slot in slots:
+        for i, n in enumerate(slot.finish_buckets):
+            buckets[i] += n
+    summary["median_seconds_to_finish"] = estimate_median(buckets)
+    return summary
+
+
+async def fetch_instrument_stats(
+    engine: AsyncEngine, instrument_id: int
+) -> dict:
+    async with make_async_session(engine) as session:
+        stmt = select_instrument_stats(instrument_id)
+        slots = (await session.scalars(stmt)).all()
+    return summarize_instrument(instrument_id, slots)
+
+
+async def fetch_iteration_stats(
+    engine: AsyncEngine, iteration_id: int
+) -> Optional[dict]:
+    """None if the iteration hasn't been opened (or doesn't exist)"""
+
+    stmt = select_iteration_stats(iteration_id)
+    async with make_async_session(engine) as session:
+        row = (await session.execute(stmt)).one_or_none()
+    if row is None:
+        return None
+
+    stats = row.IterationStats
+    seconds_to_finish = None
+    if stats.finished_at is not None:
+        finished_in = stats.finished_at - stats.opened_at
+        seconds_to_finish = finished_in.total_seconds()
+    return dict(
+        iteration_id=stats.iteration_id,
+        instrument_id=stats.instrument_id,
+        state=row.state,
+        n_open=stats.n_open,
+        n_awaiting=stats.n_awaiting,
+        n_closed=stats.n_closed,
+        n_expired=stats.n_expired,
+        opened_at=stats.opened_at.isoformat(),
+        finished_at=stats.finished_at and stats.finished_at.isoformat(),
+        seconds_to_finish=seconds_to_finish,
+    )
@@ -9,6 +9,35 @@ CREATE EXTENSION IF NOT EXISTS temporal_tables;
 CREATE SCHEMA prod;
 CREATE SCHEMA history;
 
+-- History, messages and log grow without bound, so they are range-partitioned
+-- by month: old months are archived and dropped a partition at a time (see
+-- app/utils/partitions.py) instead of with row-by-row DELETEs. Partitions are
+-- named <parent>_pYYYYMM; each parent also has a DEFAULT partition, so rows
+-- never fail to insert, but it should stay empty: a month can't be created
+-- while the default partition holds rows for it.
+CREATE FUNCTION prod.create_monthly_partitions(
+    parent text, months_ahead integer DEFAULT 3
+) RETURNS integer AS $$
+DECLARE
+    month date := date_trunc('month', now());
+    partition_name text;
+    n_created integer := 0;
+BEGIN
+    FOR i IN 0..months_ahead LOOP
+        partition_name := parent || '_p' || to_char(month, 'YYYYMM');
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %s PARTITION OF %s FOR VALUES FROM (%L) TO (%L)',
+                partition_name, parent, month, month + interval '1 month'
+            );
+            n_created := n_created + 1;
+        END IF;
+        month := month + interval '1 month';
+    END LOOP;
+    RETURN n_created;
+END;
+$$ LANGUAGE plpgsql;
+
 
 -- Recipients
 CREATE TABLE prod.recipients (
@@ -32,8 +61,9 @@ CREATE TABLE prod.instruments (
 ALTER TABLE prod.instruments OWNER TO postgres;
 
 CREATE TABLE history.instruments (
-	LIKE prod.instruments INCLUDING ALL EXCLUDING INDEXES
-);
+    LIKE prod.instruments INCLUDING ALL EXCLUDING INDEXES
+) PARTITION BY RANGE (upper(sys_period));  -- when the version ended
+CREATE TABLE history.instruments_default PARTITION OF history.instruments DEFAULT;
 ALTER TABLE history.instruments OWNER TO postgres;
 
 CREATE TRIGGER versioning_changes
@@ -56,7 +86,8 @@ ALTER TABLE prod.items OWNER TO postgres;
 
 CREATE TABLE history.items (
     LIKE prod.items INCLUDING ALL EXCLUDING INDEXES
-);
+) PARTITION BY RANGE (upper(sys_period));  -- when the version ended
+CREATE TABLE history.items_default PARTITION OF history.items DEFAULT;
 ALTER TABLE history.items OWNER TO postgres;
 
 CREATE TRIGGER versioning_changes
@@ -65,6 +96,23 @@ FOR EACH ROW EXECUTE PROCEDURE versioning(
     'sys_period', 'history.items', true
 );
 
+-- Tell the services to reload their in-memory instrument catalog (see
+-- app/utils/catalog.py) when instruments or items change. Payload is the table
+CREATE FUNCTION prod.notify_catalog_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('catalog_changed', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER notify_catalog_change
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON prod.instruments
+FOR EACH STATEMENT EXECUTE FUNCTION prod.notify_catalog_change();
+
+CREATE TRIGGER notify_catalog_change
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON prod.items
+FOR EACH STATEMENT EXECUTE FUNCTION prod.notify_catalog_change();
+
 
 -- Iterations
 CREATE TABLE prod.iterations (
@@ -79,12 +127,15 @@ CREATE TABLE prod.iterations (
     sys_period tstzrange NOT NULL DEFAULT tstzrange(current_timestamp, NULL)
 );
 ALTER TABLE prod.iterations OWNER TO postgres;
-CREATE INDEX idx__is_open ON prod.iterations (is_open) WHERE is_open is not true;
+-- Iterations still to be opened, by when; covers the starter's scheduling query
+CREATE INDEX idx__iterations__closed ON prod.iterations (opens_datetime)
+    INCLUDE (iteration_id) WHERE NOT is_open;
     -- partial index, faster than full index
 
 CREATE TABLE history.iterations (
     LIKE prod.iterations INCLUDING ALL EXCLUDING INDEXES
-);
+) PARTITION BY RANGE (upper(sys_period));  -- when the version ended
+CREATE TABLE history.iterations_default PARTITION OF history.iterations DEFAULT;
 ALTER TABLE history.iterations OWNER TO postgres;
 
 CREATE TRIGGER versioning_changes
@@ -93,25 +144,68 @@ FOR EACH ROW EXECUTE PROCEDURE versioning(
     'sys_period', 'history.iterations', true
 );
 
+-- Wake up the starters when iterations are added, rescheduled or opened
+-- (see app/utils/scheduler.py). Payload is iteration_id,opens_datetime as unix
+-- time, with an empty opens_datetime when the iteration no longer needs opening
+CREATE FUNCTION prod.notify_iteration_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify(
+        'iterations_scheduled',
+        NEW.iteration_id || ',' || CASE
+            WHEN NEW.is_open THEN ''
+            ELSE extract(epoch FROM NEW.opens_datetime)::text
+        END
+    );
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER notify_iteration_change
+AFTER INSERT OR UPDATE OF is_open, opens_datetime ON prod.iterations
+FOR EACH ROW EXECUTE FUNCTION prod.notify_iteration_change();
+
 
 -- Responses
 CREATE TABLE prod.responses (
     response_id SERIAL PRIMARY KEY,
+    iteration_id integer REFERENCES prod.iterations (iteration_id),
     phone_number text REFERENCES prod.recipients (phone_number),
-    item_id integer REFERENCES prod.items (item_id),
-    item_text text,
+    item_id integer REFERENCES prod.items (item_id),  -- NULL for the closing item
     opens_datetime timestamp with time zone,
     response integer,
     status text DEFAULT 'open',
     created_datetime timestamp with time zone DEFAULT now(),
     updated_by text DEFAULT 'init',
+    -- Timers of a response awaiting an answer (see app/utils/reminders.py)
+    remind_at timestamp with time zone,
+    expires_at timestamp with time zone,
+    n_reminders integer NOT NULL DEFAULT 0,
     sys_period tstzrange NOT NULL DEFAULT tstzrange(current_timestamp, NULL)
 );
 ALTER TABLE prod.responses OWNER TO postgres;
 
+-- One each for the two lookups of every webhook call: the response awaiting an
+-- answer and the next open item (see app/utils/conversation.py). Partial, so
+-- they stay small however many closed responses pile up
+CREATE INDEX idx__responses__awaiting ON prod.responses (phone_number, response_id)
+    WHERE status = 'awaiting';
+CREATE INDEX idx__responses__open ON prod.responses (phone_number, response_id)
+    WHERE status = 'open';
+CREATE INDEX idx__responses__iteration_id ON prod.responses (iteration_id);
+-- Due reminders and expiries; only awaiting responses, so the cost of finding
+-- what is due doesn't grow with the number of conversations
+CREATE INDEX idx__responses__remind_at ON prod.responses (remind_at)
+    WHERE status = 'awaiting';
+CREATE INDEX idx__responses__expires_at ON prod.responses (expires_at)
+    WHERE status = 'awaiting';
+-- For incremental exports, which pick what changed since the last one (see
+-- app/utils/export.py)
+CREATE INDEX idx__responses__last_changed ON prod.responses (lower(sys_period));
+
 CREATE TABLE history.responses (
     LIKE prod.responses INCLUDING ALL EXCLUDING INDEXES
-);
+) PARTITION BY RANGE (upper(sys_period));  -- when the version ended
+CREATE TABLE history.responses_default PARTITION OF history.responses DEFAULT;
 ALTER TABLE history.responses OWNER TO postgres;
 
 CREATE TRIGGER versioning_changes
@@ -120,26 +214,316 @@ FOR EACH ROW EXECUTE PROCEDURE versioning(
     'sys_period', 'history.responses', true
 );
 
+-- Tell the FastAPI workers when a response starts or stops awaiting an answer,
+-- so their in-process stores stay coherent (see app/utils/state.py).
+-- Notifications are delivered on commit, payload is phone_number,response_id,status
+CREATE FUNCTION prod.notify_awaiting_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        IF OLD.status = 'awaiting' THEN
+            PERFORM pg_notify(
+                'awaiting_responses',
+                concat_ws(',', OLD.phone_number, OLD.response_id, 'deleted')
+            );
+        END IF;
+        RETURN OLD;
+    END IF;
+
+    IF NEW.status = 'awaiting' OR (TG_OP = 'UPDATE' AND OLD.status = 'awaiting') THEN
+        PERFORM pg_notify(
+            'awaiting_responses',
+            concat_ws(',', NEW.phone_number, NEW.response_id, coalesce(NEW.status, 'null'))
+        );
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER notify_awaiting_change
+AFTER INSERT OR UPDATE OF status OR DELETE ON prod.responses
+FOR EACH ROW EXECUTE FUNCTION prod.notify_awaiting_change();
+
+
+-- Completion statistics
+-- Kept up to date by triggers on prod.responses, in the transactions changing
+-- them, so reading them never scans responses (see app/utils/stats.py). Only
+-- the items count, not the closing item. An iteration is open until its first
+-- item is asked, awaiting while items are being asked, stalled once an item
+-- expires, and closed when all items are answered
+CREATE TABLE prod.iteration_stats (
+    iteration_id integer PRIMARY KEY
+        REFERENCES prod.iterations (iteration_id) ON DELETE CASCADE,
+    instrument_id integer NOT NULL,
+    n_open integer NOT NULL DEFAULT 0,
+    n_awaiting integer NOT NULL DEFAULT 0,
+    n_closed integer NOT NULL DEFAULT 0,
+    n_expired integer NOT NULL DEFAULT 0,
+    opened_at timestamp with time zone NOT NULL DEFAULT now(),
+    finished_at timestamp with time zone
+);
+ALTER TABLE prod.iteration_stats OWNER TO postgres;
+
+-- Iterations by state, per instrument, spread over 16 slots (by iteration_id)
+-- so that concurrent conversations rarely wait for each other's row lock.
+-- finish_buckets is a histogram of the time from opening to closing, with the
+-- buckets of prod.finish_bucket()
+CREATE TABLE prod.instrument_stats (
+    instrument_id integer
+        REFERENCES prod.instruments (instrument_id) ON DELETE CASCADE,
+    slot smallint,
+    n_open bigint NOT NULL DEFAULT 0,
+    n_awaiting bigint NOT NULL DEFAULT 0,
+    n_closed bigint NOT NULL DEFAULT 0,
+    n_stalled bigint NOT NULL DEFAULT 0,
+    finish_buckets bigint[] NOT NULL DEFAULT array_fill(0::bigint, ARRAY[13]),
+    PRIMARY KEY (instrument_id, slot)
+);
+ALTER TABLE prod.instrument_stats OWNER TO postgres;
+
+-- Must match FINISH_BUCKET_BOUNDS in app/utils/stats.py
+CREATE FUNCTION prod.finish_bucket(time_to_finish interval) RETURNS integer AS $$
+    SELECT 1 + width_bucket(
+        extract(epoch FROM time_to_finish)::double precision,
+        ARRAY[60, 300, 900, 1800, 3600, 7200, 14400, 28800, 86400, 172800,
+              259200, 604800]::double precision[]
+    )
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE FUNCTION prod.iteration_state(
+    n_open integer, n_awaiting integer, n_closed integer, n_expired integer
+) RETURNS text AS $$
+    SELECT CASE
+        WHEN n_open + n_awaiting + n_closed + n_expired = 0 THEN NULL
+        WHEN n_expired > 0 THEN 'stalled'
+        WHEN n_awaiting > 0 OR (n_open > 0 AND n_closed > 0) THEN 'awaiting'
+        WHEN n_open > 0 THEN 'open'
+        ELSE 'closed'
+    END
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Apply changes in the number of responses (of iteration_ids[i], with
+-- statuses[i], by deltas[i]) to the statistics of their iterations and
+-- instruments
+CREATE FUNCTION prod.apply_response_changes(
+    iteration_ids integer[], statuses text[], deltas integer[]
+) RETURNS void AS $$
+DECLARE
+    d record;
+    s prod.iteration_stats;
+    old_state text;
+    new_state text;
+    bucket integer;
+    d_finished integer;
+BEGIN
+    FOR d IN
+        SELECT
+            iteration_id,
+            coalesce(sum(delta) FILTER (WHERE status = 'open'), 0)::integer
+                AS d_open,
+            coalesce(sum(delta) FILTER (WHERE status = 'awaiting'), 0)::integer
+                AS d_awaiting,
+            coalesce(sum(delta) FILTER (WHERE status = 'closed'), 0)::integer
+                AS d_closed,
+            coalesce(sum(delta) FILTER (WHERE status = 'expired'), 0)::integer
+                AS d_expired
+        FROM unnest(iteration_ids, statuses, deltas)
+            AS t (iteration_id, status, delta)
+        WHERE iteration_id IS NOT NULL
+        GROUP BY iteration_id
+        -- Slots in the same order everywhere, against deadlocks
+        ORDER BY iteration_id % 16, iteration_id
+    LOOP
+        INSERT INTO prod.iteration_stats AS i (
+            iteration_id, instrument_id, n_open, n_awaiting, n_closed, n_expired
+        )
+        SELECT iteration_id, instrument_id, d.d_open, d.d_awaiting,
+            d.d_closed, d.d_expired
+        FROM prod.iterations
+        WHERE iteration_id = d.iteration_id AND instrument_id IS NOT NULL
+        ON CONFLICT (iteration_id) DO UPDATE SET
+            n_open = i.n_open + excluded.n_open,
+            n_awaiting = i.n_awaiting + excluded.n_awaiting,
+            n_closed = i.n_closed + excluded.n_closed,
+            n_expired = i.n_expired + excluded.n_expired
+        RETURNING * INTO s;
+        CONTINUE WHEN NOT FOUND;
+
+        old_state := prod.iteration_state(
+            s.n_open - d.d_open, s.n_awaiting - d.d_awaiting,
+            s.n_closed - d.d_closed, s.n_expired - d.d_expired
+        );
+        new_state := prod.iteration_state(
+            s.n_open, s.n_awaiting, s.n_closed, s.n_expired
+        );
+        CONTINUE WHEN old_state IS NOT DISTINCT FROM new_state;
+
+        -- Time to finish, counted from when the iteration was (re)opened
+        bucket := 1;
+        d_finished := 0;
+        IF new_state = 'closed' THEN
+            bucket := prod.finish_bucket(now() - s.opened_at);
+            d_finished := 1;
+            UPDATE prod.iteration_stats SET finished_at = now()
+            WHERE iteration_id = s.iteration_id;
+        ELSIF old_state = 'closed' THEN
+            bucket := prod.finish_bucket(s.finished_at - s.opened_at);
+            d_finished := -1;
+            UPDATE prod.iteration_stats SET finished_at = NULL
+            WHERE iteration_id = s.iteration_id;
+        END IF;
+        IF new_state = 'open' AND old_state IS NOT NULL THEN
+            UPDATE prod.iteration_stats SET opened_at = now()
+            WHERE iteration_id = s.iteration_id;
+        END IF;
+
+        INSERT INTO prod.instrument_stats (instrument_id, slot)
+        VALUES (s.instrument_id, s.iteration_id % 16)
+        ON CONFLICT DO NOTHING;
+        UPDATE prod.instrument_stats SET
+            n_open = n_open
+                + CASE new_state WHEN 'open' THEN 1 ELSE 0 END
+                - CASE old_state WHEN 'open' THEN 1 ELSE 0 END,
+            n_awaiting = n_awaiting
+                + CASE new_state WHEN 'awaiting' THEN 1 ELSE 0 END
+                - CASE old_state WHEN 'awaiting' THEN 1 ELSE 0 END,
+            n_closed = n_closed
+                + CASE new_state WHEN 'closed' THEN 1 ELSE 0 END
+                - CASE old_state WHEN 'closed' THEN 1 ELSE 0 END,
+            n_stalled = n_stalled
+                + CASE new_state WHEN 'stalled' THEN 1 ELSE 0 END
+                - CASE old_state WHEN 'stalled' THEN 1 ELSE 0 END,
+            finish_buckets[bucket] = finish_buckets[bucket] + d_finished
+        WHERE instrument_id = s.instrument_id AND slot = s.iteration_id % 16;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Statement triggers, so a statement changing many responses (e.g. prefilling
+-- a batch of iterations) updates each iteration's statistics once. Updates not
+-- changing status (e.g. moving reminder timers on) change nothing
+CREATE FUNCTION prod.count_response_changes() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM prod.apply_response_changes(
+            array_agg(iteration_id), array_agg(status), array_agg(1)
+        )
+        FROM new_rows
+        WHERE item_id IS NOT NULL;
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM prod.apply_response_changes(
+            array_agg(iteration_id), array_agg(status), array_agg(-1)
+        )
+        FROM old_rows
+        WHERE item_id IS NOT NULL;
+    ELSE
+        PERFORM prod.apply_response_changes(
+            array_agg(iteration_id), array_agg(status), array_agg(delta)
+        )
+        FROM (
+            SELECT o.iteration_id, o.status, -1 AS delta
+            FROM old_rows AS o JOIN new_rows AS n USING (response_id)
+            WHERE o.status IS DISTINCT FROM n.status AND o.item_id IS NOT NULL
+            UNION ALL
+            SELECT n.iteration_id, n.status, 1
+            FROM old_rows AS o JOIN new_rows AS n USING (response_id)
+            WHERE o.status IS DISTINCT FROM n.status AND n.item_id IS NOT NULL
+        ) AS changes;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER count_inserted_responses
+AFTER INSERT ON prod.responses
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION prod.count_response_changes();
+
+CREATE TRIGGER count_updated_responses
+AFTER UPDATE ON prod.responses
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION prod.count_response_changes();
+
+CREATE TRIGGER count_deleted_responses
+AFTER DELETE ON prod.responses
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION prod.count_response_changes();
+
 
 -- Log
 CREATE TABLE prod.log (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     level character varying(10),
     message text,
-    created_at timestamp without time zone DEFAULT now()
-);
+    created_at timestamp without time zone DEFAULT now(),
+    PRIMARY KEY (id, created_at)  -- must include the partition key
+) PARTITION BY RANGE (created_at);
 ALTER TABLE prod.log OWNER TO postgres;
+CREATE TABLE prod.log_default PARTITION OF prod.log DEFAULT;
 
 
 -- Messages
 CREATE TABLE prod.messages (
-    message_id SERIAL PRIMARY KEY,
+    message_id SERIAL,
     sent_datetime timestamp with time zone DEFAULT now() NOT NULL,
     phone_number text REFERENCES prod.recipients (phone_number),
     message_body text,
-    direction text CHECK (direction IN ('outbound', 'inbound'))
-);
+    direction text CHECK (direction IN ('outbound', 'inbound')),
+    PRIMARY KEY (message_id, sent_datetime)  -- must include the partition key
+) PARTITION BY RANGE (sent_datetime);
 ALTER TABLE prod.messages OWNER TO postgres;
+CREATE TABLE prod.messages_default PARTITION OF prod.messages DEFAULT;
+
+
+
+-- Outbox
+-- Messages to send, written in the same transaction as the state change that
+-- calls for them, and sent by the starters (see app/utils/outbox.py). Sent
+-- messages move to prod.messages
+CREATE TABLE prod.outbox (
+    outbox_id bigserial PRIMARY KEY,
+    phone_number text NOT NULL REFERENCES prod.recipients (phone_number),
+    message_body text NOT NULL,
+    status text NOT NULL DEFAULT 'pending'
+        CHECK (status IN ('pending', 'sending', 'failed', 'unknown')),
+    n_attempts integer NOT NULL DEFAULT 0,
+    not_before timestamp with time zone NOT NULL DEFAULT now(),
+    claimed_at timestamp with time zone,
+    error text,
+    created_datetime timestamp with time zone NOT NULL DEFAULT now()
+);
+ALTER TABLE prod.outbox OWNER TO postgres;
+CREATE INDEX idx__outbox__pending ON prod.outbox (outbox_id)
+    WHERE status = 'pending';
+CREATE INDEX idx__outbox__sending ON prod.outbox (claimed_at)
+    WHERE status = 'sending';
+
+-- Replies the webhook sent, by the gateway's identifiers of the inbound
+-- message (see idempotency_key() in app/utils/api.py), so that a call the
+-- gateway retries gets the same reply on any worker or replica without moving
+-- the conversation again. Written in the transaction of the step; purged by
+-- the maintenance service
+CREATE TABLE prod.sent_replies (
+    idempotency_key text PRIMARY KEY,
+    phone_number text NOT NULL,
+    reply text NOT NULL,
+    created_datetime timestamp with time zone NOT NULL DEFAULT now()
+);
+ALTER TABLE prod.sent_replies OWNER TO postgres;
+CREATE INDEX idx__sent_replies__created_datetime
+    ON prod.sent_replies (created_datetime);
 
 COMMENT ON TABLE prod.messages IS
 'Holds all in- and outbound messages with timestamp, but without any tracking of which belong together. Table is meant for documentation and data scrutiny.';
+
+
+-- This month's and the next three months' partitions; later ones are created
+-- by the maintenance service
+SELECT prod.create_monthly_partitions(parent)
+FROM unnest(ARRAY[
+    'history.instruments',
+    'history.items',
+    'history.iterations',
+    'history.responses',
+    'prod.log',
+    'prod.messages'
+]) AS parent;
@@ -61,14 +61,22 @@ SELECT
     , now()
 FROM prod.recipients;
 
-INSERT INTO prod.responses (phone_number, item_text, item_id, opens_datetime, status)
+INSERT INTO prod.responses (iteration_id, phone_number, item_id, opens_datetime, status)
 SELECT
-    '4500000000'
-    , item_text
+    (SELECT max(iteration_id) FROM prod.iterations WHERE phone_number = '4500000000')
+    , '4500000000'
     , item_id
     , now()
     , 'open'
 FROM prod.items;
 
-INSERT INTO prod.responses (phone_number, item_text, item_id, opens_datetime, status)
-VALUES ('4500000000', 'Thank you for your help! Reply with the word Restart to start over.', NULL, now(), 'open');
+-- The closing item, whose text is in app/utils/catalog.py
+INSERT INTO prod.responses (iteration_id, phone_number, item_id, opens_datetime, status)
+SELECT
+    max(iteration_id)
+    , '4500000000'
+    , NULL
+    , now()
+    , 'open'
+FROM prod.iterations
+WHERE phone_number = '4500000000';